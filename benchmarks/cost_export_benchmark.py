@@ -0,0 +1,408 @@
+"""End-to-end throughput and memory benchmark for the FOCUS cost export pipeline
+
+Generates synthetic FOCUS parquet parts in the layout Cost Management exports
+create, uploads them to Azurite and runs CostExportProcessor (one queue message
+per part) or CostExportBatchProcessor against them. Output goes to an S3
+stand-in: moto, started in-process, or MinIO given with --s3-endpoint. STS is
+stubbed with static credentials.
+
+Each case runs in a fresh process and reports rows/s, MB/s of source parquet,
+peak RSS and the time spent per stage. The stages are blob download, encode,
+S3 upload and source delete; decode and transform make up the remainder.
+Results are appended as JSON lines with the git commit and library versions.
+--compare prints the change against an earlier results file.
+
+Settings are passed with --setting. PARQUET_PRE_BUFFER=true trades memory for
+fewer blob requests: each part's kept column chunks are fetched a row group at a
+time in a few coalesced ranged reads, instead of about one read per column
+chunk, but holds a whole row group of those columns in memory while it is
+decoded. Compare the download stage and peak RSS with and without it before
+enabling it on Flex Consumption instances with 2 GB of memory.
+
+Requirements: Azurite on its default ports (npx azurite --silent --inMemoryPersistence)
+and pip install "moto[server]", unless --s3-endpoint points at MinIO.
+
+Usage: python benchmarks/cost_export_benchmark.py [--rows 200000] [--files 4] [--extra-columns 20]
+       [--mode message batch] [--repeat 3] [--output results.jsonl] [--compare baseline.jsonl]
+"""
+import argparse
+import functools
+import json
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone, timedelta
+from multiprocessing import get_context
+
+SRC_DIR = os.path.join(os.path.dirname(__file__), "..", "src", "cost_export")
+sys.path.insert(0, SRC_DIR)
+
+import pyarrow as pa  # noqa: E402
+import pyarrow.parquet as pq  # noqa: E402
+
+AZURITE_CONNECTION_STRING = (
+    "DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;"
+    "AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTBHLYZ/+NonSoU+Sw==;"
+    "BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;QueueEndpoint=http://127.0.0.1:10001/devstoreaccount1;"
+)
+CONTAINER_NAME = "benchmark"
+BUCKET_NAME = "cost-export-benchmark"
+BLOCK_ROWS = 65536
+
+BILLING_ACCOUNT = "/providers/Microsoft.Billing/billingAccounts/bdfa614c-3bed-5e6d-313b-b4bfa3cefe1d:16e4ddda-0100-468b-a32c-abbfc29019d8_2019-05-31"
+
+# FOCUS columns with a small set of repeating values, as in real exports
+CATEGORICAL_COLUMNS = {
+    "AvailabilityZone": ["", "1", "2", "3"],
+    "BillingAccountName": ["Example Billing Account"],
+    "BillingAccountType": ["Billing Profile"],
+    "BillingCurrency": ["GBP"],
+    "ChargeCategory": ["Usage", "Purchase", "Tax", "Credit", "Adjustment"],
+    "ChargeClass": ["", "Correction"],
+    "ChargeFrequency": ["Usage-Based", "Recurring", "One-Time"],
+    "CommitmentDiscountCategory": ["", "Spend", "Usage"],
+    "CommitmentDiscountStatus": ["", "Used", "Unused"],
+    "CommitmentDiscountType": ["", "Reservation", "Savings Plan"],
+    "ConsumedUnit": ["Hours", "GB", "10K", "1M"],
+    "InvoiceIssuerName": ["Microsoft"],
+    "PricingCategory": ["Standard", "Committed", "Dynamic"],
+    "PricingUnit": ["1 Hour", "1 GB/Month", "10K", "1M"],
+    "ProviderName": ["Microsoft"],
+    "PublisherName": ["Microsoft", "Canonical", "Red Hat"],
+    "RegionId": ["uksouth", "ukwest", "westeurope", "northeurope"],
+    "RegionName": ["UK South", "UK West", "West Europe", "North Europe"],
+    "ResourceType": [f"Microsoft.Example/type{i}" for i in range(40)],
+    "ServiceCategory": ["Compute", "Storage", "Networking", "Databases", "Analytics"],
+    "ServiceName": [f"Service {i}" for i in range(60)],
+    "SubAccountType": ["Subscription"],
+}
+
+# FOCUS columns with mostly distinct values per row
+IDENTIFIER_COLUMNS = ["ChargeDescription", "CommitmentDiscountId", "CommitmentDiscountName", "ResourceId", "ResourceName", "SkuId", "SkuPriceId", "SubAccountId", "SubAccountName", "Tags"]
+
+COST_COLUMNS = ["BilledCost", "ContractedCost", "ContractedUnitPrice", "EffectiveCost", "ListCost", "ListUnitPrice", "ConsumedQuantity", "PricingQuantity"]
+
+def synthetic_block(rows, day, extra_columns, rng):
+    """Build one block of synthetic FOCUS rows for a single charge day"""
+    start = datetime(2025, 8, day, tzinfo=timezone.utc)
+    columns = {
+        "BillingAccountId": pa.array([BILLING_ACCOUNT] * rows),
+        "BillingPeriodStart": pa.array([datetime(2025, 8, 1, tzinfo=timezone.utc)] * rows, pa.timestamp("us", tz="UTC")),
+        "BillingPeriodEnd": pa.array([datetime(2025, 9, 1, tzinfo=timezone.utc)] * rows, pa.timestamp("us", tz="UTC")),
+        "ChargePeriodStart": pa.array([start] * rows, pa.timestamp("us", tz="UTC")),
+        "ChargePeriodEnd": pa.array([start + timedelta(days=1)] * rows, pa.timestamp("us", tz="UTC")),
+    }
+    for name, values in CATEGORICAL_COLUMNS.items():
+        indices = pa.array([rng.randrange(len(values)) for _ in range(rows)], pa.int32())
+        columns[name] = pa.DictionaryArray.from_arrays(indices, pa.array(values)).cast(pa.string())
+    for name in IDENTIFIER_COLUMNS:
+        columns[name] = pa.array([f"{name}-{rng.randrange(rows * 4)}" for _ in range(rows)])
+    for name in COST_COLUMNS:
+        columns[name] = pa.array([rng.random() * 100 for _ in range(rows)], pa.float64())
+    for i in range(extra_columns):
+        columns[f"x_ExtraColumn{i}"] = pa.array([f"x{rng.randrange(1000)}" for _ in range(rows)])
+    return pa.table(columns)
+
+def export_blob_name(part):
+    """Blob name of a daily export part, as Cost Management writes it"""
+    return f"gds-focus-v1/focus-daily-cost-export-0/20250801-20250831/202508150632/{uuid.UUID(int=1)}/part_{part}_0001.parquet"
+
+def generate_parts(directory, rows, files, extra_columns, days=14, seed=1):
+    """Write synthetic export parts to directory and return [(blob name, local path, rows, bytes)]
+
+    Rows are built from blocks of up to BLOCK_ROWS rows that cycle through
+    charge days, so generation stays fast for large files.
+    """
+    rng = random.Random(seed)
+    blocks = [synthetic_block(min(BLOCK_ROWS, rows), day % days + 1, extra_columns, rng) for day in range(min(days, -(-rows // BLOCK_ROWS)))]
+    parts = []
+    for part in range(files):
+        path = os.path.join(directory, f"part_{part}.parquet")
+        with pq.ParquetWriter(path, blocks[0].schema, compression="snappy") as writer:
+            written = 0
+            while written < rows:
+                block = blocks[(written // BLOCK_ROWS) % len(blocks)].slice(0, rows - written)
+                writer.write_table(block)
+                written += block.num_rows
+        parts.append((export_blob_name(part), path, rows, os.path.getsize(path)))
+    return parts
+
+class StageTimer:
+    """Accumulates exclusive wall time per stage by wrapping methods
+
+    Time spent in a nested wrapped call is charged to the inner stage only, so
+    the stages add up to no more than the total.
+    """
+
+    def __init__(self):
+        self.totals = defaultdict(float)
+        self._local = threading.local()
+
+    def wrap(self, owner, name, stage):
+        original = getattr(owner, name)
+        timer = self
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            stack = timer._local.__dict__.setdefault("stack", [])
+            stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                nested = stack.pop()
+                timer.totals[stage] += elapsed - nested
+                if stack:
+                    stack[-1] += elapsed
+
+        setattr(owner, name, timed)
+
+def stub_sts(common, s3_endpoint, access_key, secret_key):
+    """Replace the STS role assumption with static credentials for the S3 stand-in"""
+    import boto3
+    from botocore.config import Config as BotoConfig
+    from pyarrow.fs import S3FileSystem
+
+    scheme, _, host = s3_endpoint.partition("://")
+
+    def create_clients():
+        filesystem = S3FileSystem(access_key=access_key, secret_key=secret_key, region=common.Config.aws_region, endpoint_override=host, scheme=scheme)
+        client = boto3.client(
+            "s3",
+            endpoint_url=s3_endpoint,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            region_name=common.Config.aws_region,
+            config=BotoConfig(max_pool_connections=max(10, common.Config.s3_upload_concurrency * 4))
+        )
+        return (filesystem, client), datetime.now(timezone.utc) + timedelta(hours=12)
+
+    common._s3_filesystem_cache._create_clients = create_clients
+
+def event_message(blob_name, size):
+    """Build the EventGrid BlobCreated message Event Grid delivers to the costdata queue"""
+    return json.dumps({
+        "subject": f"/blobServices/default/containers/{CONTAINER_NAME}/blobs/{blob_name}",
+        "eventType": "Microsoft.Storage.BlobCreated",
+        "data": {"contentLength": size},
+    })
+
+def run_case(case):
+    """Run one benchmark case in the current (fresh) process and return its measurements"""
+    os.environ.update({
+        "ENTRA_APP_CLIENT_ID": "00000000-0000-0000-0000-000000000000",
+        "ENTRA_APP_URN": "api://benchmark",
+        "AWS_ROLE_ARN": "arn:aws:iam::000000000000:role/benchmark",
+        "AWS_REGION": "eu-west-2",
+        "S3_FOCUS_PATH": f"s3://{BUCKET_NAME}/{case['run_id']}/",
+        "S3_UTILIZATION_PATH": f"s3://{BUCKET_NAME}/",
+        "S3_RECOMMENDATIONS_PATH": f"s3://{BUCKET_NAME}/",
+        "S3_CARBON_PATH": f"s3://{BUCKET_NAME}/",
+        "CARBON_DIRECTORY_NAME": "carbon",
+        "STORAGE_CONNECTION_STRING": case["storage_connection_string"],
+        "CONTAINER_NAME": CONTAINER_NAME,
+        "COST_EXPORT_BATCH_MODE": "true" if case["mode"] == "batch" else "false",
+    })
+    os.environ.update(case["settings"])
+
+    import_start = time.perf_counter()
+    import azure.functions as func
+    import common
+    import focus
+    import function_app
+    from azure.core.exceptions import ResourceExistsError
+    from azure.storage.blob import BlobClient, ContainerClient
+    import_seconds = time.perf_counter() - import_start
+
+    stub_sts(common, case["s3_endpoint"], case["s3_access_key"], case["s3_secret_key"])
+
+    # Upload the source parts; the processor deletes each one once it is exported
+    container_client = common.azure_clients.container_client()
+    try:
+        container_client.create_container()
+    except ResourceExistsError:
+        pass
+    for blob_name, path, _, _ in case["parts"]:
+        with open(path, "rb") as data:
+            container_client.upload_blob(blob_name, data, overwrite=True)
+
+    if case["mode"] == "batch":
+        queue_client = common.azure_clients.queue_client(function_app.COST_DATA_QUEUE)
+        try:
+            queue_client.create_queue()
+        except ResourceExistsError:
+            pass
+        for blob_name, _, _, size in case["parts"]:
+            queue_client.send_message(event_message(blob_name, size))
+
+    timer = StageTimer()
+    timer.wrap(common.BlobRangeReader, "readinto", "download")
+    timer.wrap(focus.ParquetOutputWriter, "_write_row_group", "encode")
+    timer.wrap(common.S3MultipartUpload, "_submit_part", "upload")
+    timer.wrap(common.S3MultipartUpload, "close", "upload")
+    timer.wrap(BlobClient, "delete_blob", "delete")
+    timer.wrap(ContainerClient, "delete_blobs", "delete")
+
+    start = time.perf_counter()
+    if case["mode"] == "batch":
+        function_app.cost_export_batch_processor(None)
+    else:
+        messages = [func.QueueMessage(body=event_message(blob_name, size).encode("utf-8")) for blob_name, _, _, size in case["parts"]]
+        with ThreadPoolExecutor(max_workers=case["concurrency"]) as executor:
+            list(executor.map(function_app.cost_export_processor, messages))
+    total_seconds = time.perf_counter() - start
+
+    s3_client = common.getS3Client()
+    output_bytes = 0
+    output_objects = 0
+    for page in s3_client.get_paginator("list_objects_v2").paginate(Bucket=BUCKET_NAME, Prefix=f"{case['run_id']}/"):
+        for item in page.get("Contents", []):
+            output_bytes += item["Size"]
+            output_objects += 1
+
+    stages = dict(timer.totals)
+    stages["decode_transform"] = max(total_seconds - sum(stages.values()), 0.0)
+    rows = sum(part[2] for part in case["parts"])
+    source_bytes = sum(part[3] for part in case["parts"])
+    return {
+        "total_seconds": total_seconds,
+        "import_seconds": import_seconds,
+        "rows_per_second": rows / total_seconds,
+        "source_mb_per_second": source_bytes / total_seconds / 1e6,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "source_bytes": source_bytes,
+        "output_bytes": output_bytes,
+        "output_objects": output_objects,
+        "stage_seconds": {stage: round(seconds, 4) for stage, seconds in sorted(stages.items())},
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True, cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def start_moto_server():
+    """Start moto's S3 server in this process and return its endpoint"""
+    from moto.server import ThreadedMotoServer
+    server = ThreadedMotoServer(ip_address="127.0.0.1", port=0)
+    server.start()
+    host, port = server.get_host_and_port()
+    return server, f"http://{host}:{port}"
+
+def case_key(result):
+    return (result["mode"], result["rows_per_file"], result["files"], result["extra_columns"], result["concurrency"])
+
+def print_comparison(results, baseline_path):
+    """Print the change in throughput and peak RSS against the mean of matching cases in a baseline file"""
+    baseline = defaultdict(list)
+    with open(baseline_path) as f:
+        for line in f:
+            if line.strip():
+                result = json.loads(line)
+                baseline[case_key(result)].append(result)
+
+    print(f"\nCompared with {baseline_path}:")
+    for result in results:
+        previous = baseline.get(case_key(result))
+        if not previous:
+            continue
+        previous_rate = sum(r["rows_per_second"] for r in previous) / len(previous)
+        previous_rss = sum(r["peak_rss_mb"] for r in previous) / len(previous)
+        print(f"{result['mode']:<8} rows/s {(result['rows_per_second'] / previous_rate - 1) * 100:+7.1f}%   peak RSS {(result['peak_rss_mb'] / previous_rss - 1) * 100:+7.1f}%")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200000, help="Rows per export part")
+    parser.add_argument("--files", type=int, default=4, help="Number of export parts")
+    parser.add_argument("--extra-columns", type=int, default=20, help="Number of extra x_ columns, which the processor drops")
+    parser.add_argument("--mode", nargs="+", choices=("message", "batch"), default=["message"], help="Run one message per part through CostExportProcessor, or drain the queue with CostExportBatchProcessor")
+    parser.add_argument("--concurrency", type=int, default=1, help="Messages processed at once in message mode")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per case")
+    parser.add_argument("--setting", action="append", default=[], metavar="NAME=VALUE", help="Function app setting for the run, e.g. PARQUET_COMPRESSION=zstd (repeatable)")
+    parser.add_argument("--storage-connection-string", default=AZURITE_CONNECTION_STRING, help="Blob and queue storage; defaults to Azurite")
+    parser.add_argument("--s3-endpoint", help="S3 endpoint, e.g. MinIO at http://127.0.0.1:9000; defaults to an in-process moto server")
+    parser.add_argument("--s3-access-key", default="benchmark")
+    parser.add_argument("--s3-secret-key", default="benchmark")
+    parser.add_argument("--output", help="Append results to this JSON lines file")
+    parser.add_argument("--compare", help="Compare results with an earlier JSON lines file")
+    args = parser.parse_args()
+
+    settings = dict(setting.split("=", 1) for setting in args.setting)
+    server = None
+    s3_endpoint = args.s3_endpoint
+    if s3_endpoint is None:
+        server, s3_endpoint = start_moto_server()
+
+    import boto3
+    s3_client = boto3.client("s3", endpoint_url=s3_endpoint, aws_access_key_id=args.s3_access_key, aws_secret_access_key=args.s3_secret_key, region_name="eu-west-2")
+    try:
+        s3_client.create_bucket(Bucket=BUCKET_NAME, CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+    except (s3_client.exceptions.BucketAlreadyOwnedByYou, s3_client.exceptions.BucketAlreadyExists):
+        pass
+
+    results = []
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            generate_start = time.perf_counter()
+            parts = generate_parts(directory, args.rows, args.files, args.extra_columns)
+            print(f"Generated {args.files} parts of {args.rows} rows ({sum(p[3] for p in parts) / 1e6:.1f} MB) in {time.perf_counter() - generate_start:.1f}s")
+
+            print(f"{'mode':<8} {'run':>3} {'rows/s':>10} {'MB/s':>7} {'peak RSS MB':>12} {'total s':>8}  stages")
+            for mode in args.mode:
+                for run in range(args.repeat):
+                    case = {
+                        "mode": mode,
+                        "parts": parts,
+                        "concurrency": args.concurrency,
+                        "settings": settings,
+                        "run_id": uuid.uuid4().hex,
+                        "storage_connection_string": args.storage_connection_string,
+                        "s3_endpoint": s3_endpoint,
+                        "s3_access_key": args.s3_access_key,
+                        "s3_secret_key": args.s3_secret_key,
+                    }
+                    # A fresh process per run, so peak RSS and import time are per case
+                    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                        measured = executor.submit(run_case, case).result()
+
+                    result = {
+                        "timestamp": datetime.now(timezone.utc).isoformat(),
+                        "commit": git_commit(),
+                        "python": platform.python_version(),
+                        "pyarrow": pa.__version__,
+                        "mode": mode,
+                        "run": run,
+                        "rows_per_file": args.rows,
+                        "files": args.files,
+                        "extra_columns": args.extra_columns,
+                        "concurrency": args.concurrency,
+                        "settings": settings,
+                        **measured,
+                    }
+                    results.append(result)
+                    stages = " ".join(f"{stage}={seconds:.2f}" for stage, seconds in result["stage_seconds"].items())
+                    print(f"{mode:<8} {run:>3} {result['rows_per_second']:>10.0f} {result['source_mb_per_second']:>7.1f} {result['peak_rss_mb']:>12.0f} {result['total_seconds']:>8.2f}  {stages}")
+    finally:
+        if server is not None:
+            server.stop()
+
+    if args.output:
+        with open(args.output, "a") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+    if args.compare:
+        print_comparison(results, args.compare)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+"""Cold start import time benchmark for the function app
+
+Imports function_app in a fresh interpreter, as a new Flex Consumption instance
+does when it indexes the functions, and reports the wall time, the cumulative
+time from python -X importtime and the slowest modules. The dependencies each
+function loads on its first invocation are measured the same way, on top of
+function_app.
+
+Exits with status 1 if importing function_app loads one of the heavy
+dependencies that should only be imported on first use (pyarrow, boto3,
+azure.storage and the others in LAZY_MODULES, or any of their submodules), or
+takes longer than --max-ms, so it can be run as a check in CI. --check only
+runs that import check, in a single fresh interpreter.
+
+Usage: python benchmarks/import_time_benchmark.py [--repeat 5] [--top 15] [--max-ms 1500]
+       python benchmarks/import_time_benchmark.py --check
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src", "cost_export"))
+
+# Required settings, so Config can be read if something touches it at import time
+ENVIRONMENT = {
+    "ENTRA_APP_CLIENT_ID": "00000000-0000-0000-0000-000000000000",
+    "ENTRA_APP_URN": "api://benchmark",
+    "AWS_ROLE_ARN": "arn:aws:iam::000000000000:role/benchmark",
+    "AWS_REGION": "eu-west-2",
+    "S3_FOCUS_PATH": "s3://benchmark/focus/",
+    "S3_UTILIZATION_PATH": "s3://benchmark/utilization/",
+    "S3_RECOMMENDATIONS_PATH": "s3://benchmark/recommendations/",
+    "S3_CARBON_PATH": "s3://benchmark/carbon/",
+    "CARBON_DIRECTORY_NAME": "carbon",
+    "STORAGE_CONNECTION_STRING": "UseDevelopmentStorage=true",
+    "CONTAINER_NAME": "benchmark",
+}
+
+# Packages that must not be loaded, nor any of their submodules, just by importing function_app
+LAZY_MODULES = ["pyarrow", "boto3", "botocore", "requests", "azure.identity", "azure.storage", "focus", "compaction"]
+
+# What each kind of function imports on its first invocation, on top of function_app
+FIRST_USE = {
+    "CostExportProcessor": ["pyarrow.parquet", "focus", "azure.storage.blob", "azure.identity", "boto3", "pyarrow.fs"],
+    "FocusPartitionCompactor": ["compaction", "azure.identity", "boto3", "pyarrow.fs"],
+    "AdvisorRecommendationsExporter": ["requests", "azure.identity", "azure.storage.blob", "boto3", "pyarrow.fs"],
+}
+
+MEASURE = """
+import json, sys, time
+start = time.perf_counter()
+import function_app
+function_app_ms = (time.perf_counter() - start) * 1000
+loaded = [lazy for lazy in {lazy!r} if any(name == lazy or name.startswith(lazy + ".") for name in sys.modules)]
+start = time.perf_counter()
+for name in {first_use!r}:
+    __import__(name)
+first_use_ms = (time.perf_counter() - start) * 1000
+print(json.dumps([function_app_ms, first_use_ms, loaded]))
+"""
+
+def measure(first_use):
+    """Import function_app then first_use in a fresh interpreter
+
+    Returns (function_app ms, first use ms, lazy modules loaded, importtime lines).
+    """
+    env = dict(os.environ, **ENVIRONMENT)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [SRC_DIR, env.get("PYTHONPATH")]))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", MEASURE.format(first_use=first_use, lazy=LAZY_MODULES)],
+        env=env, cwd=SRC_DIR, capture_output=True, text=True, check=True
+    )
+    function_app_ms, first_use_ms, loaded = json.loads(result.stdout.strip().splitlines()[-1])
+    return function_app_ms, first_use_ms, loaded, result.stderr.splitlines()
+
+def parse_importtime(lines):
+    """Parse -X importtime output into (module, self us, cumulative us) tuples"""
+    modules = []
+    for line in lines:
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        modules.append((name.strip(), int(self_us), int(cumulative_us)))
+    return modules
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters per measurement; the median is reported")
+    parser.add_argument("--top", type=int, default=15, help="Number of slowest modules to list")
+    parser.add_argument("--max-ms", type=float, help="Fail if importing function_app takes longer than this (median wall time)")
+    parser.add_argument("--check", action="store_true", help="Only check that importing function_app loads none of LAZY_MODULES")
+    args = parser.parse_args()
+
+    if args.check:
+        loaded = measure([])[2]
+        if loaded:
+            print(f"FAIL: importing function_app loaded {', '.join(loaded)}, which should only be imported on first use")
+            sys.exit(1)
+        print(f"OK: importing function_app loaded none of {', '.join(LAZY_MODULES)}")
+        return
+
+    # Warm the bytecode cache so the first run does not pay for compiling
+    measure([])
+
+    runs = [measure([]) for _ in range(args.repeat)]
+    function_app_ms = statistics.median(run[0] for run in runs)
+    loaded = runs[0][2]
+    modules = parse_importtime(runs[0][3])
+    function_app_module = next((m for m in modules if m[0] == "function_app"), None)
+
+    print(f"import function_app: {function_app_ms:.1f} ms wall (median of {args.repeat})", end="")
+    if function_app_module:
+        print(f", {function_app_module[2] / 1000:.1f} ms cumulative importtime")
+    else:
+        print()
+
+    print("\nSlowest modules by self time:")
+    print(f"{'module':<50} {'self ms':>9} {'cumulative ms':>14}")
+    for name, self_us, cumulative_us in sorted(modules, key=lambda m: m[1], reverse=True)[:args.top]:
+        print(f"{name:<50} {self_us / 1000:>9.1f} {cumulative_us / 1000:>14.1f}")
+
+    print(f"\n{'first invocation':<34} {'extra import ms':>16}")
+    for function, first_use in FIRST_USE.items():
+        first_use_ms = statistics.median(measure(first_use)[1] for _ in range(args.repeat))
+        print(f"{function:<34} {first_use_ms:>16.1f}")
+
+    failed = False
+    if loaded:
+        print(f"\nFAIL: importing function_app loaded {', '.join(loaded)}, which should only be imported on first use")
+        failed = True
+    if args.max_ms is not None and function_app_ms > args.max_ms:
+        print(f"\nFAIL: importing function_app took {function_app_ms:.1f} ms, over the {args.max_ms:.0f} ms budget")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Microbenchmark for the blob path to S3 key mapping engine
+
+Generates realistic daily and backfill cost export blob names and reports the
+per-path cost of map_blob_path (with a cold and a warm segment cache) and the
+throughput of the map_blob_paths batch API, against a baseline of one
+map_blob_path call per path, which is what the batch API did before it shared
+work between paths in the same directory. The batch results are checked
+against the baseline's.
+
+Usage: python benchmarks/path_mapping_benchmark.py [--count 100000]
+"""
+import argparse
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "cost_export"))
+
+import path_mapping  # noqa: E402
+
+BILLING_ACCOUNT_MAPPING = {"0": "bdfa614c-3bed-5e6d-313b-b4bfa3cefe1d:16e4ddda-0100-468b-a32c-abbfc29019d8_2019-05-31"}
+
+def daily_paths(count):
+    """Daily exports: one run per day, a handful of part files per run"""
+    paths = []
+    for i in range(count):
+        day = i // 8 % 28 + 1
+        run_id = uuid.UUID(int=i // 8)
+        paths.append(
+            f"gds-focus-v1/focus-daily-cost-export-0/20250801-20250831/202508{day:02d}0632/{run_id}/part_{i % 8}_0001.parquet"
+        )
+    return paths
+
+def backfill_paths(count):
+    """Backfill exports: one export per month, many part files per run, billing account in the path"""
+    paths = []
+    for i in range(count):
+        month = i // 64 % 12 + 1
+        run_id = uuid.UUID(int=i // 64)
+        paths.append(
+            f"gds-focus-v1/focus-backfill-0-2024-{month:02d}/2024{month:02d}01-2024{month:02d}28/202501150312/{run_id}"
+            f"/providers/Microsoft.Billing/billingAccounts/bdfa614c:16e4ddda_2019-05-31/billingProfiles/OC35-AR3W-BG7-PGB/part_{i % 64}_0001.parquet"
+        )
+    return paths
+
+def clear_caches():
+    for cached in (path_mapping.classify_segment, path_mapping._is_timestamp, path_mapping._is_uuid, path_mapping._export_index):
+        cached.cache_clear()
+
+def time_single(paths):
+    start = time.perf_counter()
+    for path in paths:
+        path_mapping.map_blob_path(path, billing_account_mapping=BILLING_ACCOUNT_MAPPING)
+    return time.perf_counter() - start
+
+def baseline_batch(paths):
+    """The batch API as one map_blob_path call per path"""
+    return [(path,) + path_mapping.map_blob_path(path, billing_account_mapping=BILLING_ACCOUNT_MAPPING) for path in paths]
+
+def time_batch(paths, map_paths):
+    start = time.perf_counter()
+    mapped = map_paths(paths)
+    return time.perf_counter() - start, mapped
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--count", type=int, default=100000, help="Number of blob names per shape")
+    args = parser.parse_args()
+
+    print(f"{'shape':<10} {'mode':<15} {'paths':>8} {'total s':>9} {'us/path':>9} {'paths/s':>11} {'vs baseline':>12}")
+    for shape, generate in (("daily", daily_paths), ("backfill", backfill_paths)):
+        paths = generate(args.count)
+
+        clear_caches()
+        cold = time_single(paths)
+        warm = time_single(paths)
+        baseline, expected = time_batch(paths, baseline_batch)
+        batch, mapped = time_batch(paths, lambda p: path_mapping.map_blob_paths(p, billing_account_mapping=BILLING_ACCOUNT_MAPPING))
+        if mapped != expected:
+            sys.exit(f"map_blob_paths returned different keys from map_blob_path for the {shape} paths")
+
+        for mode, elapsed in (("single-cold", cold), ("single-warm", warm), ("batch-baseline", baseline), ("batch", batch)):
+            print(f"{shape:<10} {mode:<15} {len(paths):>8} {elapsed:>9.3f} {elapsed / len(paths) * 1e6:>9.2f} {len(paths) / elapsed:>11.0f} {baseline / elapsed:>11.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -79,6 +79,27 @@ resource "azurerm_function_app_flex_consumption" "cost_export" {
     "BILLING_SCOPE" = "/providers/Microsoft.Management/managementGroups/${data.azurerm_client_config.current.tenant_id}"
     # Mapping of billing account index to billing account ID for S3 path organization
     "BILLING_ACCOUNT_MAPPING" = jsonencode({ for idx, account in local.billing_accounts_map : idx => account.id })
+    # In batch mode the queue is drained by CostExportBatchProcessor instead of CostExportProcessor
+    "COST_EXPORT_BATCH_MODE"                    = tostring(var.cost_export_batch_mode)
+    "AzureWebJobs.CostExportProcessor.Disabled" = tostring(var.cost_export_batch_mode)
+    # Parquet output profile for the FOCUS files written to S3
+    "PARQUET_COMPRESSION"        = var.parquet_compression
+    "PARQUET_COMPRESSION_LEVEL"  = var.parquet_compression_level == null ? "" : tostring(var.parquet_compression_level)
+    "PARQUET_ROW_GROUP_ROWS"     = var.parquet_row_group_rows == null ? "" : tostring(var.parquet_row_group_rows)
+    "PARQUET_DICTIONARY_COLUMNS" = join(",", var.parquet_dictionary_columns)
+    "PARQUET_SORT_COLUMNS"       = join(",", var.parquet_sort_columns)
+    "PARQUET_WRITE_PAGE_INDEX"   = tostring(var.parquet_write_page_index)
+    # Write only the changed charge days of the daily MonthToDate export
+    "FOCUS_INCREMENTAL_MODE" = tostring(var.focus_incremental_mode)
+    # Compact closed billing_period partitions in S3
+    "S3_COMPACTION_ENABLED" = tostring(var.enable_s3_compaction)
+    # Per-stage timings and counters
+    "METRICS_MODE" = var.metrics_mode
+    # Source of the Advisor recommendations (per-subscription API calls or Resource Graph)
+    "ADVISOR_ENGINE" = var.advisor_engine
+    # Output formats of the Advisor and Carbon exports
+    "RECOMMENDATIONS_OUTPUT_FORMAT" = join(",", var.recommendations_output_format)
+    "CARBON_OUTPUT_FORMAT"          = join(",", var.carbon_output_format)
   }
 }
 
@@ -66,4 +66,9 @@ resource "azurerm_role_assignment" "advisor_reader" {
   scope                = "/providers/Microsoft.Management/managementGroups/${data.azurerm_client_config.current.tenant_id}"
   role_definition_name = "Reader"
   principal_id         = azurerm_function_app_flex_consumption.cost_export.identity[0].principal_id
-}
\ No newline at end of file
+}
+resource "azurerm_role_assignment" "monitoring_reader" {
+  scope                = "/providers/Microsoft.Management/managementGroups/${data.azurerm_client_config.current.tenant_id}"
+  role_definition_name = "Monitoring Reader"
+  principal_id         = azurerm_function_app_flex_consumption.cost_export.identity[0].principal_id
+}
@@ -0,0 +1,96 @@
+import logging
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+from common import Config, send_arm_request
+
+CARBON_API_PATH = "/providers/Microsoft.Carbon/carbonEmissionReports"
+CARBON_API_VERSION = "2025-04-01"
+
+# Emission values that are additive across subscriptions
+ADDITIVE_FIELDS = ("latestMonthEmissions", "previousMonthEmissions", "monthlyEmissionsChangeValue")
+
+def chunk_list(values, chunk_size):
+    """Split a list into consecutive chunks of at most chunk_size items"""
+    return [values[i:i + chunk_size] for i in range(0, len(values), chunk_size)]
+
+def request_monthly_summary_report(subscription_ids, month_str):
+    """Request a MonthlySummaryReport for a single chunk of subscriptions"""
+    request_data = {
+        "reportType": "MonthlySummaryReport",
+        "subscriptionList": subscription_ids,
+        "carbonScopeList": ["Scope1", "Scope3"],
+        "dateRange": {
+            "start": month_str,
+            "end": month_str
+        }
+    }
+
+    response = send_arm_request(
+        "POST",
+        f"{Config.arm_endpoint}{CARBON_API_PATH}?api-version={CARBON_API_VERSION}",
+        json=request_data,
+        timeout=300
+    )
+
+    if response.status_code != 200:
+        raise RuntimeError(f"Carbon API request failed for {month_str} ({len(subscription_ids)} subscriptions): {response.status_code} - {response.text}")
+
+    return response.json()
+
+def _record_order(record):
+    return (record.get("date") or "", record.get("dataType") or "")
+
+def merge_monthly_summary_reports(reports):
+    """Merge MonthlySummaryReport responses for disjoint subscription chunks into one report
+
+    Emission totals are summed per date. The change ratio is recomputed from the
+    summed totals, and carbon intensity is re-weighted by the emissions behind
+    each chunk's intensity, so the result matches a single unchunked request.
+    Records are sorted by date and data type, however many chunks there were.
+    """
+    if len(reports) == 1:
+        return {"value": sorted(reports[0].get("value", []), key=_record_order)}
+
+    merged = {}
+    intensity_denominators = defaultdict(float)
+
+    for report in reports:
+        for record in report.get("value", []):
+            key = (record.get("dataType"), record.get("date"))
+            if key not in merged:
+                merged[key] = dict(record)
+                for field in ADDITIVE_FIELDS:
+                    merged[key][field] = 0.0
+
+            for field in ADDITIVE_FIELDS:
+                merged[key][field] += record.get(field) or 0.0
+
+            # carbonIntensity is emissions per unit of usage, so recover the usage behind it.
+            # A chunk with zero emissions reports zero intensity and contributes no usage.
+            intensity = record.get("carbonIntensity") or 0.0
+            if intensity:
+                intensity_denominators[key] += (record.get("latestMonthEmissions") or 0.0) / intensity
+
+    for key, record in merged.items():
+        previous = record["previousMonthEmissions"]
+        record["monthOverMonthEmissionsChangeRatio"] = (record["latestMonthEmissions"] - previous) / previous if previous else 0.0
+        denominator = intensity_denominators[key]
+        record["carbonIntensity"] = record["latestMonthEmissions"] / denominator if denominator else 0.0
+
+    return {"value": sorted(merged.values(), key=_record_order)}
+
+def fetch_monthly_summary_report(subscription_ids, month_str):
+    """Fetch a MonthlySummaryReport for all subscriptions, split into concurrent chunked requests
+
+    Chunk size and concurrency are set by CARBON_SUBSCRIPTION_CHUNK_SIZE and
+    CARBON_MAX_CONCURRENCY. Any failed chunk fails the whole report, since
+    partial totals would be wrong.
+    """
+    chunks = chunk_list(subscription_ids, Config.carbon_subscription_chunk_size) or [[]]
+    logging.info(f"Requesting carbon report for {month_str} with {len(subscription_ids)} subscriptions in {len(chunks)} chunk(s)")
+
+    with ThreadPoolExecutor(max_workers=min(Config.carbon_max_concurrency, len(chunks))) as executor:
+        reports = list(executor.map(metrics.bind(lambda chunk: request_monthly_summary_report(chunk, month_str)), chunks))
+
+    return merge_monthly_summary_reports(reports)
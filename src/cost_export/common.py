@@ -1,11 +1,20 @@
 import os
-import boto3
+import io
+import zlib
+import base64
 import logging
-import requests
-import uuid
 import json
-from pyarrow.fs import S3FileSystem
-from azure.identity import ManagedIdentityCredential
+import random
+import re
+import threading
+import time
+import metrics
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timezone, timedelta
+from urllib.parse import urlsplit
+
+# The Azure SDK, boto3, requests and pyarrow are imported by the first call that
+# needs them, so importing the function app on a new instance stays cheap
 
 def _get_required_env(name):
     value = os.environ.get(name)
@@ -13,83 +22,786 @@ def _get_required_env(name):
         raise EnvironmentError(f"Missing required environment variable: {name}")
     return value
 
-def is_uuid(value):
-    """Check if a string is a valid UUID"""
+class _setting:
+    """A Config attribute computed from the environment on first access and then cached"""
+
+    def __init__(self, load):
+        self._load = load
+
+    def __set_name__(self, owner, name):
+        self._name = name
+
+    def __get__(self, instance, owner):
+        value = self._load()
+        # Replace the descriptor with the value so later reads are plain attribute lookups
+        setattr(owner, self._name, value)
+        return value
+
+def _billing_account_mapping():
+    mapping_json = os.environ.get("BILLING_ACCOUNT_MAPPING", "{}")
     try:
-        uuid.UUID(value)
-        return True
+        return json.loads(mapping_json)
     except ValueError:
-        return False
-
-class Config:    
-    client_id = _get_required_env("ENTRA_APP_CLIENT_ID")  # Example: "00000000-0000-0000-0000-000000000000"
-    urn = _get_required_env("ENTRA_APP_URN")  # Example: "api://AWS-Federation-App"
-    arn = _get_required_env("AWS_ROLE_ARN")  # Example: "arn:aws:iam::000000000000:role/aad_s3"
-    s3_focus_path = _get_required_env("S3_FOCUS_PATH")  # Example: "s3://s3bucketname/test/"
-    aws_region = _get_required_env("AWS_REGION")  # Example: "eu-west-2"
-    storage_connection_string = _get_required_env("STORAGE_CONNECTION_STRING")
-    container_name = _get_required_env("CONTAINER_NAME")
-    s3_utilization_path = _get_required_env("S3_UTILIZATION_PATH")
-    s3_recommendations_path = _get_required_env("S3_RECOMMENDATIONS_PATH")
-    s3_carbon_path = _get_required_env("S3_CARBON_PATH")
-    carbon_directory_name = _get_required_env("CARBON_DIRECTORY_NAME")
+        logging.warning(f"Failed to parse BILLING_ACCOUNT_MAPPING: {mapping_json}")
+        return {}
+
+class Config:
+    """Function app settings, each read from the environment and validated on first access
+
+    Functions only pay for, and only fail on, the settings they use.
+    """
+    client_id = _setting(lambda: _get_required_env("ENTRA_APP_CLIENT_ID"))  # Example: "00000000-0000-0000-0000-000000000000"
+    urn = _setting(lambda: _get_required_env("ENTRA_APP_URN"))  # Example: "api://AWS-Federation-App"
+    arn = _setting(lambda: _get_required_env("AWS_ROLE_ARN"))  # Example: "arn:aws:iam::000000000000:role/aad_s3"
+    s3_focus_path = _setting(lambda: _get_required_env("S3_FOCUS_PATH"))  # Example: "s3://s3bucketname/test/"
+    aws_region = _setting(lambda: _get_required_env("AWS_REGION"))  # Example: "eu-west-2"
+    storage_connection_string = _setting(lambda: _get_required_env("STORAGE_CONNECTION_STRING"))
+    container_name = _setting(lambda: _get_required_env("CONTAINER_NAME"))
+    s3_utilization_path = _setting(lambda: _get_required_env("S3_UTILIZATION_PATH"))
+    s3_recommendations_path = _setting(lambda: _get_required_env("S3_RECOMMENDATIONS_PATH"))
+    s3_carbon_path = _setting(lambda: _get_required_env("S3_CARBON_PATH"))
+    carbon_directory_name = _setting(lambda: _get_required_env("CARBON_DIRECTORY_NAME"))
+
+    # Azure Resource Manager and Azure Monitor metrics endpoints, overridable to point at a local stand-in
+    arm_endpoint = _setting(lambda: os.environ.get("ARM_ENDPOINT", "https://management.azure.com").rstrip("/"))
+    monitor_metrics_endpoint = _setting(lambda: os.environ.get("MONITOR_METRICS_ENDPOINT", "https://{location}.metrics.monitor.azure.com").rstrip("/"))  # {location} is the resource region
 
     # Carbon Optimization API settings
-    carbon_tenant_id = os.environ.get("CARBON_API_TENANT_ID")
-    billing_scope = os.environ.get("BILLING_SCOPE")
+    carbon_tenant_id = _setting(lambda: os.environ.get("CARBON_API_TENANT_ID"))
+    billing_scope = _setting(lambda: os.environ.get("BILLING_SCOPE"))
+
+    # How long discovered subscriptions are reused before the billing scope is enumerated again
+    subscription_cache_ttl_hours = _setting(lambda: float(os.environ.get("SUBSCRIPTION_CACHE_TTL_HOURS", "24")))
+
+    # Where the Advisor exporter reads recommendations: "api" (the Advisor API, once per subscription)
+    # or "resource_graph" (paged queries of the Resource Graph advisorresources table)
+    advisor_engine = _setting(lambda: os.environ.get("ADVISOR_ENGINE", "api").lower())
+
+    # Maximum number of subscriptions queried concurrently by the Advisor exporter
+    advisor_max_concurrency = _setting(lambda: int(os.environ.get("ADVISOR_MAX_CONCURRENCY", "16")))
+
+    # Subscriptions per Carbon API request, and how many chunked requests run at once
+    carbon_subscription_chunk_size = _setting(lambda: int(os.environ.get("CARBON_SUBSCRIPTION_CHUNK_SIZE", "100")))
+    carbon_max_concurrency = _setting(lambda: int(os.environ.get("CARBON_MAX_CONCURRENCY", "4")))
+
+    # Day of the following month from which a month's emissions are final. Months already in S3
+    # and written after that are not requested again, unless CARBON_FORCE_EXPORT is set
+    carbon_data_final_day = _setting(lambda: int(os.environ.get("CARBON_DATA_FINAL_DAY", "20")))
+    carbon_force_export = _setting(lambda: os.environ.get("CARBON_FORCE_EXPORT", "false").lower() == "true")
+
+    # Pacing of ARM requests per host and resource provider: sustained rate, burst, and the
+    # remaining quota (from x-ms-ratelimit-remaining-* headers) below which the rate is slowed
+    arm_requests_per_second = _setting(lambda: float(os.environ.get("ARM_REQUESTS_PER_SECOND", "20")))
+    arm_burst = _setting(lambda: int(os.environ.get("ARM_BURST", "40")))
+    arm_quota_low_watermark = _setting(lambda: int(os.environ.get("ARM_QUOTA_LOW_WATERMARK", "100")))
+
+    # Formats the Advisor and Carbon exports are written in: "json", "parquet" or both, comma-separated
+    recommendations_output_formats = _setting(lambda: [f.strip().lower() for f in os.environ.get("RECOMMENDATIONS_OUTPUT_FORMAT", "json").split(",") if f.strip()])
+    carbon_output_formats = _setting(lambda: [f.strip().lower() for f in os.environ.get("CARBON_OUTPUT_FORMAT", "json").split(",") if f.strip()])
+
+    # Number of rows decoded and written per record batch when streaming parquet files
+    parquet_batch_size = _setting(lambda: int(os.environ.get("PARQUET_BATCH_SIZE", "65536")))
+
+    # Read all of a row group's kept column chunks in a few coalesced ranged reads before decoding.
+    # Fewer blob requests, but each file holds a whole row group of those columns in memory
+    parquet_pre_buffer = _setting(lambda: os.environ.get("PARQUET_PRE_BUFFER", "false").lower() == "true")
+
+    # Multipart uploads to S3: part size in bytes (at least 5 MiB) and parts uploaded concurrently per object
+    s3_upload_part_size = _setting(lambda: max(int(os.environ.get("S3_UPLOAD_PART_SIZE", str(16 * 1024 * 1024))), 5 * 1024 * 1024))
+    s3_upload_concurrency = _setting(lambda: int(os.environ.get("S3_UPLOAD_CONCURRENCY", "8")))
+
+    # Utilization exporter: metric time grain, aggregations, resources per batch metrics request (at most 50) and concurrent requests
+    utilization_interval = _setting(lambda: os.environ.get("UTILIZATION_INTERVAL", "PT1H"))
+    utilization_aggregations = _setting(lambda: [a.strip() for a in os.environ.get("UTILIZATION_AGGREGATIONS", "average,maximum").split(",") if a.strip()])
+    utilization_batch_size = _setting(lambda: min(int(os.environ.get("UTILIZATION_BATCH_SIZE", "50")), 50))
+    utilization_max_concurrency = _setting(lambda: int(os.environ.get("UTILIZATION_MAX_CONCURRENCY", "8")))
+
+    # Parquet output profile for files written to S3_FOCUS_PATH. Unset values keep pyarrow's defaults
+    parquet_compression = _setting(lambda: os.environ.get("PARQUET_COMPRESSION", "snappy"))
+    parquet_compression_level = _setting(lambda: int(os.environ["PARQUET_COMPRESSION_LEVEL"]) if os.environ.get("PARQUET_COMPRESSION_LEVEL") else None)
+    parquet_row_group_rows = _setting(lambda: int(os.environ.get("PARQUET_ROW_GROUP_ROWS", "0")) or None)
+    parquet_dictionary_columns = _setting(lambda: [c.strip() for c in os.environ["PARQUET_DICTIONARY_COLUMNS"].split(",") if c.strip()] if os.environ.get("PARQUET_DICTIONARY_COLUMNS") else None)
+    parquet_sort_columns = _setting(lambda: [c.strip() for c in os.environ.get("PARQUET_SORT_COLUMNS", "").split(",") if c.strip()])
+    parquet_write_statistics = _setting(lambda: os.environ.get("PARQUET_WRITE_STATISTICS", "true").lower() == "true")
+    parquet_write_page_index = _setting(lambda: os.environ.get("PARQUET_WRITE_PAGE_INDEX", "false").lower() == "true")
+
+    # Per-stage timings and counters: off, log or otel (see metrics.py)
+    metrics_mode = _setting(lambda: os.environ.get("METRICS_MODE", "off"))
+
+    # Batch mode: drain the cost data queue on a timer and coalesce parts into larger S3 objects
+    cost_export_batch_mode = _setting(lambda: os.environ.get("COST_EXPORT_BATCH_MODE", "false").lower() == "true")
+    batch_max_messages = _setting(lambda: int(os.environ.get("BATCH_MAX_MESSAGES", "256")))
+    batch_max_runtime_minutes = _setting(lambda: float(os.environ.get("BATCH_MAX_RUNTIME_MINUTES", "20")))
+    coalesce_target_bytes = _setting(lambda: int(os.environ.get("COALESCE_TARGET_BYTES", str(256 * 1024 * 1024))))
+
+    # Incremental mode: write only the charge days of the daily MonthToDate export that changed
+    focus_incremental_mode = _setting(lambda: os.environ.get("FOCUS_INCREMENTAL_MODE", "false").lower() == "true")
+
+    # Compaction of closed billing_period partitions in S3_FOCUS_PATH
+    s3_compaction_enabled = _setting(lambda: os.environ.get("S3_COMPACTION_ENABLED", "false").lower() == "true")
+    compaction_min_age_days = _setting(lambda: int(os.environ.get("COMPACTION_MIN_AGE_DAYS", "7")))  # Days after the billing period ends
+    compaction_target_bytes = _setting(lambda: int(os.environ.get("COMPACTION_TARGET_BYTES", str(256 * 1024 * 1024))))
+    compaction_row_group_rows = _setting(lambda: int(os.environ.get("COMPACTION_ROW_GROUP_ROWS", "500000")))
+    compaction_max_runtime_minutes = _setting(lambda: float(os.environ.get("COMPACTION_MAX_RUNTIME_MINUTES", "20")))
     
     # Billing account mapping for S3 path organization
-    _billing_account_mapping_json = os.environ.get("BILLING_ACCOUNT_MAPPING", "{}")
+    billing_account_mapping = _setting(_billing_account_mapping)
+
+class BlobRangeReader(io.RawIOBase):
+    """Seekable, read-only file object over a blob that fetches bytes with ranged reads
+
+    Lets pyarrow read the parquet footer and only the column chunks it needs
+    instead of downloading the whole blob.
+    """
+
+    def __init__(self, blob_client, size=None):
+        self._blob_client = blob_client
+        self._size = size if size is not None else blob_client.get_blob_properties().size
+        self._position = 0
+        self.bytes_read = 0
+        self.range_requests = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def size(self):
+        return self._size
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self._size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position: {position}")
+        self._position = position
+        return self._position
+
+    def readinto(self, buffer):
+        length = min(len(buffer), self._size - self._position)
+        if length <= 0:
+            return 0
+        with metrics.span("blob_download"):
+            data = self._blob_client.download_blob(offset=self._position, length=length).readall()
+        metrics.count("bytes_in", len(data))
+        buffer[:len(data)] = data
+        self._position += len(data)
+        self.bytes_read += len(data)
+        self.range_requests += 1
+        return len(data)
+
+class AzureClients:
+    """Lazily-initialised registry of Azure clients shared by every function in the worker
+
+    Reusing one credential, one BlobServiceClient and one requests session keeps
+    the HTTP connection pools (and their TLS sessions) warm between invocations.
+    Tokens are cached until shortly before they expire.
+    """
+
+    management_scope = "https://management.azure.com/.default"
+
+    # Fetch a new token this long before the cached one expires
+    token_refresh_margin = timedelta(minutes=5)
+
+    # Maximum number of pooled connections kept open per host (ARM and the regional metrics endpoints)
+    arm_pool_size = 32
+
+    # Number of hosts whose connection pools are kept
+    arm_pool_hosts = 8
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._credential = None
+        self._blob_service_client = None
+        self._queue_clients = {}
+        self._arm_session = None
+        self._tokens = {}
+        self._token_locks = {}
+
+    def set_credential(self, credential):
+        """Use credential instead of the function app's managed identity, e.g. when running off Azure"""
+        with self._lock:
+            self._credential = credential
+            self._tokens = {}
+
+    def credential(self):
+        with self._lock:
+            if self._credential is None:
+                from azure.identity import ManagedIdentityCredential
+                self._credential = ManagedIdentityCredential()
+            return self._credential
+
+    def _token_is_fresh(self, token):
+        refresh_at = datetime.now(timezone.utc) + self.token_refresh_margin
+        return token is not None and datetime.fromtimestamp(token.expires_on, timezone.utc) > refresh_at
+
+    def get_token(self, scope):
+        """Return a cached access token string for the scope, fetching a new one near expiry
+
+        The fetch holds a lock for its scope only, so callers needing the same
+        scope wait for one fetch while other clients and scopes are not blocked.
+        """
+        credential = self.credential()
+        with self._lock:
+            token = self._tokens.get(scope)
+            if self._token_is_fresh(token):
+                return token.token
+            scope_lock = self._token_locks.setdefault(scope, threading.Lock())
+
+        with scope_lock:
+            # Another caller may have fetched the token while this one waited
+            with self._lock:
+                token = self._tokens.get(scope)
+            if not self._token_is_fresh(token):
+                token = credential.get_token(scope)
+                with self._lock:
+                    self._tokens[scope] = token
+            return token.token
+
+    def blob_service_client(self):
+        with self._lock:
+            if self._blob_service_client is None:
+                from azure.storage.blob import BlobServiceClient
+                self._blob_service_client = BlobServiceClient.from_connection_string(Config.storage_connection_string)
+            return self._blob_service_client
+
+    def container_client(self):
+        return self.blob_service_client().get_container_client(Config.container_name)
+
+    def queue_client(self, queue_name):
+        with self._lock:
+            if queue_name not in self._queue_clients:
+                from azure.storage.queue import QueueClient
+                self._queue_clients[queue_name] = QueueClient.from_connection_string(Config.storage_connection_string, queue_name)
+            return self._queue_clients[queue_name]
+
+    def arm_session(self):
+        with self._lock:
+            if self._arm_session is None:
+                import requests
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=self.arm_pool_hosts, pool_maxsize=self.arm_pool_size)
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._arm_session = session
+            return self._arm_session
+
+    def arm_headers(self, scope=None):
+        """Return request headers for ARM calls using the cached token for scope (the management scope by default)"""
+        return {
+            "Authorization": f"Bearer {self.get_token(scope or self.management_scope)}",
+            "Content-Type": "application/json"
+        }
+
+azure_clients = AzureClients()
+
+def _retry_after_seconds(response, default):
+    """Return the number of seconds a throttled response asks us to wait"""
+    retry_after = response.headers.get("Retry-After")
     try:
-        billing_account_mapping = json.loads(_billing_account_mapping_json)
-    except:
-        logging.warning(f"Failed to parse BILLING_ACCOUNT_MAPPING: {_billing_account_mapping_json}")
-        billing_account_mapping = {}
+        return max(float(retry_after), 0)
+    except (TypeError, ValueError):
+        return default
+
+def _arm_provider(url):
+    """Return the last resource provider in an ARM URL, used to label request metrics"""
+    providers = re.findall(r"/providers/([^/?]+)", url)
+    return providers[-1] if providers else "unknown"
+
+# Responses worth retrying: throttling and transient server errors
+ARM_RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+# Upper bound of the exponential backoff between retries, in seconds
+ARM_MAX_BACKOFF_SECONDS = 60
+
+def _backoff_seconds(attempt):
+    """Exponential backoff with jitter, so concurrent callers don't retry in lockstep"""
+    ceiling = min(ARM_MAX_BACKOFF_SECONDS, 2 ** (attempt + 1))
+    return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+def _quota_remaining(headers):
+    """Return the lowest remaining request quota reported by ARM response headers, or None
+
+    Covers the x-ms-ratelimit-remaining-* headers (including per-resource
+    quotas such as "Microsoft.Compute/HighCostGet3Min;159") and Resource
+    Graph's x-ms-user-quota-remaining.
+    """
+    remaining = None
+    for name, value in headers.items():
+        name = name.lower()
+        if not (name.startswith("x-ms-ratelimit-remaining-") or name == "x-ms-user-quota-remaining"):
+            continue
+        for quota in value.split(","):
+            try:
+                count = int(quota.rsplit(";", 1)[-1])
+            except ValueError:
+                continue
+            remaining = count if remaining is None else min(remaining, count)
+    return remaining
+
+class ArmRateLimiter:
+    """Token buckets pacing ARM requests, one per endpoint host and resource provider
+
+    Each bucket refills at ARM_REQUESTS_PER_SECOND up to ARM_BURST tokens. When
+    the remaining quota reported by a response drops below
+    ARM_QUOTA_LOW_WATERMARK, the refill rate is scaled down in proportion so the
+    quota is spread out instead of exhausted. A 429 pauses the whole bucket for
+    its Retry-After and halves the rate, which recovers as requests succeed.
+    """
+
+    # The refill rate never drops below this fraction of the configured rate
+    min_rate_fraction = 0.05
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def _bucket(self, key, now):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = {"tokens": float(Config.arm_burst), "rate": Config.arm_requests_per_second, "updated": now, "paused_until": 0.0}
+            self._buckets[key] = bucket
+        else:
+            bucket["tokens"] = min(Config.arm_burst, bucket["tokens"] + (now - bucket["updated"]) * bucket["rate"])
+            bucket["updated"] = now
+        return bucket
+
+    def acquire(self, key):
+        """Block until the bucket for key has a token; returns the seconds waited"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                bucket = self._bucket(key, now)
+                if now < bucket["paused_until"]:
+                    delay = bucket["paused_until"] - now
+                elif bucket["tokens"] >= 1:
+                    bucket["tokens"] -= 1
+                    return waited
+                else:
+                    delay = (1 - bucket["tokens"]) / bucket["rate"]
+            time.sleep(delay)
+            waited += delay
+
+    def observe(self, key, response, retry_after=None):
+        """Adapt the bucket for key to a response's status and remaining-quota headers"""
+        base_rate = Config.arm_requests_per_second
+        min_rate = base_rate * self.min_rate_fraction
+        remaining = _quota_remaining(response.headers)
+        with self._lock:
+            now = time.monotonic()
+            bucket = self._bucket(key, now)
+            if response.status_code == 429:
+                bucket["tokens"] = 0.0
+                bucket["rate"] = max(min_rate, bucket["rate"] / 2)
+                bucket["paused_until"] = max(bucket["paused_until"], now + (retry_after or 0))
+            elif remaining is not None and remaining < Config.arm_quota_low_watermark:
+                bucket["rate"] = max(min_rate, base_rate * remaining / Config.arm_quota_low_watermark)
+                bucket["tokens"] = min(bucket["tokens"], remaining)
+            else:
+                bucket["rate"] = min(base_rate, bucket["rate"] * 1.5)
+
+arm_rate_limiter = ArmRateLimiter()
+
+def send_arm_request(method, url, max_retries=5, scope=None, **kwargs):
+    """Send an ARM request on the shared session, paced by arm_rate_limiter and retried on throttling
+
+    429 and transient 5xx responses, connection errors and timeouts are retried
+    after the delay given in the Retry-After header (plus a little jitter), or
+    with jittered exponential backoff if the header is missing. The last
+    response is returned once max_retries is reached. scope selects the token
+    audience for APIs outside ARM, such as Azure Monitor metrics.
+    """
+    import requests
+
+    provider = _arm_provider(url)
+    limiter_key = (urlsplit(url).netloc, provider)
+    for attempt in range(max_retries + 1):
+        with metrics.span("arm_throttle", provider=provider):
+            arm_rate_limiter.acquire(limiter_key)
+        try:
+            with metrics.span("arm_request", provider=provider):
+                response = azure_clients.arm_session().request(method, url, headers=azure_clients.arm_headers(scope), **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == max_retries:
+                raise
+            metrics.count("arm_retries", provider=provider)
+            delay = _backoff_seconds(attempt)
+            logging.warning(f"ARM request to {url} failed ({type(e).__name__}), retrying in {delay:.1f} seconds (attempt {attempt + 1} of {max_retries})")
+            time.sleep(delay)
+            continue
+
+        metrics.count("arm_requests", provider=provider)
+        retry_after = _retry_after_seconds(response, default=None)
+        arm_rate_limiter.observe(limiter_key, response, retry_after)
+        if response.status_code not in ARM_RETRY_STATUS_CODES or attempt == max_retries:
+            return response
+
+        metrics.count("arm_retries", provider=provider)
+        delay = _backoff_seconds(attempt) if retry_after is None else retry_after + random.uniform(0, 1)
+        logging.warning(f"ARM request to {url} returned {response.status_code}, retrying in {delay:.1f} seconds (attempt {attempt + 1} of {max_retries})")
+        time.sleep(delay)
+
+class S3FileSystemCache:
+    """Process-wide cache of the S3FileSystem, the boto3 S3 client and the STS credentials behind them
+
+    Credentials are refreshed in a background thread once they are within the
+    refresh margin of expiring, so callers on the hot path keep using the cached
+    clients. If they have already expired, the first caller refreshes them
+    while holding the lock and concurrent callers wait for that single STS call.
+    """
+
+    # Start refreshing credentials this long before they expire
+    refresh_margin = timedelta(minutes=10)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sts_client = None
+        self._clients = None
+        self._expiration = None
+        self._refreshing = False
+
+    def get(self):
+        """Return the cached S3FileSystem"""
+        return self._current()[0]
+
+    def client(self):
+        """Return the cached boto3 S3 client"""
+        return self._current()[1]
+
+    def _current(self):
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            if self._clients is not None and now < self._expiration:
+                if now >= self._expiration - self.refresh_margin and not self._refreshing:
+                    self._refreshing = True
+                    threading.Thread(target=self._refresh_in_background, daemon=True).start()
+                return self._clients
+
+            # Missing or expired - refresh synchronously
+            self._clients, self._expiration = self._create_clients()
+            return self._clients
+
+    def _refresh_in_background(self):
+        try:
+            clients, expiration = self._create_clients()
+            with self._lock:
+                self._clients, self._expiration = clients, expiration
+            logging.info(f"Refreshed cached AWS credentials, valid until {expiration.isoformat()}")
+        except Exception as e:
+            # The cached credentials are still valid; the next caller will retry
+            logging.warning(f"Background refresh of AWS credentials failed: {str(e)}")
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+    def _create_clients(self):
+        import boto3
+        from botocore.config import Config as BotoConfig
+        from pyarrow.fs import S3FileSystem
+
+        if self._sts_client is None:
+            self._sts_client = boto3.client('sts')
+
+        token = azure_clients.get_token(Config.urn)
+
+        role = self._sts_client.assume_role_with_web_identity(
+            RoleArn=Config.arn,
+            RoleSessionName='session1',
+            WebIdentityToken=token
+            )
+
+        credentials = role['Credentials']
+        filesystem = S3FileSystem(
+            access_key=credentials['AccessKeyId'],
+            secret_key=credentials['SecretAccessKey'],
+            session_token=credentials['SessionToken'],
+            region=Config.aws_region
+        )
+        # Enough pooled connections for several concurrent multipart uploads
+        s3_client = boto3.client(
+            's3',
+            aws_access_key_id=credentials['AccessKeyId'],
+            aws_secret_access_key=credentials['SecretAccessKey'],
+            aws_session_token=credentials['SessionToken'],
+            region_name=Config.aws_region,
+            config=BotoConfig(max_pool_connections=max(10, Config.s3_upload_concurrency * 4))
+        )
+        return (filesystem, s3_client), credentials['Expiration']
+
+_s3_filesystem_cache = S3FileSystemCache()
 
 def getS3FileSystem():
-    default_credential = ManagedIdentityCredential()
-    token = default_credential.get_token(Config.urn)
+    """Return the cached S3FileSystem, assuming the AWS role only when needed"""
+    return _s3_filesystem_cache.get()
+
+def getS3Client():
+    """Return the cached boto3 S3 client, assuming the AWS role only when needed"""
+    return _s3_filesystem_cache.client()
+
+def split_s3_path(s3_path):
+    """Split s3://bucket/key (or bucket/key) into (bucket, key)"""
+    bucket, _, key = s3_path.removeprefix("s3://").partition("/")
+    return bucket, key
+
+def _crc32_checksum(data):
+    """Return the base64 encoded CRC32 of data, as S3 reports it"""
+    return base64.b64encode(zlib.crc32(data).to_bytes(4, "big")).decode("ascii")
+
+def _composite_crc32_checksum(part_checksums):
+    """Return the checksum S3 reports for a multipart object: the CRC32 of the part CRC32s, and the part count"""
+    return f"{_crc32_checksum(b''.join(base64.b64decode(c) for c in part_checksums))}-{len(part_checksums)}"
+
+class S3MultipartUpload(io.RawIOBase):
+    """Writable file object that uploads to S3 in parts, several parts at a time
+
+    Parts of part_size bytes are uploaded by up to max_concurrency threads, so
+    at most max_concurrency + 1 parts are held in memory. Each part carries a
+    CRC32 checksum that S3 validates, and the checksum S3 returns is compared
+    with ours. After completion the object's composite CRC32 checksum and
+    size are checked against the uploaded parts. The ETag is not compared, as
+    it is not an MD5 of the data for SSE-KMS or SSE-C encrypted objects.
+    Objects smaller than one part are sent
+    with a single PutObject. On failure, or when a with block exits with an
+    exception, the upload is aborted and no object is created.
+    """
+
+    def __init__(self, client, bucket, key, part_size, max_concurrency):
+        self._client = client
+        self._bucket = bucket
+        self._key = key
+        self._part_size = part_size
+        self._max_concurrency = max_concurrency
+        self._buffer = bytearray()
+        self._position = 0
+        self._upload_id = None
+        self._executor = None
+        self._parts = []
+        self._aborted = False
+
+    def writable(self):
+        return True
 
-    role = boto3.client('sts').assume_role_with_web_identity(
-        RoleArn=Config.arn,
-        RoleSessionName='session1',
-        WebIdentityToken=token.token
+    def tell(self):
+        return self._position
+
+    def write(self, data):
+        view = memoryview(data).cast("B")
+        self._buffer += view
+        self._position += view.nbytes
+        while len(self._buffer) >= self._part_size:
+            self._submit_part(bytes(self._buffer[:self._part_size]))
+            del self._buffer[:self._part_size]
+        return view.nbytes
+
+    def _submit_part(self, body):
+        if self._upload_id is None:
+            self._upload_id = self._client.create_multipart_upload(Bucket=self._bucket, Key=self._key, ChecksumAlgorithm="CRC32")["UploadId"]
+            self._executor = ThreadPoolExecutor(max_workers=self._max_concurrency)
+
+        # Wait for a free upload slot, failing fast if an earlier part failed
+        in_flight = [future for _, future, _ in self._parts if not future.done()]
+        if len(in_flight) >= self._max_concurrency:
+            with metrics.span("s3_upload"):
+                wait(in_flight, return_when=FIRST_COMPLETED)
+        for _, future, _ in self._parts:
+            if future.done():
+                future.result()
+
+        part_number = len(self._parts) + 1
+        checksum = _crc32_checksum(body)
+        future = self._executor.submit(
+            self._client.upload_part,
+            Bucket=self._bucket,
+            Key=self._key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=body,
+            ChecksumAlgorithm="CRC32",
+            ChecksumCRC32=checksum
         )
-        
-    credentials = role['Credentials']
-    aws_access_key_id = credentials['AccessKeyId']
-    aws_secret_access_key = credentials['SecretAccessKey']
-    aws_session_token = credentials['SessionToken']
-        
-    return S3FileSystem(
-        access_key=aws_access_key_id,
-        secret_key=aws_secret_access_key,
-        session_token=aws_session_token,
-        region=Config.aws_region
-    )
-
-def extract_subscription_ids_from_billing_scope(scope):
-    """Extract all subscription IDs that belong to the billing scope"""
+        self._parts.append((part_number, future, checksum))
+
+    def _put_object(self):
+        body = bytes(self._buffer)
+        checksum = _crc32_checksum(body)
+        response = self._client.put_object(Bucket=self._bucket, Key=self._key, Body=body, ChecksumAlgorithm="CRC32", ChecksumCRC32=checksum)
+        if response.get("ChecksumCRC32", checksum) != checksum:
+            raise IOError(f"Checksum mismatch uploading s3://{self._bucket}/{self._key}: sent {checksum}, S3 stored {response['ChecksumCRC32']}")
+
+    def _complete(self):
+        if self._buffer:
+            self._submit_part(bytes(self._buffer))
+            self._buffer.clear()
+
+        completed_parts = []
+        for part_number, future, checksum in self._parts:
+            response = future.result()
+            if response.get("ChecksumCRC32", checksum) != checksum:
+                raise IOError(f"Checksum mismatch for part {part_number} of s3://{self._bucket}/{self._key}: sent {checksum}, S3 stored {response['ChecksumCRC32']}")
+            completed_parts.append({"PartNumber": part_number, "ETag": response["ETag"], "ChecksumCRC32": checksum})
+
+        result = self._client.complete_multipart_upload(
+            Bucket=self._bucket,
+            Key=self._key,
+            UploadId=self._upload_id,
+            MultipartUpload={"Parts": completed_parts}
+        )
+
+        # S3 returns the composite checksum of the parts it assembled, whatever the encryption
+        expected_checksum = _composite_crc32_checksum([part["ChecksumCRC32"] for part in completed_parts])
+        checksum = result.get("ChecksumCRC32", expected_checksum)
+        size = self._client.head_object(Bucket=self._bucket, Key=self._key)["ContentLength"]
+        if checksum != expected_checksum or size != self._position:
+            self._client.delete_object(Bucket=self._bucket, Key=self._key)
+            raise IOError(f"Verification failed for s3://{self._bucket}/{self._key}: checksum {checksum} (expected {expected_checksum}), {size} bytes (expected {self._position})")
+        logging.info(f"Uploaded s3://{self._bucket}/{self._key} in {len(completed_parts)} parts ({self._position} bytes), checksum {checksum}")
+
+    def abort(self):
+        """Abandon the upload; nothing is written to S3"""
+        self._aborted = True
+        self._buffer.clear()
+        if self._upload_id is not None:
+            try:
+                self._client.abort_multipart_upload(Bucket=self._bucket, Key=self._key, UploadId=self._upload_id)
+            except Exception as e:
+                logging.warning(f"Failed to abort multipart upload of s3://{self._bucket}/{self._key}: {str(e)}")
+            self._upload_id = None
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if not self._aborted:
+                with metrics.span("s3_upload"):
+                    if self._upload_id is None:
+                        self._put_object()
+                    else:
+                        self._complete()
+                metrics.count("bytes_out", self._position)
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+            super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        self.close()
+
+def open_s3_upload(s3_path):
+    """Open an S3 object for writing with concurrent, verified multipart uploads
+
+    Part size and concurrency are set by S3_UPLOAD_PART_SIZE and S3_UPLOAD_CONCURRENCY.
+    """
+    bucket, key = split_s3_path(s3_path)
+    return S3MultipartUpload(getS3Client(), bucket, key, Config.s3_upload_part_size, Config.s3_upload_concurrency)
+
+# Blob (in CONTAINER_NAME) holding previously discovered subscriptions per scope
+SUBSCRIPTION_CACHE_BLOB = "cache/subscription-discovery.json"
+
+def load_json_blob(blob_name, default=None):
+    """Load a JSON document from the function's storage container, or return default if unavailable"""
+    from azure.core.exceptions import ResourceNotFoundError
+    try:
+        blob_client = azure_clients.container_client().get_blob_client(blob_name)
+        return json.loads(blob_client.download_blob().readall())
+    except ResourceNotFoundError:
+        return default
+    except Exception as e:
+        logging.warning(f"Failed to load {blob_name}: {str(e)}")
+        return default
+
+def save_json_blob(blob_name, data):
+    """Write a JSON document to the function's storage container, replacing any existing blob"""
+    blob_client = azure_clients.container_client().get_blob_client(blob_name)
+    blob_client.upload_blob(json.dumps(data), overwrite=True)
+
+def _load_subscription_cache():
+    """Load the persisted subscription discovery cache, or an empty cache if unavailable"""
+    return load_json_blob(SUBSCRIPTION_CACHE_BLOB, default={})
+
+def _save_subscription_cache(cache):
+    """Persist the subscription discovery cache to blob storage"""
+    try:
+        save_json_blob(SUBSCRIPTION_CACHE_BLOB, cache)
+    except Exception as e:
+        logging.warning(f"Failed to save subscription discovery cache: {str(e)}")
+
+def _is_cache_entry_fresh(entry):
+    discovered_at = datetime.fromisoformat(entry["discovered_at"])
+    return datetime.now(timezone.utc) - discovered_at < timedelta(hours=Config.subscription_cache_ttl_hours)
+
+def extract_subscription_ids_from_billing_scope(scope, use_cache=True):
+    """Extract all subscription IDs that belong to one or more comma-separated billing scopes
+
+    Results are cached per scope in blob storage for SUBSCRIPTION_CACHE_TTL_HOURS.
+    Scopes missing from the cache are discovered concurrently, and the combined
+    list is deduplicated while keeping first-seen order.
+    """
+    scopes = [s.strip() for s in (scope or "").split(",") if s.strip()]
+    if not scopes:
+        logging.error(f"Unsupported billing scope format: {scope}")
+        return []
+
+    cache = _load_subscription_cache() if use_cache else {}
+    stale_scopes = [s for s in scopes if not (s in cache and _is_cache_entry_fresh(cache[s]))]
+
+    if stale_scopes:
+        with ThreadPoolExecutor(max_workers=len(stale_scopes)) as executor:
+            discovered = dict(zip(stale_scopes, executor.map(metrics.bind(discover_subscription_ids), stale_scopes)))
+
+        discovered_at = datetime.now(timezone.utc).isoformat()
+        for stale_scope, subscription_ids in discovered.items():
+            # Don't cache failed or empty discoveries so the next run tries again
+            if subscription_ids:
+                cache[stale_scope] = {"discovered_at": discovered_at, "subscription_ids": subscription_ids}
+            else:
+                cache.pop(stale_scope, None)
+
+        if use_cache:
+            _save_subscription_cache(cache)
+    else:
+        discovered = {}
+
+    subscription_ids = []
+    for s in scopes:
+        if s in discovered:
+            subscription_ids.extend(discovered[s])
+        elif s in cache:
+            logging.info(f"Using cached subscriptions for scope {s} discovered at {cache[s]['discovered_at']}")
+            subscription_ids.extend(cache[s]["subscription_ids"])
+
+    subscription_ids = list(dict.fromkeys(subscription_ids))
+    logging.info(f"Found {len(subscription_ids)} unique subscriptions across {len(scopes)} billing scope(s)")
+    return subscription_ids
+
+def discover_subscription_ids(scope):
+    """Discover all subscription IDs that belong to a single billing scope"""
     try:
-        # Get access token using managed identity
-        credential = ManagedIdentityCredential()
-        token = credential.get_token("https://management.azure.com/.default")
-        
-        headers = {
-            "Authorization": f"Bearer {token.token}",
-            "Content-Type": "application/json"
-        }
-        
         subscription_ids = []
         
         # Parse the billing scope type and extract subscription IDs accordingly
         if "/providers/Microsoft.Billing/billingAccounts/" in scope:
             # Billing Account scope - get all subscriptions under this billing account
-            subscription_ids = get_subscriptions_from_billing_account(scope, headers)
+            subscription_ids = get_subscriptions_from_billing_account(scope)
             
         elif "/providers/Microsoft.Management/managementGroups/" in scope:
             # Management Group scope - get all subscriptions under this management group
-            subscription_ids = get_subscriptions_from_management_group(scope, headers)
+            subscription_ids = get_subscriptions_from_management_group(scope)
             
         elif "/subscriptions/" in scope and scope.count("/") == 2:
             # Single subscription scope - extract the subscription ID directly
@@ -106,52 +818,51 @@ def extract_subscription_ids_from_billing_scope(scope):
             logging.error(f"Unsupported billing scope format: {scope}")
             return []
         
-        logging.info(f"Found {len(subscription_ids)} subscriptions in billing scope")
+        logging.info(f"Found {len(subscription_ids)} subscriptions in billing scope {scope}")
         return subscription_ids
         
     except Exception as e:
         logging.error(f"Error extracting subscription IDs: {str(e)}")
         return []
 
-def get_subscriptions_from_billing_account(scope, headers):
-    """Get all subscription IDs from a billing account scope"""
+def get_subscriptions_from_billing_account(scope):
+    """Get all subscription IDs from a billing account scope, following nextLink pages"""
     try:
         # Extract billing account ID from scope
         # Format: /providers/Microsoft.Billing/billingAccounts/{billingAccountId}
         billing_account_id = scope.split("/")[-1]
         
         # Query billing subscriptions API
-        api_url = f"https://management.azure.com/providers/Microsoft.Billing/billingAccounts/{billing_account_id}/billingSubscriptions"
+        api_url = f"{Config.arm_endpoint}/providers/Microsoft.Billing/billingAccounts/{billing_account_id}/billingSubscriptions"
         api_version = "2020-05-01"
         
-        response = requests.get(
-            f"{api_url}?api-version={api_version}",
-            headers=headers,
-            timeout=60
-        )
+        subscription_ids = []
+        next_url = f"{api_url}?api-version={api_version}"
         
-        if response.status_code == 200:
-            data = response.json()
-            subscription_ids = []
+        while next_url:
+            response = send_arm_request("GET", next_url, timeout=60)
+            
+            if response.status_code != 200:
+                logging.error(f"Failed to get subscriptions from billing account: {response.status_code} - {response.text}")
+                return []
             
+            data = response.json()
             for subscription in data.get("value", []):
                 # Extract subscription ID from the subscription properties
                 sub_id = subscription.get("properties", {}).get("subscriptionId")
                 if sub_id:
                     subscription_ids.append(sub_id)
-                    
-            logging.info(f"Retrieved {len(subscription_ids)} subscriptions from billing account {billing_account_id}")
-            return subscription_ids
             
-        else:
-            logging.error(f"Failed to get subscriptions from billing account: {response.status_code} - {response.text}")
-            return []
+            next_url = data.get("nextLink")
+                    
+        logging.info(f"Retrieved {len(subscription_ids)} subscriptions from billing account {billing_account_id}")
+        return subscription_ids
             
     except Exception as e:
         logging.error(f"Error getting subscriptions from billing account: {str(e)}")
         return []
 
-def get_subscriptions_from_management_group(scope, headers):
+def get_subscriptions_from_management_group(scope):
     """Get all subscription IDs from a management group scope using Resource Graph API"""
     try:
         # Extract management group ID from scope
@@ -159,7 +870,7 @@ def get_subscriptions_from_management_group(scope, headers):
         mg_id = scope.split("/")[-1]
         
         # Use Resource Graph API to get subscriptions under management group
-        subscription_ids = get_subscriptions_via_resource_graph(mg_id, headers)
+        subscription_ids = get_subscriptions_via_resource_graph(mg_id)
         
         logging.info(f"Retrieved {len(subscription_ids)} subscriptions from management group {mg_id}")
         return subscription_ids
@@ -168,78 +879,55 @@ def get_subscriptions_from_management_group(scope, headers):
         logging.error(f"Error getting subscriptions from management group: {str(e)}")
         return []
 
-def get_subscriptions_via_resource_graph(mg_id, headers):
-    """Get subscriptions using Azure Resource Graph API"""
-    try:
-        # Use Resource Graph to query subscriptions under management group
-        api_url = "https://management.azure.com/providers/Microsoft.ResourceGraph/resources"
-        api_version = "2021-03-01"
-        
-        # Query to get all subscriptions under the management group
-        query_data = {
-            "query": f"ResourceContainers | where type =~ 'microsoft.resources/subscriptions' | project subscriptionId",
-            "managementGroups": [mg_id]
-        }
-        
-        response = requests.post(
+# Resource Graph accepts at most 1000 subscriptions per query
+RESOURCE_GRAPH_MAX_SUBSCRIPTIONS = 1000
+
+def query_resource_graph(query, management_groups=None, subscriptions=None, page_size=1000):
+    """Yield every row of an Azure Resource Graph query, following $skipToken pages"""
+    api_url = f"{Config.arm_endpoint}/providers/Microsoft.ResourceGraph/resources"
+    api_version = "2021-03-01"
+    
+    query_data = {"query": query, "options": {"$top": page_size}}
+    if management_groups:
+        query_data["managementGroups"] = management_groups
+    if subscriptions:
+        query_data["subscriptions"] = subscriptions
+    
+    while True:
+        response = send_arm_request(
+            "POST",
             f"{api_url}?api-version={api_version}",
-            headers=headers,
             json=query_data,
             timeout=60
         )
         
-        if response.status_code == 200:
-            data = response.json()
-            subscription_ids = []
-            
-            for row in data.get("data", []):
-                if "subscriptionId" in row:
-                    subscription_ids.append(row["subscriptionId"])
-                    
-            logging.info(f"Resource Graph API found {len(subscription_ids)} subscriptions under management group {mg_id}")
-            return subscription_ids
-            
-        else:
+        if response.status_code != 200:
             logging.error(f"Resource Graph API failed: {response.status_code} - {response.text}")
-            return []
-            
-    except Exception as e:
-        logging.error(f"Error using Resource Graph API: {str(e)}")
-        return []
-
-def extract_billing_account_from_blob_path(blob_name):
-    """Extract billing account ID from the blob path structure
-    
-    Cost exports create paths like: 
-    /gds-focus-v1/focus-daily-cost-export-0/billing_period=20250801/...
-    where the export name ends with the billing account index from Terraform
-    """
-    try:
-        path_parts = blob_name.split('/')
+            response.raise_for_status()
         
-        for part in path_parts:
-            # Look for focus export names that end with a numeric index
-            if part.startswith("focus-daily-cost-export-") or part.startswith("focus-backfill-"):
-                # Extract the index number from the export name
-                if "-" in part:
-                    parts = part.split("-")
-                    if len(parts) >= 4:  # focus-daily-cost-export-N or focus-backfill-N-YYYY-MM
-                        try:
-                            # For daily exports: focus-daily-cost-export-0
-                            if part.startswith("focus-daily-cost-export-"):
-                                export_index = int(parts[-1])
-                                return export_index
-                            # For backfill exports: focus-backfill-0-2024-01
-                            elif part.startswith("focus-backfill-") and len(parts) >= 5:
-                                export_index = int(parts[2])  # Third part after focus-backfill-
-                                return export_index
-                        except (ValueError, IndexError) as e:
-                            logging.debug(f"Failed to parse blob path part '{part}': {str(e)}")
-                            continue
+        data = response.json()
+        yield from data.get("data", [])
         
-        logging.warning(f"Could not extract billing account index from blob path: {blob_name}")
-        return None
+        skip_token = data.get("$skipToken")
+        if not skip_token:
+            return
+        query_data["options"]["$skipToken"] = skip_token
+
+def get_subscriptions_via_resource_graph(mg_id):
+    """Get subscriptions using Azure Resource Graph API"""
+    try:
+        # Query to get all subscriptions under the management group
+        query = "ResourceContainers | where type =~ 'microsoft.resources/subscriptions' | project subscriptionId"
         
+        subscription_ids = [
+            row["subscriptionId"]
+            for row in query_resource_graph(query, management_groups=[mg_id])
+            if "subscriptionId" in row
+        ]
+                    
+        logging.info(f"Resource Graph API found {len(subscription_ids)} subscriptions under management group {mg_id}")
+        return subscription_ids
+            
     except Exception as e:
-        logging.exception(f"Error extracting billing account from blob path: {str(e)}")
-        return None
\ No newline at end of file
+        logging.error(f"Error using Resource Graph API: {str(e)}")
+        return []
@@ -0,0 +1,270 @@
+"""Compact the FOCUS parquet files in closed billing_period partitions on S3
+
+Daily runs and backfills leave many small part files in each
+billing_period=YYYYMMDD partition. Compaction rewrites each billing account's
+files in a partition into a few target-sized files with large row groups.
+
+Compaction keeps its own record of each partition in a _manifest.json object:
+the live files, and the source files each compacted file replaced. Query
+engines such as Athena ignore objects whose names start with an underscore and
+list the partition directly, so the manifest does not hide anything from them.
+Compacted files are written with open_s3_upload, so an object is only
+recorded, and its sources deleted, once S3 has verified its checksum and size.
+Compaction is not invisible to queries: between writing a compacted file and
+deleting its sources, queries of the partition count the rows of both. Each
+chunk's sources are deleted as soon as its compacted file is written and
+recorded, so the window is one chunk long. If a run stops inside it, the next
+run finds the sources in the manifest and deletes them.
+"""
+import re
+import json
+import math
+import hashlib
+import logging
+from datetime import datetime, timezone, timedelta
+import pyarrow.parquet as pq
+from pyarrow.fs import FileSelector, FileType
+from common import open_s3_upload
+from focus import ParquetOutputWriter, DEFAULT_OUTPUT_PROFILE
+
+MANIFEST_NAME = "_manifest.json"
+PARTITION_PREFIX = "billing_period="
+
+# Flattened FOCUS filenames are {billing account}_{billing profile}_{part}, where the part
+# is an export part (prefixed with day_YYYYMMDD_ in incremental mode), a batch mode
+# coalesced file or an earlier compacted file
+_FILENAME_RE = re.compile(r"^(?P<prefix>.*?)_?(?P<part>(?:(?:day_[0-9a-z]+_)?part_\d+_\d+|coalesced_[0-9a-f]+|compacted_[0-9a-f]+)\.parquet)$")
+_COMPACTED_RE = re.compile(r"(?:^|_)compacted_[0-9a-f]+\.parquet$")
+
+def file_group(filename):
+    """Return the billing account prefix of a flattened filename, which files are compacted by"""
+    match = _FILENAME_RE.match(filename)
+    return match.group("prefix") if match else ""
+
+def is_compacted_file(filename):
+    return bool(_COMPACTED_RE.search(filename))
+
+def partition_end(partition_dir):
+    """Return the start of the month after a billing_period=YYYYMMDD partition, or None if it is not one"""
+    name = partition_dir.rstrip("/").rsplit("/", 1)[-1]
+    try:
+        start = datetime.strptime(name[len(PARTITION_PREFIX):], "%Y%m%d").replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+    return (start.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+def is_partition_closed(partition_dir, now, min_age_days):
+    """Check if a partition's billing period ended at least min_age_days ago
+
+    Open partitions are still rewritten by the daily MonthToDate export, which
+    relies on overwriting its own part filenames.
+    """
+    end = partition_end(partition_dir)
+    return end is not None and now >= end + timedelta(days=min_age_days)
+
+def list_partitions(s3, base_path):
+    """List the parquet files under base_path, grouped by billing_period partition directory
+
+    Returns {partition directory: {filename: FileInfo}}.
+    """
+    selector = FileSelector(base_path.removeprefix("s3://").rstrip("/"), recursive=True, allow_not_found=True)
+    partitions = {}
+    for info in s3.get_file_info(selector):
+        if info.type != FileType.File or not info.path.endswith(".parquet"):
+            continue
+        partition_dir, filename = info.path.rsplit("/", 1)
+        if filename.startswith(("_", ".")) or not partition_dir.rsplit("/", 1)[-1].startswith(PARTITION_PREFIX):
+            continue
+        partitions.setdefault(partition_dir, {})[filename] = info
+    return partitions
+
+def load_manifest(s3, partition_dir):
+    """Load a partition's manifest, or None if it has never been compacted"""
+    try:
+        with s3.open_input_stream(f"{partition_dir}/{MANIFEST_NAME}") as stream:
+            return json.loads(stream.read())
+    except FileNotFoundError:
+        return None
+
+def save_manifest(s3, partition_dir, manifest):
+    """Replace a partition's manifest; S3 makes the new object visible in a single step"""
+    with s3.open_output_stream(f"{partition_dir}/{MANIFEST_NAME}") as stream:
+        stream.write(json.dumps(manifest, indent=2).encode("utf-8"))
+
+def _modified_after(info, since):
+    return info.mtime is not None and since is not None and info.mtime > since
+
+def plan_partition(files, manifest, target_bytes):
+    """Work out how to compact one partition
+
+    files maps filename to FileInfo. Returns (chunks, stale) where chunks is a
+    list of (group, [filenames]) to rewrite into one file each, and stale is a
+    list of filenames to delete without rewriting:
+    - compacted files missing from the manifest, left by an interrupted run
+    - source files listed as replaced in the manifest that were not modified
+      since the compacted file was written, left by an interrupted delete
+    - compacted files whose sources were all written again since, e.g. by a
+      re-run backfill, as those rows are now duplicated
+
+    A compacted file is only dropped once every source it replaced is back, as
+    it holds the only copy of the rows of the others. Until then its re-written
+    sources are left as they are, neither deleted nor compacted, and their rows
+    are counted twice by queries of the partition.
+    """
+    manifest = manifest or {}
+    compacted_at = manifest.get("compacted_at")
+    replaced = manifest.get("replaced", {})
+    stale = set()
+    held = set()
+
+    for filename in files:
+        if is_compacted_file(filename) and filename not in replaced:
+            stale.add(filename)
+
+    for output, sources in replaced.items():
+        if output not in files:
+            continue
+        written_at = files[output].mtime or (datetime.fromisoformat(compacted_at) if compacted_at else None)
+        live_sources = [s for s in sources if s in files]
+        if not any(_modified_after(files[s], written_at) for s in live_sources):
+            stale.update(live_sources)
+        elif len(live_sources) == len(sources):
+            stale.add(output)
+        else:
+            logging.info(f"Keeping {output} until all of its {len(sources)} sources are written again ({len(live_sources)} so far)")
+            held.update(live_sources)
+
+    groups = {}
+    for filename in sorted(files):
+        if filename not in stale and filename not in held:
+            groups.setdefault(file_group(filename), []).append(filename)
+
+    chunks = []
+    for group, filenames in sorted(groups.items()):
+        total_bytes = sum(files[f].size for f in filenames)
+        if len(filenames) <= max(1, math.ceil(total_bytes / target_bytes)):
+            # Already as compact as the target size allows
+            continue
+
+        current, current_bytes = [], 0
+        for filename in filenames:
+            if current and current_bytes + files[filename].size > target_bytes:
+                chunks.append((group, current))
+                current, current_bytes = [], 0
+            current.append(filename)
+            current_bytes += files[filename].size
+        chunks.append((group, current))
+
+    # A chunk of one file would be rewritten unchanged
+    return [(group, chunk) for group, chunk in chunks if len(chunk) > 1], sorted(stale)
+
+def compacted_filename(group, sources):
+    """Name a compacted file after its sources, so a retried run writes the same object"""
+    digest = hashlib.sha1("\n".join(sorted(sources)).encode("utf-8")).hexdigest()[:16]
+    return f"{group}_compacted_{digest}.parquet" if group else f"compacted_{digest}.parquet"
+
+def rewrite_files(s3, partition_dir, sources, output, profile=DEFAULT_OUTPUT_PROFILE, batch_size=65536):
+    """Rewrite parquet files into one file with the row group size and encoding of profile
+
+    At most one row group is held in memory, plus the parts being uploaded.
+    Files must share a schema. The output is a verified open_s3_upload, so this
+    raises, before any source is deleted, unless S3 stored exactly what was
+    written; a compacted file left behind is not in the manifest and is
+    deleted as stale by the next run.
+    Returns rows written.
+    """
+    inputs = [s3.open_input_file(f"{partition_dir}/{filename}") for filename in sources]
+    try:
+        parquet_files = [pq.ParquetFile(source) for source in inputs]
+        schema = parquet_files[0].schema_arrow
+
+        with open_s3_upload(f"{partition_dir}/{output}") as sink:
+            with ParquetOutputWriter(sink, schema, profile) as writer:
+                for parquet_file in parquet_files:
+                    for batch in parquet_file.iter_batches(batch_size=batch_size):
+                        writer.write_batch(batch)
+            logging.info(f"Wrote {output} from {len(sources)} files: {writer.rows} rows, {writer.bytes_written} bytes, {writer.row_groups} row group(s), {writer.encode_seconds:.3f}s encode time")
+        return writer.rows
+    finally:
+        for source in inputs:
+            source.close()
+
+def _split_by_schema(s3, partition_dir, chunk):
+    """Split a chunk into lists of files with identical schemas, as a ParquetWriter needs one schema"""
+    by_schema = {}
+    for filename in chunk:
+        schema = pq.read_schema(f"{partition_dir}/{filename}", filesystem=s3)
+        by_schema.setdefault(schema.to_string(), []).append(filename)
+    return [filenames for filenames in by_schema.values() if len(filenames) > 1]
+
+def compact_partition(s3, partition_dir, files, target_bytes, profile=DEFAULT_OUTPUT_PROFILE, batch_size=65536):
+    """Compact one partition, recording each compacted file in its manifest before deleting the sources
+
+    This is not atomic for readers: from the time a compacted file is written
+    until its sources are deleted, queries of the partition count their rows
+    twice (see the module docstring). Returns a summary dict, or None if the
+    partition is already compact.
+    """
+    manifest = load_manifest(s3, partition_dir)
+    chunks, stale = plan_partition(files, manifest, target_bytes)
+    if not chunks and not stale and (manifest is None or set(manifest.get("files", [])) == set(files)):
+        return None
+
+    replaced = {
+        output: sources
+        for output, sources in (manifest or {}).get("replaced", {}).items()
+        if output in files and output not in stale
+    }
+    rows = 0
+    removed = set()
+
+    def record_and_delete(filenames):
+        """Save the manifest without filenames, then delete them"""
+        removed.update(filenames)
+        save_manifest(s3, partition_dir, {
+            "compacted_at": datetime.now(timezone.utc).isoformat(),
+            "files": sorted((set(files) - removed) | set(replaced)),
+            "replaced": replaced,
+        })
+        for filename in sorted(filenames):
+            s3.delete_file(f"{partition_dir}/{filename}")
+
+    if stale or not chunks:
+        record_and_delete(stale)
+    for group, chunk in chunks:
+        for sources in _split_by_schema(s3, partition_dir, chunk):
+            output = compacted_filename(group, sources)
+            rows += rewrite_files(s3, partition_dir, sources, output, profile, batch_size)
+            # Sources that were themselves compacted are expanded, so a later re-export of any original part is still detected
+            replaced[output] = sorted({s for source in sources for s in replaced.pop(source, [source])})
+            record_and_delete(sources)
+
+    live = (set(files) - removed) | set(replaced)
+    return {"files_before": len(files), "files_after": len(live), "rows_rewritten": rows, "stale_removed": len(stale)}
+
+def compact_partitions(s3, base_path, min_age_days, target_bytes, profile=DEFAULT_OUTPUT_PROFILE, deadline=None, batch_size=65536):
+    """Compact every closed billing_period partition under base_path
+
+    Stops starting new partitions once deadline (a UTC datetime) has passed;
+    the remaining partitions are picked up on the next run. Returns
+    {partition directory: summary} for the partitions that were changed.
+    """
+    now = datetime.now(timezone.utc)
+    results = {}
+    for partition_dir, files in sorted(list_partitions(s3, base_path).items()):
+        if not is_partition_closed(partition_dir, now, min_age_days):
+            continue
+        if deadline is not None and datetime.now(timezone.utc) >= deadline:
+            logging.info("Compaction deadline reached, leaving remaining partitions for the next run")
+            break
+        try:
+            summary = compact_partition(s3, partition_dir, files, target_bytes, profile, batch_size)
+        except Exception as e:
+            logging.error(f"Failed to compact {partition_dir}: {str(e)}")
+            continue
+        if summary is None:
+            logging.info(f"Partition already compact, skipping: {partition_dir}")
+        else:
+            logging.info(f"Compacted {partition_dir}: {summary}")
+            results[partition_dir] = summary
+    return results
@@ -0,0 +1,164 @@
+"""Flattened Arrow schemas for the Advisor and Carbon exports written as parquet
+
+Each recommendation or carbon report record becomes one row with typed
+columns, so query engines can prune columns instead of parsing nested JSON.
+Fields that are not mapped to a column are kept in a JSON string column.
+"""
+import json
+from datetime import datetime
+import pyarrow as pa
+from focus import ParquetOutputWriter, ParquetOutputProfile
+
+# Recommendations are converted and written this many at a time
+RECOMMENDATION_BATCH_ROWS = 1000
+
+RECOMMENDATION_SCHEMA = pa.schema([
+    ("RecommendationId", pa.string()),
+    ("RecommendationName", pa.string()),
+    ("RecommendationTypeId", pa.string()),
+    ("SubscriptionId", pa.string()),
+    ("ResourceGroup", pa.string()),
+    ("ResourceType", pa.string()),
+    ("Category", pa.string()),
+    ("Impact", pa.string()),
+    ("Risk", pa.string()),
+    ("Problem", pa.string()),
+    ("Solution", pa.string()),
+    ("SavingsAmount", pa.float64()),
+    ("AnnualSavingsAmount", pa.float64()),
+    ("SavingsCurrency", pa.string()),
+    ("Term", pa.string()),
+    ("LookbackPeriod", pa.string()),
+    ("Region", pa.string()),
+    ("LastUpdated", pa.timestamp("s", tz="UTC")),
+    ("ExtendedProperties", pa.string()),
+])
+
+# extendedProperties keys mapped to their own columns
+_EXTENDED_PROPERTY_COLUMNS = {
+    "savingsAmount": "SavingsAmount",
+    "annualSavingsAmount": "AnnualSavingsAmount",
+    "savingsCurrency": "SavingsCurrency",
+    "term": "Term",
+    "lookbackPeriod": "LookbackPeriod",
+    "region": "Region",
+}
+
+CARBON_SCHEMA = pa.schema([
+    ("DataType", pa.string()),
+    ("Date", pa.date32()),
+    ("CarbonIntensity", pa.float64()),
+    ("LatestMonthEmissions", pa.float64()),
+    ("PreviousMonthEmissions", pa.float64()),
+    ("MonthOverMonthEmissionsChangeRatio", pa.float64()),
+    ("MonthlyEmissionsChangeValue", pa.float64()),
+    ("Note", pa.string()),
+])
+
+CARBON_SORT_COLUMNS = ("Date", "DataType")
+
+# Encodings of the Advisor and Carbon files, independent of the FOCUS PARQUET_* settings.
+# Every column is dictionary encoded; recommendations keep the order they arrive in
+RECOMMENDATION_OUTPUT_PROFILE = ParquetOutputProfile(compression="zstd", compression_level=3)
+CARBON_OUTPUT_PROFILE = ParquetOutputProfile(compression="zstd", compression_level=3, sort_columns=CARBON_SORT_COLUMNS)
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+def _to_timestamp(value):
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return None
+
+def _resource_group(resource_id):
+    """Return the resource group named in an ARM ID, or None"""
+    parts = (resource_id or "").split("/")
+    lowered = [part.lower() for part in parts]
+    if "resourcegroups" in lowered:
+        index = lowered.index("resourcegroups")
+        if index + 1 < len(parts):
+            return parts[index + 1]
+    return None
+
+def flatten_recommendation(recommendation):
+    """Map a sanitized Advisor recommendation to a RECOMMENDATION_SCHEMA row"""
+    properties = recommendation.get("properties", {})
+    extended = dict(properties.get("extendedProperties") or {})
+    short_description = properties.get("shortDescription") or {}
+    row = {
+        "RecommendationId": recommendation.get("id"),
+        "RecommendationName": recommendation.get("name"),
+        "RecommendationTypeId": properties.get("recommendationTypeId"),
+        "SubscriptionId": recommendation.get("subscriptionId"),
+        "ResourceGroup": _resource_group(recommendation.get("id")),
+        "ResourceType": properties.get("impactedField"),
+        "Category": properties.get("category"),
+        "Impact": properties.get("impact"),
+        "Risk": properties.get("risk"),
+        "Problem": short_description.get("problem"),
+        "Solution": short_description.get("solution"),
+        "LastUpdated": _to_timestamp(properties.get("lastUpdated")),
+    }
+    for key, column in _EXTENDED_PROPERTY_COLUMNS.items():
+        value = extended.pop(key, None)
+        if RECOMMENDATION_SCHEMA.field(column).type == pa.float64():
+            row[column] = _to_float(value)
+        else:
+            row[column] = None if value is None else str(value)
+    row["ExtendedProperties"] = json.dumps(extended, sort_keys=True) if extended else None
+    return row
+
+def _rows_to_record_batch(rows, schema):
+    return pa.RecordBatch.from_pylist(rows, schema=schema)
+
+class RecommendationParquetWriter:
+    """Buffers flattened recommendations and writes them to a parquet sink in batches"""
+
+    def __init__(self, sink, profile=RECOMMENDATION_OUTPUT_PROFILE):
+        self._writer = ParquetOutputWriter(sink, RECOMMENDATION_SCHEMA, profile)
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, recommendation):
+        self._rows.append(flatten_recommendation(recommendation))
+        if len(self._rows) >= RECOMMENDATION_BATCH_ROWS:
+            self._flush()
+
+    def _flush(self):
+        if self._rows:
+            self._writer.write_batch(_rows_to_record_batch(self._rows, RECOMMENDATION_SCHEMA))
+            self._rows = []
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+def flatten_carbon_record(record):
+    """Map a carbon emissions report record to a CARBON_SCHEMA row"""
+    date = record.get("date")
+    return {
+        "DataType": record.get("dataType"),
+        "Date": datetime.strptime(date[:10], "%Y-%m-%d").date() if date else None,
+        "CarbonIntensity": _to_float(record.get("carbonIntensity")),
+        "LatestMonthEmissions": _to_float(record.get("latestMonthEmissions")),
+        "PreviousMonthEmissions": _to_float(record.get("previousMonthEmissions")),
+        "MonthOverMonthEmissionsChangeRatio": _to_float(record.get("monthOverMonthEmissionsChangeRatio")),
+        "MonthlyEmissionsChangeValue": _to_float(record.get("monthlyEmissionsChangeValue")),
+        "Note": record.get("note"),
+    }
+
+def write_carbon_parquet(data, sink, profile=CARBON_OUTPUT_PROFILE):
+    """Write the records of a carbon emissions report to a parquet sink; returns the row count"""
+    rows = [flatten_carbon_record(record) for record in data.get("value", [])]
+    with ParquetOutputWriter(sink, CARBON_SCHEMA, profile) as writer:
+        writer.write_batch(_rows_to_record_batch(rows, CARBON_SCHEMA))
+    return writer.rows
@@ -0,0 +1,321 @@
+import time
+import logging
+import contextlib
+from collections import namedtuple
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import metrics
+
+### Any deployment specific requirements can be implemented here ###
+# Columns removed from the FOCUS data before it is forwarded to S3
+DROPPED_COLUMNS = frozenset([
+    "ResourceName",
+    "BillingAccountId",
+    "BillingAccountName",
+    "BillingAccountType",
+    "ChargeDescription",
+    "CommitmentDiscountName",
+    "RegionId",
+    "ResourceId",
+    "SubAccountId",
+    "SubAccountName",
+    "SubAccountType",
+    "Tags",
+])
+
+# Any columns that start with these prefixes are dropped as well
+DROPPED_COLUMN_PREFIXES = ("x_",)
+### End of deployment specific requirements ###
+
+# Column used to split output files by billing account before it is dropped
+BILLING_ACCOUNT_COLUMN = "BillingAccountId"
+
+# Columns used to split output by charge day and to fingerprint each day's rows
+CHARGE_PERIOD_COLUMN = "ChargePeriodStart"
+FINGERPRINT_COST_COLUMNS = ("BilledCost", "EffectiveCost")
+
+# Encoding settings for the parquet files written to S3. dictionary_columns of None
+# dictionary encodes every column, and a row_group_rows of None writes one row
+# group per record batch. The defaults match pyarrow's own.
+ParquetOutputProfile = namedtuple("ParquetOutputProfile", [
+    "compression",
+    "compression_level",
+    "row_group_rows",
+    "dictionary_columns",
+    "sort_columns",
+    "write_statistics",
+    "write_page_index",
+], defaults=("snappy", None, None, None, (), True, False))
+
+DEFAULT_OUTPUT_PROFILE = ParquetOutputProfile()
+
+def parquet_writer_options(profile, schema):
+    """Return ParquetWriter keyword arguments for a profile, ignoring columns missing from the schema"""
+    options = {
+        "compression": profile.compression,
+        "write_statistics": profile.write_statistics,
+        "write_page_index": profile.write_page_index,
+    }
+    if profile.compression_level is not None:
+        options["compression_level"] = profile.compression_level
+    if profile.dictionary_columns is None:
+        options["use_dictionary"] = True
+    else:
+        options["use_dictionary"] = [name for name in profile.dictionary_columns if name in schema.names]
+    return options
+
+class ParquetOutputWriter:
+    """ParquetWriter that applies a ParquetOutputProfile and measures output size and encode time
+
+    Batches are buffered until a full row group is available, so at most one
+    row group is held in memory, and rows are sorted within each row group.
+    """
+
+    def __init__(self, sink, schema, profile=DEFAULT_OUTPUT_PROFILE):
+        self._sink = sink
+        self._schema = schema
+        self._profile = profile
+        self._sort_keys = [(name, "ascending") for name in profile.sort_columns if name in schema.names]
+        self._pending = []
+        self._pending_rows = 0
+        self._writer = pq.ParquetWriter(sink, schema, **parquet_writer_options(profile, schema))
+        self.rows = 0
+        self.row_groups = 0
+        self.bytes_written = 0
+        self.encode_seconds = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write_batch(self, batch):
+        self._pending.append(batch)
+        self._pending_rows += batch.num_rows
+        row_group_rows = self._profile.row_group_rows or self._pending_rows
+        while self._pending_rows and self._pending_rows >= row_group_rows:
+            # Write exactly one full row group and carry the remainder over
+            table = pa.Table.from_batches(self._pending, schema=self._schema)
+            self._write_row_group(table.slice(0, row_group_rows))
+            self._pending = table.slice(row_group_rows).to_batches()
+            self._pending_rows -= row_group_rows
+
+    def _write_row_group(self, table):
+        start = time.perf_counter()
+        with metrics.span("parquet_encode"):
+            if self._sort_keys:
+                table = table.sort_by(self._sort_keys)
+            self._writer.write_table(table, row_group_size=table.num_rows)
+        self.encode_seconds += time.perf_counter() - start
+        self.rows += table.num_rows
+        self.row_groups += 1
+
+    def close(self):
+        if self._writer is None:
+            return
+        if self._pending_rows:
+            self._write_row_group(pa.Table.from_batches(self._pending, schema=self._schema))
+        self._pending, self._pending_rows = [], 0
+
+        start = time.perf_counter()
+        with metrics.span("parquet_encode"):
+            self._writer.close()
+        self.encode_seconds += time.perf_counter() - start
+        self._writer = None
+        self.bytes_written = self._sink.tell()
+
+def kept_column_names(schema):
+    """Return the column names that survive the column policy, in schema order"""
+    return [
+        name for name in schema.names
+        if name not in DROPPED_COLUMNS and not name.startswith(DROPPED_COLUMN_PREFIXES)
+    ]
+
+def read_column_names(schema):
+    """Return the columns to read from the source: the kept columns plus BillingAccountId"""
+    columns = kept_column_names(schema)
+    if BILLING_ACCOUNT_COLUMN in schema.names:
+        columns.append(BILLING_ACCOUNT_COLUMN)
+    return columns
+
+def output_schema(schema):
+    """Return the Arrow schema written to S3 for a source schema"""
+    return pa.schema([schema.field(name) for name in kept_column_names(schema)])
+
+# Matches BillingAccountId values such as
+# /providers/Microsoft.Billing/billingAccounts/bdfa614c-3bed-5e6d-313b-b4bfa3cefe1d:16e4ddda-0100-468b-a32c-abbfc29019d8_2019-05-31/billingProfiles/OC35-AR3W-BG7-PGB
+BILLING_ACCOUNT_PATTERN = r"/providers/Microsoft\.Billing/billingAccounts/(?P<account>.+?)(?:/billingProfiles/(?P<profile>.*))?$"
+
+def parse_billing_account_paths(values):
+    """Parse an array of BillingAccountId values into {value: (billing account ID, billing profile)}
+
+    Parsing uses Arrow compute, so it is done once per distinct value rather
+    than once per row.
+    """
+    values = pc.drop_null(values)
+    if len(values) == 0:
+        return {}
+
+    parsed = pc.extract_regex(values, BILLING_ACCOUNT_PATTERN)
+    accounts = pc.struct_field(parsed, "account")
+    profiles = pc.struct_field(parsed, "profile")
+
+    result = {}
+    for value, matched, account, profile in zip(values.to_pylist(), pc.is_valid(parsed).to_pylist(), accounts.to_pylist(), profiles.to_pylist()):
+        if matched:
+            result[value] = (account, profile or None)
+        else:
+            # Fallback: use the full path as billing account ID
+            logging.warning(f"Could not parse billing account path, using full path: {value}")
+            result[value] = (value, None)
+    return result
+
+def split_batch_by_billing_account(batch, output_names):
+    """Split a record batch by BillingAccountId, yielding (BillingAccountId value, projected batch)
+
+    A batch that belongs to a single account, which is the common case, is
+    passed through without copying.
+    """
+    if BILLING_ACCOUNT_COLUMN not in batch.schema.names:
+        yield None, batch.select(output_names)
+        return
+
+    billing_column = batch.column(BILLING_ACCOUNT_COLUMN)
+    projected = batch.select(output_names)
+    unique_values = pc.unique(billing_column)
+
+    if len(unique_values) == 1:
+        yield unique_values[0].as_py(), projected
+        return
+
+    for value in unique_values:
+        if value.is_valid:
+            mask = pc.fill_null(pc.equal(billing_column, value), False)
+        else:
+            mask = pc.is_null(billing_column)
+        yield value.as_py(), projected.filter(mask)
+
+def charge_days(column):
+    """Return the ChargePeriodStart day of each row as a YYYYMMDD string array
+
+    Exports store ChargePeriodStart as a timestamp, but ISO 8601 strings are
+    accepted too. Rows without a ChargePeriodStart get the day "unknown". A
+    batch only spans a few days, so each distinct date is formatted once.
+    """
+    if pa.types.is_timestamp(column.type) or pa.types.is_date(column.type):
+        dates = pc.dictionary_encode(pc.cast(column, pa.date32()))
+        days = pc.take(pc.strftime(dates.dictionary, format="%Y%m%d"), dates.indices)
+    else:
+        days = pc.replace_substring(pc.utf8_slice_codeunits(column, 0, 10), "-", "")
+    return pc.fill_null(days, "unknown")
+
+def day_totals(batch):
+    """Count the rows and sum the cost columns of each (BillingAccountId value, charge day) in a record batch
+
+    The batch needs ChargePeriodStart and the FINGERPRINT_COST_COLUMNS it has,
+    plus BillingAccountId if present. Returns {(BillingAccountId value, day):
+    {"rows": count, cost column: unrounded sum}}.
+    """
+    cost_columns = [name for name in FINGERPRINT_COST_COLUMNS if name in batch.schema.names]
+    if BILLING_ACCOUNT_COLUMN in batch.schema.names:
+        accounts = batch.column(BILLING_ACCOUNT_COLUMN)
+    else:
+        accounts = pa.nulls(batch.num_rows, type=pa.string())
+
+    keyed = pa.table(
+        {"account": accounts, "day": charge_days(batch.column(CHARGE_PERIOD_COLUMN))}
+        | {name: pc.cast(batch.column(name), pa.float64()) for name in cost_columns}
+    )
+    grouped = keyed.group_by(["account", "day"]).aggregate([("day", "count")] + [(name, "sum") for name in cost_columns])
+
+    totals = {}
+    for row in grouped.to_pylist():
+        total = {"rows": row["day_count"]}
+        for name in cost_columns:
+            total[name] = row[f"{name}_sum"] or 0.0
+        totals[(row["account"], row["day"])] = total
+    return totals
+
+def day_fingerprints(batches):
+    """Fingerprint the rows of each (BillingAccountId value, charge day) in a stream of record batches
+
+    Only the totals of each batch are kept, so memory does not grow with the
+    input. Returns {(BillingAccountId value, day): {"rows": count, cost column:
+    rounded sum}}. Sums are rounded once all batches are added, so that a
+    different row order in a later export does not register as a change.
+    """
+    totals = {}
+    for batch in batches:
+        for key, batch_total in day_totals(batch).items():
+            total = totals.setdefault(key, dict.fromkeys(batch_total, 0))
+            for name, value in batch_total.items():
+                total[name] += value
+    return {key: {name: value if name == "rows" else round(value, 6) for name, value in total.items()} for key, total in totals.items()}
+
+def split_batch_by_day(batch, keep_days=None):
+    """Split a record batch by charge day, yielding (day, batch) for the days in keep_days (or every day)"""
+    days = charge_days(batch.column(CHARGE_PERIOD_COLUMN))
+    for day in pc.unique(days).to_pylist():
+        if keep_days is not None and day not in keep_days:
+            continue
+        yield day, batch.filter(pc.equal(days, day))
+
+def write_batches_by_billing_account(batches, schema, open_sink, profile=DEFAULT_OUTPUT_PROFILE, by_day=False, keep_days=None):
+    """Write record batches to one output per billing account
+
+    open_sink(billing_account_id, billing_profile) is called the first time an
+    account is seen and must return an open output stream; billing_account_id is
+    None for rows without a BillingAccountId. If the input has no rows, a single
+    empty file is written with no billing account. Only one batch is held in
+    memory at a time, plus one buffered row group per output if the profile sets
+    row_group_rows. Returns {(billing account ID, billing profile): rows written}.
+
+    With by_day, output is also split by ChargePeriodStart day: open_sink and the
+    returned keys get the YYYYMMDD day as a third value, and keep_days, if given,
+    maps each BillingAccountId value to the set of days to write. No empty file
+    is written in this mode. Every output stays open until the batches run out,
+    so callers should pass one day's rows at a time to bound memory.
+    """
+    output_names = schema.names
+    parsed_accounts = {}
+    writers = {}
+    rows_written = {}
+
+    with contextlib.ExitStack() as stack:
+        def writer_for(key):
+            if key not in writers:
+                sink = stack.enter_context(open_sink(*key))
+                writers[key] = stack.enter_context(ParquetOutputWriter(sink, schema, profile))
+                rows_written[key] = 0
+            return writers[key]
+
+        for batch in batches:
+            if BILLING_ACCOUNT_COLUMN in batch.schema.names:
+                with metrics.span("column_transform"):
+                    new_values = [v for v in pc.unique(batch.column(BILLING_ACCOUNT_COLUMN)).to_pylist() if v not in parsed_accounts]
+                    if new_values:
+                        parsed_accounts.update(parse_billing_account_paths(pa.array(new_values, type=pa.string())))
+
+            for value, account_batch in metrics.timed(split_batch_by_billing_account(batch, output_names), "column_transform"):
+                key = parsed_accounts.get(value, (None, None))
+                if not by_day:
+                    writer_for(key).write_batch(account_batch)
+                    rows_written[key] += account_batch.num_rows
+                    continue
+
+                account_days = keep_days.get(value, set()) if keep_days is not None else None
+                if account_days is not None and not account_days:
+                    continue
+                for day, day_batch in split_batch_by_day(account_batch, account_days):
+                    writer_for(key + (day,)).write_batch(day_batch)
+                    rows_written[key + (day,)] += day_batch.num_rows
+
+        if not writers and not by_day:
+            writer_for((None, None))
+
+    metrics.count("rows_out", sum(rows_written.values()))
+    for key, writer in writers.items():
+        logging.info(f"Encoded {writer.rows} rows for {key} into {writer.bytes_written} bytes in {writer.row_groups} row group(s) with {profile.compression} in {writer.encode_seconds:.3f}s")
+    return rows_written
@@ -1,12 +1,21 @@
 import azure.functions as func
 import logging
-from common import Config, getS3FileSystem, is_uuid, extract_subscription_ids_from_billing_scope, extract_billing_account_from_blob_path
-import pyarrow.parquet as pq
-import io
+import metrics
+from common import Config, BlobRangeReader, azure_clients, send_arm_request, load_json_blob, save_json_blob, getS3FileSystem, getS3Client, split_s3_path, open_s3_upload, extract_subscription_ids_from_billing_scope, query_resource_graph, RESOURCE_GRAPH_MAX_SUBSCRIPTIONS
+from carbon import fetch_monthly_summary_report
+from path_mapping import map_blob_path, parse_blob_path, parse_export_run, resolve_billing_account, is_daily_export, UNKNOWN_BILLING_ACCOUNT
 import json
-import requests
-from azure.storage.blob import BlobServiceClient
-from azure.identity import ManagedIdentityCredential
+import base64
+import calendar
+import contextlib
+import functools
+import hashlib
+import itertools
+import re
+import typing
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 
 app = func.FunctionApp()
@@ -18,9 +27,263 @@ logging.info(f"Number of billing accounts: {len(Config.billing_account_mapping)}
 for idx, account_id in Config.billing_account_mapping.items():
     logging.info(f"Export index {idx} -> Billing Account {account_id}")
 logging.info("====================================")
+logging.info(
+    f"Parquet output settings: compression={Config.parquet_compression} level={Config.parquet_compression_level} "
+    f"row_group_rows={Config.parquet_row_group_rows} dictionary_columns={Config.parquet_dictionary_columns} "
+    f"sort_columns={Config.parquet_sort_columns} statistics={Config.parquet_write_statistics} page_index={Config.parquet_write_page_index}"
+)
+
+# pyarrow and the parquet modules (focus, compaction) are imported inside the
+# functions that process parquet, so the timer and HTTP functions do not load them
+
+@functools.lru_cache(maxsize=None)
+def focus_output_profile():
+    """Return the encoding of the FOCUS parquet files written to S3, from the PARQUET_* settings"""
+    from focus import ParquetOutputProfile
+
+    return ParquetOutputProfile(
+        compression=Config.parquet_compression,
+        compression_level=Config.parquet_compression_level,
+        row_group_rows=Config.parquet_row_group_rows,
+        dictionary_columns=Config.parquet_dictionary_columns,
+        sort_columns=tuple(Config.parquet_sort_columns),
+        write_statistics=Config.parquet_write_statistics,
+        write_page_index=Config.parquet_write_page_index
+    )
+
+# Per-stage timings and counters, emitted once per invocation
+metrics.configure(Config.metrics_mode)
+
+def blob_name_from_event(message_body):
+    """Extract the blob name from an EventGrid BlobCreated message, or None if it has no usable subject"""
+    blob_url = message_body.get("subject")
+    if not blob_url:
+        logging.error(f"EventGrid message has no subject: {message_body}")
+        return None
+    
+    # Extract blob name from the subject (format: /blobServices/default/containers/{container}/blobs/{blobname})
+    blob_name = None
+    if blob_url.startswith("/blobServices/default/containers/"):
+        parts = blob_url.split("/blobs/", 1)
+        if len(parts) == 2:
+            blob_name = parts[1]
+    
+    if not blob_name:
+        logging.error(f"Could not extract blob name from message subject: {blob_url}")
+    return blob_name
+
+def focus_output_key(blob_name, billing_account_id=None, billing_profile=None, filename=None, day=None):
+    """Map a blob to the (relative S3 key, billing account folder) of one of its outputs
+
+    In incremental mode each charge day is written as its own object, with the
+    filename prefixed by day_YYYYMMDD_.
+    """
+    if day is not None:
+        filename = f"day_{day}_{filename or parse_blob_path(blob_name).filename}"
+    return map_blob_path(
+        blob_name,
+        billing_account_id=billing_account_id,
+        billing_profile=billing_profile,
+        billing_account_mapping=Config.billing_account_mapping,
+        filename=filename
+    )
+
+def focus_s3_path(relative_key):
+    return f"{Config.s3_focus_path.rstrip('/')}/{relative_key.lstrip('/')}"
+
+def focus_s3_sink_opener(blob_name, filename=None, written_keys=None):
+    """Return an open_sink callback for write_batches_by_billing_account
+
+    Each billing account's rows go to the flattened S3 path of blob_name, with
+    the original filename replaced by filename when given. The relative key of
+    each object opened is appended to written_keys when given.
+    """
+    def open_s3_sink(billing_account_id, billing_profile_from_data, day=None):
+        # Transform S3 path
+        # Example: gds-focus-v1/focus-daily-cost-export-0/20250801-20250831/202508150632/7a770e35-b455-4df2-a276-b07408438d9a/part_0_0001.parquet
+        # Becomes: gds-focus-v1/billing_period=20250801/billing-account-id-profile-id_profile-name_part_0_0001.parquet
+        with metrics.span("path_mapping"):
+            modified_path, billing_account_folder = focus_output_key(blob_name, billing_account_id, billing_profile_from_data, filename, day)
+        if billing_account_folder == UNKNOWN_BILLING_ACCOUNT:
+            logging.warning(f"Could not determine billing account folder for {blob_name}")
+        
+        if written_keys is not None:
+            written_keys.append(modified_path)
+        
+        # Construct S3 path with flattened structure
+        s3_path = focus_s3_path(modified_path)
+        logging.info(f"Uploading rows for billing account {billing_account_folder} to S3 at path: {s3_path}")
+        return open_s3_upload(s3_path)
+    
+    return open_s3_sink
+
+def delete_focus_object(s3, relative_key):
+    """Delete an object under S3_FOCUS_PATH, ignoring objects that are already gone"""
+    try:
+        # pyarrow filesystems take bucket/key paths without the s3:// scheme
+        s3.delete_file(focus_s3_path(relative_key).removeprefix("s3://"))
+        logging.info(f"Deleted obsolete S3 object: {relative_key}")
+    except FileNotFoundError:
+        pass
+
+# Blob prefix (in CONTAINER_NAME) holding the day fingerprints of parts written in incremental mode
+INCREMENTAL_STATE_PREFIX = "state/focus-incremental/"
+
+def incremental_state_blob(blob_name):
+    """Name the fingerprint state blob of a daily export part
+
+    The flattened key leaves out the export run's timestamp and ID, so each
+    day's MonthToDate run of the same part finds the previous run's state.
+    """
+    key, _ = map_blob_path(blob_name, billing_account_mapping=Config.billing_account_mapping)
+    return f"{INCREMENTAL_STATE_PREFIX}{key}.json"
+
+def write_changed_days(parquet_file, s3, blob_name):
+    """Write only the charge days of a daily export part whose rows changed since the previous run
+
+    Only ChargePeriodStart, BillingAccountId and the cost columns are read, one
+    batch at a time, to fingerprint each (billing account, day) and note which
+    row groups hold each day. The rest of the columns are only decoded if a day
+    changed, and then each changed day is written from just its row groups, as
+    day-level objects, before the next day is read. Only one day's outputs are
+    open at a time, so memory stays bounded like the streaming path; a part
+    whose days are spread across every row group is decoded once per changed
+    day. Objects for days that left the part, and the full month object from
+    before incremental mode was enabled, are deleted.
+    Returns (days written, days unchanged).
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from focus import read_column_names, output_schema, write_batches_by_billing_account, parse_billing_account_paths, charge_days, day_fingerprints, BILLING_ACCOUNT_COLUMN, CHARGE_PERIOD_COLUMN, FINGERPRINT_COST_COLUMNS
+
+    schema = parquet_file.schema_arrow
+    fingerprint_columns = [name for name in (CHARGE_PERIOD_COLUMN, BILLING_ACCOUNT_COLUMN) + FINGERPRINT_COST_COLUMNS if name in schema.names]
+    day_row_groups = {}
+
+    def fingerprint_batches():
+        for index in range(parquet_file.num_row_groups):
+            for batch in metrics.timed(parquet_file.iter_batches(batch_size=Config.parquet_batch_size, row_groups=[index], columns=fingerprint_columns), "parquet_decode"):
+                for day in pc.unique(charge_days(batch.column(CHARGE_PERIOD_COLUMN))).to_pylist():
+                    day_row_groups.setdefault(day, []).append(index)
+                yield batch
+
+    with metrics.span("column_transform"):
+        fingerprints = day_fingerprints(fingerprint_batches())
+    account_values = sorted({value for value, _ in fingerprints if value is not None})
+    parsed_accounts = parse_billing_account_paths(pa.array(account_values, type=pa.string()))
+
+    state_blob = incremental_state_blob(blob_name)
+    previous = load_json_blob(state_blob)
+    previous_objects = (previous or {}).get("objects", {})
+
+    current_objects = {}
+    changed_days = {}
+    for (value, day), fingerprint in fingerprints.items():
+        billing_account_id, billing_profile = parsed_accounts.get(value, (None, None))
+        key, _ = focus_output_key(blob_name, billing_account_id, billing_profile, day=day)
+        current_objects[key] = fingerprint
+        if previous_objects.get(key) != fingerprint:
+            changed_days.setdefault(value, set()).add(day)
+
+    for day in sorted({day for days in changed_days.values() for day in days}):
+        row_groups = sorted(set(day_row_groups[day]))
+        batches = metrics.timed(parquet_file.iter_batches(batch_size=Config.parquet_batch_size, row_groups=row_groups, columns=read_column_names(schema)), "parquet_decode")
+        keep_days = {value: {day} for value, days in changed_days.items() if day in days}
+        write_batches_by_billing_account(batches, output_schema(schema), focus_s3_sink_opener(blob_name), focus_output_profile(), by_day=True, keep_days=keep_days)
+
+    obsolete = set(previous_objects) - set(current_objects)
+    if previous is None:
+        obsolete.update(focus_output_key(blob_name, *parsed_accounts.get(value, (None, None)))[0] for value, _ in fingerprints)
+    for key in sorted(obsolete):
+        delete_focus_object(s3, key)
+
+    save_json_blob(state_blob, {"updated_at": datetime.now(timezone.utc).isoformat(), "objects": current_objects})
+
+    days_written = sum(len(days) for days in changed_days.values())
+    return days_written, len(fingerprints) - days_written
+
+@functools.lru_cache(maxsize=None)
+def incremental_state_exists():
+    """Check, once per instance, whether any incremental mode state is left in the storage container
+
+    Changing FOCUS_INCREMENTAL_MODE restarts the function app, so no new state
+    appears while an instance runs with the setting off.
+    """
+    container_client = azure_clients.container_client()
+    return next(iter(container_client.list_blobs(name_starts_with=INCREMENTAL_STATE_PREFIX, results_per_page=1)), None) is not None
+
+def remove_incremental_outputs(s3, blob_name):
+    """Delete the day-level objects of a daily export part after switching back to full month files"""
+    state_blob = incremental_state_blob(blob_name)
+    state = load_json_blob(state_blob)
+    if state is None:
+        return
+    
+    for key in sorted(state.get("objects", {})):
+        delete_focus_object(s3, key)
+    azure_clients.container_client().get_blob_client(state_blob).delete_blob()
+
+def process_cost_export_blob(blob_name, delete_source=True):
+    """Transform one FOCUS parquet part from the storage container and upload it to S3
+
+    This is the work of CostExportProcessor, shared with the replay command.
+    The source blob is deleted after a successful upload unless delete_source
+    is False. Returns the number of rows read from the part.
+    """
+    import pyarrow.parquet as pq
+    from focus import read_column_names, output_schema, write_batches_by_billing_account, CHARGE_PERIOD_COLUMN
+    
+    # Reuse the worker's pooled blob service client
+    container_client = azure_clients.container_client()
+    
+    # Get S3 filesystem
+    s3 = getS3FileSystem()
+    
+    # Open the blob for random access so only the footer and kept column chunks are downloaded
+    blob_client = container_client.get_blob_client(blob_name)
+    source = BlobRangeReader(blob_client)
+
+    try:
+        # Compute the kept column set once from the parquet footer
+        parquet_file = pq.ParquetFile(source, pre_buffer=Config.parquet_pre_buffer)
+        columns = read_column_names(parquet_file.schema_arrow)
+        logging.info(f"Reading {len(columns)} of {len(parquet_file.schema_arrow.names)} columns from {blob_name}")
+        metrics.count("rows_in", parquet_file.metadata.num_rows)
+        metrics.count("columns_dropped", len(parquet_file.schema_arrow.names) - len(columns))
+
+        daily_export = is_daily_export(blob_name)
+        if Config.focus_incremental_mode and daily_export and CHARGE_PERIOD_COLUMN in parquet_file.schema_arrow.names:
+            days_written, days_unchanged = write_changed_days(parquet_file, s3, blob_name)
+            logging.info(f"Incremental mode: wrote {days_written} changed day(s) from {blob_name}, skipped {days_unchanged} unchanged day(s)")
+        else:
+            # Decode only the needed columns, one record batch at a time, and stream each
+            # billing account's rows to its own S3 object
+            batches = metrics.timed(parquet_file.iter_batches(batch_size=Config.parquet_batch_size, columns=columns), "parquet_decode")
+            rows_written = write_batches_by_billing_account(batches, output_schema(parquet_file.schema_arrow), focus_s3_sink_opener(blob_name), focus_output_profile())
+            for (billing_account_id, billing_profile), rows in rows_written.items():
+                logging.info(f"Successfully uploaded {rows} rows from {blob_name} for billing account {billing_account_id} (profile: {billing_profile})")
+            
+            # Day-level objects from incremental mode would duplicate the full month file. Without
+            # any incremental state, skip the state blob lookup for every part
+            if daily_export and incremental_state_exists():
+                remove_incremental_outputs(s3, blob_name)
+
+        if delete_source:
+            # Delete source file after successful upload
+            with metrics.span("source_delete"):
+                blob_client.delete_blob()
+            logging.info(f"Successfully deleted source file: {blob_name}")
+        return parquet_file.metadata.num_rows
+        
+    except Exception as e:
+        logging.error(f"Failed to process {blob_name}: {str(e)}")
+        raise
+    finally:
+        source.close()
 
 @app.function_name(name="CostExportProcessor")
 @app.queue_trigger(arg_name="msg", queue_name="costdata", connection="StorageAccountManagedIdentity")
+@metrics.invocation("CostExportProcessor")
 def cost_export_processor(msg: func.QueueMessage) -> None:
     """Queue trigger function that processes parquet files when messages are received"""
     utc_timestamp = datetime.now(timezone.utc).isoformat()
@@ -31,20 +294,8 @@ def cost_export_processor(msg: func.QueueMessage) -> None:
     try:
         # Parse the EventGrid message to get the specific blob
         message_body = json.loads(msg.get_body().decode("utf-8"))
-        blob_url = message_body.get("subject")
-        if not blob_url:
-           # log an error
-           return
-        
-        # Extract blob name from the subject (format: /blobServices/default/containers/{container}/blobs/{blobname})
-        blob_name = None
-        if blob_url.startswith("/blobServices/default/containers/"):
-            parts = blob_url.split("/blobs/", 1)
-            if len(parts) == 2:
-                blob_name = parts[1]
-        
+        blob_name = blob_name_from_event(message_body)
         if not blob_name:
-            logging.error(f"Could not extract blob name from message subject: {blob_url}")
             return
             
         if not blob_name.endswith('.parquet'):
@@ -53,221 +304,265 @@ def cost_export_processor(msg: func.QueueMessage) -> None:
             
         logging.info(f"Processing specific parquet file: {blob_name}")
         
-        # Initialize blob service client
-        blob_service_client = BlobServiceClient.from_connection_string(Config.storage_connection_string)
-        container_client = blob_service_client.get_container_client(Config.container_name)
-        
-        # Get S3 filesystem
-        s3 = getS3FileSystem()
-        
         # Process the specific blob from the message
-        try:
-            # Download blob content
-            blob_client = container_client.get_blob_client(blob_name)
-            blob_data = blob_client.download_blob().readall()
-            blob_to_read = io.BytesIO(blob_data)
-            
-            # Read parquet table
-            table = pq.read_table(blob_to_read)
-            
-            ### Any deployment specific requirements can be implemented here ###
-            table = table.drop_columns("ResourceName")
-            
-            # Extract billing account ID before dropping it, for S3 path organization
-            billing_account_id = None
-            billing_profile_from_data = None
-            if "BillingAccountId" in table.column_names:
-                # Get the first BillingAccountId value to determine the billing account
-                billing_account_ids = table.select(["BillingAccountId"]).to_pylist()
-                if billing_account_ids:
-                    full_billing_path = billing_account_ids[0]["BillingAccountId"]
-                    logging.info(f"Found billing account path in data: {full_billing_path}")
-                    
-                    # Extract billing account ID and profile from the full path
-                    # Example: /providers/Microsoft.Billing/billingAccounts/bdfa614c-3bed-5e6d-313b-b4bfa3cefe1d:16e4ddda-0100-468b-a32c-abbfc29019d8_2019-05-31/billingProfiles/OC35-AR3W-BG7-PGB
-                    if "/providers/Microsoft.Billing/billingAccounts/" in full_billing_path:
-                        # Extract the part after billingAccounts/
-                        account_part = full_billing_path.split("/providers/Microsoft.Billing/billingAccounts/")[1]
-                        
-                        # Check if there's a billingProfiles part
-                        if "/billingProfiles/" in account_part:
-                            billing_account_id = account_part.split("/billingProfiles/")[0]
-                            billing_profile_from_data = account_part.split("/billingProfiles/")[1]
-                        else:
-                            billing_account_id = account_part
-                        
-                        logging.info(f"Extracted billing account ID: {billing_account_id}")
-                        if billing_profile_from_data:
-                            logging.info(f"Extracted billing profile from data: {billing_profile_from_data}")
-                    else:
-                        # Fallback: use the full path as billing account ID
-                        billing_account_id = full_billing_path
-                        logging.warning(f"Could not parse billing account path, using full path: {billing_account_id}")
+        process_cost_export_blob(blob_name)
             
-            table = table.drop_columns("BillingAccountId")
-            table = table.drop_columns("BillingAccountName")
-            table = table.drop_columns("BillingAccountType")
-            table = table.drop_columns("ChargeDescription")
-            table = table.drop_columns("CommitmentDiscountName")
-            table = table.drop_columns("RegionId")
-            table = table.drop_columns("ResourceId")
-            table = table.drop_columns("SubAccountId")
-            table = table.drop_columns("SubAccountName")
-            table = table.drop_columns("SubAccountType")
-            table = table.drop_columns("Tags")
-            
-            # Drop any columns that start with "x_"
-            columns_to_drop = [col for col in table.column_names if col.startswith("x_")]
-            if columns_to_drop:
-                table = table.drop_columns(columns_to_drop)
-            ### End of deployment specific requirements ###
+    except Exception as e:
+        logging.error(f"Error in daily cost export processor: {str(e)}")
+        raise
+
+# Queue that EventGrid BlobCreated messages for FOCUS exports are delivered to
+COST_DATA_QUEUE = "costdata"
+
+def decode_queue_message(content):
+    """Decode an EventGrid queue message, which may be plain or base64 encoded JSON"""
+    try:
+        return json.loads(content)
+    except ValueError:
+        return json.loads(base64.b64decode(content).decode("utf-8"))
+
+def group_cost_export_blobs(blob_sizes):
+    """Group blobs by target billing_period directory, billing account and export run, then into target-sized chunks
+
+    blob_sizes maps blob name to size in bytes. Returns a list of blob name lists,
+    each of which is coalesced into one S3 object per billing account. Every
+    chunk holds parts of a single export run.
+    """
+    groups = {}
+    for blob_name, size in blob_sizes.items():
+        parsed = parse_blob_path(blob_name)
+        billing_account_folder = resolve_billing_account(parsed, billing_account_mapping=Config.billing_account_mapping)
+        run = tuple(value or "" for value in parse_export_run(blob_name))
+        groups.setdefault((tuple(parsed.directory_parts), billing_account_folder, run), []).append(blob_name)
+    
+    chunks = []
+    for key in sorted(groups):
+        current, current_bytes = [], 0
+        for blob_name in sorted(groups[key]):
+            if current and current_bytes + blob_sizes[blob_name] > Config.coalesce_target_bytes:
+                chunks.append(current)
+                current, current_bytes = [], 0
+            current.append(blob_name)
+            current_bytes += blob_sizes[blob_name]
+        if current:
+            chunks.append(current)
+    return chunks
+
+# Blob prefix (in CONTAINER_NAME) recording the coalesced S3 objects written by each export run
+COALESCED_STATE_PREFIX = "state/focus-coalesced/"
+
+def coalesced_state_blob(blob_name):
+    """Name the state blob listing the coalesced outputs of a part's export, billing_period and billing account"""
+    parsed = parse_blob_path(blob_name)
+    billing_account_folder = resolve_billing_account(parsed, billing_account_mapping=Config.billing_account_mapping).replace(':', '-')
+    export = parse_export_run(blob_name).export or "export"
+    return f"{COALESCED_STATE_PREFIX}{'/'.join(parsed.directory_parts)}/{export}/{billing_account_folder}.json"
+
+def replace_previous_run_outputs(s3, blob_name):
+    """Make the export run of blob_name the current one for its coalesced outputs
+
+    Each coalesced output is named after the parts in its chunk, and a later
+    run of the same export groups its parts differently, so its outputs do not
+    overwrite the previous run's. The first chunk of a newer run deletes the
+    previous run's outputs instead. Returns (state blob, state), or (None, None)
+    if the part belongs to an older run than the recorded one, which has been
+    superseded and should not be written.
+    """
+    run = parse_export_run(blob_name)
+    run_key = f"{run.timestamp or ''}/{run.run_id or ''}"
+    state_blob = coalesced_state_blob(blob_name)
+    state = load_json_blob(state_blob, default={})
+    
+    if state.get("run", "") > run_key:
+        return None, None
+    if state.get("run") != run_key:
+        for key in sorted(state.get("objects", [])):
+            delete_focus_object(s3, key)
+        state = {"run": run_key, "objects": []}
+    return state_blob, state
+
+def coalesce_cost_export_blobs(container_client, blob_names):
+    """Stream several source parquet parts into one S3 object per billing account
+
+    The output filename is derived from the flattened source part names, so a
+    retried chunk overwrites its previous output. The outputs of each export
+    run are recorded in a state blob, and a newer run of the same export
+    deletes the previous run's outputs before writing its own (see
+    replace_previous_run_outputs), so MonthToDate reruns do not duplicate rows.
+    Returns the blob names that were read, or superseded by a newer run;
+    missing blobs (e.g. already processed) are skipped.
+    """
+    import pyarrow.parquet as pq
+    from azure.core.exceptions import ResourceNotFoundError
+    from focus import read_column_names, output_schema, write_batches_by_billing_account
+
+    sources = []
+    try:
+        files_by_schema = {}
+        for blob_name in blob_names:
+            try:
+                source = BlobRangeReader(container_client.get_blob_client(blob_name))
+            except ResourceNotFoundError:
+                logging.warning(f"Source blob no longer exists, skipping: {blob_name}")
+                continue
+            sources.append(source)
+            parquet_file = pq.ParquetFile(source, pre_buffer=Config.parquet_pre_buffer)
+            metrics.count("rows_in", parquet_file.metadata.num_rows)
             
-            # Transform S3 path
-            # Example: /7a770e35-b455-4df2-a276-b07408438d9a/gds-focus-v1/focus-backfill-2025-06/billing_period=20250601/providers/Microsoft.Billing/billingAccounts/billing-account-id:profile-id/billingProfiles/profile-name/part_0_0001.parquet
-            # Becomes: /7a770e35-b455-4df2-a276-b07408438d9a/gds-focus-v1/billing_period=20250601/billing-account-id:profile-id_profile-name_part_0_0001.parquet
-            path_parts = blob_name.split('/')
-            modified_parts = []
-            billing_account_path_part = None
-            billing_profile_path_part = None
+            # ParquetWriter needs a single schema, so parts are only combined with matching schemas
+            schema = output_schema(parquet_file.schema_arrow)
+            files_by_schema.setdefault(schema.to_string(), (schema, []))[1].append((blob_name, parquet_file))
+        
+        processed = []
+        s3 = getS3FileSystem()
+        for schema, members in files_by_schema.values():
+            member_names = [blob_name for blob_name, _ in members]
+            state_blob, state = replace_previous_run_outputs(s3, member_names[0])
+            if state is None:
+                logging.warning(f"Skipping {len(member_names)} parts of an export run superseded by a newer run, starting with {member_names[0]}")
+                processed.extend(member_names)
+                continue
             
-            # Find and extract billing account and profile info from path
-            i = 0
-            while i < len(path_parts):
-                part = path_parts[i]
-                    
-                if part == "focus-daily-cost-export" or part.startswith("focus-daily-cost-export-"):
-                    # Skip this part entirely
-                    i += 1
-                    continue
-                elif part.startswith("focus-backfill-"):
-                    # Skip focus-backfill-YYYY-MM directories
-                    logging.info(f"Skipping focus-backfill directory: {part}")
-                    i += 1
-                    continue
-                elif len(part) == 12 and part.isdigit():
-                    # Validate that this is actually a valid YYYYMMDDHHMM timestamp
-                    try:
-                        datetime.strptime(part, "%Y%m%d%H%M")
-                        logging.info(f"Skipping timestamp directory: {part}")
-                        i += 1
-                        continue
-                    except ValueError:
-                        # Not a valid timestamp, continue processing normally
-                        pass
-                elif "-" in part and len(part) == 17 and part[:8].isdigit() and part[9:17].isdigit():
-                    # Transform date range (e.g., "20250801-20250831" -> "billing_period=20250801")
-                    billing_period = part.split("-")[0]
-                    modified_parts.append(f"billing_period={billing_period}")
-                    i += 1
-                    continue
-                elif is_uuid(part):
-                    # Skip UUID directories - these should be flattened
-                    logging.info(f"Skipping UUID directory: {part}")
-                    i += 1
-                    continue
-                elif part == "providers":
-                    # Skip providers/Microsoft.Billing/billingAccounts structure and extract info
-                    if (i + 3 < len(path_parts) and 
-                        path_parts[i + 1] == "Microsoft.Billing" and 
-                        path_parts[i + 2] == "billingAccounts"):
-                        billing_account_path_part = path_parts[i + 3]
-                        logging.info(f"Found billing account in path: {billing_account_path_part}")
-                        # Skip providers, Microsoft.Billing, billingAccounts, and the billing account ID
-                        i += 4
-                        continue
-                    else:
-                        modified_parts.append(part)
-                        i += 1
-                        continue
-                elif part == "billingProfiles":
-                    # Extract billing profile name from next part
-                    if i + 1 < len(path_parts):
-                        billing_profile_path_part = path_parts[i + 1]
-                        logging.info(f"Found billing profile in path: {billing_profile_path_part}")
-                        # Skip billingProfiles and the profile name
-                        i += 2
-                        continue
-                    else:
-                        i += 1
-                        continue
-                else:
-                    modified_parts.append(part)
-                    i += 1
+            # Hash the flattened part keys, which leave out the export run's timestamp and ID
+            part_keys = [map_blob_path(blob_name, billing_account_mapping=Config.billing_account_mapping)[0] for blob_name in member_names]
+            digest = hashlib.sha1("\n".join(part_keys).encode("utf-8")).hexdigest()[:16]
+            filename = f"coalesced_{digest}.parquet"
             
-            # Determine billing account folder for S3 path organization
-            billing_account_folder = None
-            if billing_account_id:
-                # Use the billing account ID directly
-                billing_account_folder = billing_account_id
-                logging.info(f"Using billing account ID from data: {billing_account_folder}")
-            elif billing_account_path_part:
-                # Use the billing account ID from the path
-                billing_account_folder = billing_account_path_part
-                logging.info(f"Using billing account ID from path: {billing_account_folder}")
-            else:
-                # Fallback: try to extract from blob path structure
-                export_index = extract_billing_account_from_blob_path(blob_name)
-                if export_index is not None and str(export_index) in Config.billing_account_mapping:
-                    billing_account_folder = Config.billing_account_mapping[str(export_index)]
-                    logging.info(f"Mapped export index {export_index} to billing account: {billing_account_folder}")
-                else:
-                    logging.warning(f"Could not determine billing account folder for {blob_name}")
-                    billing_account_folder = "unknown-billing-account"
+            batches = (
+                batch
+                for _, parquet_file in members
+                for batch in metrics.timed(parquet_file.iter_batches(batch_size=Config.parquet_batch_size, columns=read_column_names(parquet_file.schema_arrow)), "parquet_decode")
+            )
+            written_keys = []
+            rows_written = write_batches_by_billing_account(batches, schema, focus_s3_sink_opener(member_names[0], filename=filename, written_keys=written_keys), focus_output_profile())
+            logging.info(f"Coalesced {len(member_names)} parts into {filename} ({sum(rows_written.values())} rows, {len(rows_written)} billing account(s))")
             
-            # Extract filename from the modified path and construct flattened filename
-            modified_path_parts = [part for part in modified_parts if part]  # Remove empty parts
+            state["objects"] = sorted(set(state["objects"]) | set(written_keys))
+            state["updated_at"] = datetime.now(timezone.utc).isoformat()
+            save_json_blob(state_blob, state)
+            processed.extend(member_names)
+        return processed
+    finally:
+        for source in sources:
+            source.close()
+
+@app.function_name(name="CostExportBatchProcessor")
+@app.timer_trigger(schedule="0 */5 * * * *", arg_name="timer", run_on_startup=False)
+@metrics.invocation("CostExportBatchProcessor")
+def cost_export_batch_processor(timer: func.TimerRequest) -> None:
+    """Timer trigger function that drains the cost data queue in batches when COST_EXPORT_BATCH_MODE is enabled
+
+    Parts are grouped by billing_period and billing account and written as fewer,
+    larger parquet objects. Source blobs are then removed with the Blob Batch API.
+    CostExportProcessor should be disabled in batch mode (the module sets
+    AzureWebJobs.CostExportProcessor.Disabled accordingly).
+    """
+    if not Config.cost_export_batch_mode:
+        return
+    
+    utc_timestamp = datetime.now(timezone.utc)
+    logging.info(f'Cost export batch processor triggered at: {utc_timestamp.isoformat()}')
+    
+    try:
+        queue_client = azure_clients.queue_client(COST_DATA_QUEUE)
+        container_client = azure_clients.container_client()
+        deadline = utc_timestamp + timedelta(minutes=Config.batch_max_runtime_minutes)
+        
+        while datetime.now(timezone.utc) < deadline:
+            messages = list(queue_client.receive_messages(
+                messages_per_page=32,
+                max_messages=Config.batch_max_messages,
+                visibility_timeout=int(Config.batch_max_runtime_minutes * 60) + 300
+            ))
+            if not messages:
+                break
             
-            if modified_path_parts:
-                # Get the original filename (last part)
-                original_filename = modified_path_parts[-1]
-                directory_parts = modified_path_parts[:-1]
+            # Map each parquet blob to the messages that reference it (EventGrid may deliver duplicates)
+            blob_sizes = {}
+            messages_by_blob = {}
+            for message in messages:
+                try:
+                    event = decode_queue_message(message.content)
+                    blob_name = blob_name_from_event(event)
+                except ValueError as e:
+                    logging.error(f"Could not decode queue message {message.id}: {str(e)}")
+                    blob_name = None
                 
-                # Construct flattened filename: billing_account_id_billing_profile_original_filename
-                filename_parts = []
-                if billing_account_folder:
-                    # Replace colons with dashes for filesystem compatibility
-                    safe_billing_account = billing_account_folder.replace(':', '-')
-                    filename_parts.append(safe_billing_account)
-                
-                # Prefer billing profile from data over path
-                billing_profile_to_use = billing_profile_from_data or billing_profile_path_part
-                if billing_profile_to_use:
-                    filename_parts.append(billing_profile_to_use)
-                
-                filename_parts.append(original_filename)
-                
-                flattened_filename = '_'.join(filename_parts)
-                logging.info(f"Flattened filename: {original_filename} -> {flattened_filename}")
+                if not blob_name or not blob_name.endswith('.parquet'):
+                    queue_client.delete_message(message)
+                    continue
                 
-                # Reconstruct path with flattened filename
-                if directory_parts:
-                    modified_path = '/'.join(directory_parts) + '/' + flattened_filename
-                else:
-                    modified_path = flattened_filename
-            else:
-                modified_path = '/'.join(modified_parts)
-                logging.warning(f"Could not extract filename from path parts: {modified_parts}")
+                blob_sizes[blob_name] = event.get("data", {}).get("contentLength") or 0
+                messages_by_blob.setdefault(blob_name, []).append(message)
             
-            # Construct S3 path with flattened structure
-            s3_path = f"{Config.s3_focus_path.rstrip('/')}/{modified_path.lstrip('/')}"
+            chunks = group_cost_export_blobs(blob_sizes)
+            logging.info(f"Received {len(messages)} messages for {len(blob_sizes)} parts, coalescing into {len(chunks)} chunk(s)")
             
-            pq.write_table(table, where=s3_path, filesystem=s3, compression='snappy')
-            logging.info(f"Successfully uploaded {blob_name} to S3 at path: {s3_path} (billing account: {billing_account_folder})")
+            for chunk in chunks:
+                try:
+                    processed = coalesce_cost_export_blobs(container_client, chunk)
+                    
+                    # Delete source files after successful upload, up to 256 per Blob Batch request
+                    with metrics.span("source_delete"):
+                        for i in range(0, len(processed), 256):
+                            container_client.delete_blobs(*processed[i:i + 256])
+                    logging.info(f"Successfully deleted {len(processed)} source files")
+                    
+                    for blob_name in chunk:
+                        for message in messages_by_blob[blob_name]:
+                            queue_client.delete_message(message)
+                            
+                except Exception as e:
+                    # Messages become visible again after the visibility timeout and are retried
+                    logging.error(f"Failed to coalesce chunk starting with {chunk[0]}: {str(e)}")
+        
+    except Exception as e:
+        logging.error(f"Error in cost export batch processor: {str(e)}")
+        raise
 
-            # Delete source file after successful upload
-            blob_client.delete_blob()
-            logging.info(f"Successfully deleted source file: {blob_name}")
-            
-        except Exception as e:
-            logging.error(f"Failed to process {blob_name}: {str(e)}")
-            raise
-            
+@app.function_name(name="FocusPartitionCompactor")
+@app.timer_trigger(schedule="0 0 4 * * *", arg_name="timer", run_on_startup=False)
+@metrics.invocation("FocusPartitionCompactor")
+def focus_partition_compactor(timer: func.TimerRequest) -> None:
+    """Timer trigger function that compacts closed billing_period partitions daily at 4 AM when S3_COMPACTION_ENABLED is set
+
+    Each billing account's part files in a partition are rewritten into files of
+    about COMPACTION_TARGET_BYTES. Each compacted file is recorded in the
+    partition's _manifest.json and then its sources are deleted, so queries
+    briefly see both (see compaction.py). Partitions that are already compact
+    are skipped, and a partition is only touched once its billing period ended
+    COMPACTION_MIN_AGE_DAYS ago.
+    """
+    if not Config.s3_compaction_enabled:
+        return
+    
+    utc_timestamp = datetime.now(timezone.utc)
+    logging.info(f'FOCUS partition compactor triggered at: {utc_timestamp.isoformat()}')
+    
+    try:
+        from compaction import compact_partitions
+        
+        s3 = getS3FileSystem()
+        results = compact_partitions(
+            s3,
+            Config.s3_focus_path,
+            min_age_days=Config.compaction_min_age_days,
+            target_bytes=Config.compaction_target_bytes,
+            profile=focus_output_profile()._replace(row_group_rows=Config.compaction_row_group_rows),
+            deadline=utc_timestamp + timedelta(minutes=Config.compaction_max_runtime_minutes),
+            batch_size=Config.parquet_batch_size
+        )
+        files_before = sum(r["files_before"] for r in results.values())
+        files_after = sum(r["files_after"] for r in results.values())
+        logging.info(f"Compacted {len(results)} partitions from {files_before} to {files_after} files")
+        
     except Exception as e:
-        logging.error(f"Error in daily cost export processor: {str(e)}")
+        logging.error(f"Error in FOCUS partition compactor: {str(e)}")
         raise
 
 @app.function_name(name="AdvisorRecommendationsExporter")
 @app.timer_trigger(schedule="0 0 2 * * *", arg_name="timer", run_on_startup=False)
+@metrics.invocation("AdvisorRecommendationsExporter")
 def advisor_recommendations_exporter(timer: func.TimerRequest) -> None:
     """Timer trigger function that exports Azure Advisor cost recommendations daily at 2 AM"""
     utc_timestamp = datetime.now(timezone.utc).isoformat()
@@ -278,77 +573,28 @@ def advisor_recommendations_exporter(timer: func.TimerRequest) -> None:
         logging.info('The timer is past due!')
 
     try:
-        # Get access token using managed identity
-        credential = ManagedIdentityCredential()
-        token = credential.get_token("https://management.azure.com/.default")
-        
-        headers = {
-            "Authorization": f"Bearer {token.token}",
-            "Content-Type": "application/json"
-        }
-        
-        # Extract subscription IDs from billing scope
-        subscription_ids = extract_subscription_ids_from_billing_scope(Config.billing_scope)
-        
-        logging.info(f"Fetching cost recommendations for {len(subscription_ids)} subscriptions")
-        
-        all_recommendations = []
-        
-        # Fetch cost recommendations for each subscription
-        for subscription_id in subscription_ids:
-            try:
-                logging.info(f"Fetching cost recommendations for subscription: {subscription_id}")
-                
-                # Azure Advisor Recommendations API endpoint
-                api_url = f"https://management.azure.com/subscriptions/{subscription_id}/providers/Microsoft.Advisor/recommendations"
-                api_version = "2025-01-01"
-                
-                # Filter for cost category recommendations only
-                params = {
-                    "api-version": api_version,
-                    "$filter": "Category eq 'Cost'"
-                }
-                
-                logging.info(f"Calling API: {api_url} with params: {params}")
-                
-                response = requests.get(
-                    api_url,
-                    headers=headers,
-                    params=params,
-                    timeout=300
-                )
-                
-                logging.info(f"API Response Status: {response.status_code}")
-                
-                if response.status_code == 200:
-                    recommendations_data = response.json()
-                    recommendations = recommendations_data.get("value", [])
-                    
-                    logging.info(f"Raw API response for subscription {subscription_id}: {recommendations_data}")
-                    
-                    # Add subscription ID to each recommendation for tracking
-                    for rec in recommendations:
-                        rec["subscriptionId"] = subscription_id
-                    
-                    all_recommendations.extend(recommendations)
-                    logging.info(f"Retrieved {len(recommendations)} cost recommendations for subscription {subscription_id}")
-                    
-                else:
-                    logging.error(f"Failed to fetch recommendations for subscription {subscription_id}: {response.status_code}")
-                    logging.error(f"Response text: {response.text}")
-                    logging.error(f"Response headers: {dict(response.headers)}")
-                    
-            except Exception as e:
-                logging.error(f"Error fetching recommendations for subscription {subscription_id}: {str(e)}")
-                continue
+        if Config.advisor_engine == "resource_graph":
+            # One paged Resource Graph query per management group (or subscription chunk)
+            source = f"billing scope {Config.billing_scope}"
+            recommendations = iter_recommendations_via_resource_graph(Config.billing_scope)
+        else:
+            # Extract subscription IDs from billing scope, sorted so the output order is deterministic
+            subscription_ids = sorted(extract_subscription_ids_from_billing_scope(Config.billing_scope))
+            source = f"{len(subscription_ids)} subscriptions"
+            
+            logging.info(f"Fetching cost recommendations for {len(subscription_ids)} subscriptions with concurrency {Config.advisor_max_concurrency}")
+            
+            # Fetch recommendations concurrently and stream them to S3 as they arrive
+            recommendations = iter_recommendations_concurrently(subscription_ids)
+        first_recommendation = next(recommendations, None)
         
-        if all_recommendations:
+        if first_recommendation is not None:
             # Save recommendations to S3
             current_date = datetime.now(timezone.utc)
             file_name = f"advisor-cost-recommendations-{current_date.strftime('%Y-%m-%d')}.json"
-            save_recommendations_to_s3({"value": all_recommendations}, file_name)
+            exported_count = save_recommendations_to_s3(itertools.chain([first_recommendation], recommendations), file_name)
             
-            logging.info(f"Successfully exported {len(all_recommendations)} cost recommendations from {len(subscription_ids)} subscriptions")
+            logging.info(f"Successfully exported {exported_count} cost recommendations from {source}")
         else:
             logging.warning("No cost recommendations found across all subscriptions")
             
@@ -356,8 +602,53 @@ def advisor_recommendations_exporter(timer: func.TimerRequest) -> None:
         logging.error(f"Error in Azure Advisor recommendations exporter: {str(e)}")
         raise
 
+def utilization_s3_path(day):
+    """Return the S3 path of a day's utilization file, partitioned by billing period like the FOCUS data"""
+    billing_period = day.strftime("%Y%m01")
+    return f"{Config.s3_utilization_path.rstrip('/')}/gds-utilization-v1/billing_period={billing_period}/utilization-{day.strftime('%Y-%m-%d')}.parquet"
+
+@app.function_name(name="UtilizationExporter")
+@app.timer_trigger(schedule="0 0 3 * * *", arg_name="timer", run_on_startup=False)
+@metrics.invocation("UtilizationExporter")
+def utilization_exporter(timer: func.TimerRequest) -> None:
+    """Timer trigger function that exports the previous day's compute utilization metrics daily at 3 AM
+
+    CPU, memory and disk metrics for virtual machines and scale sets are fetched
+    with the Azure Monitor batch metrics API and written as one parquet file per
+    day to S3_UTILIZATION_PATH.
+    """
+    utc_timestamp = datetime.now(timezone.utc)
+    
+    logging.info(f'Utilization exporter triggered at: {utc_timestamp.isoformat()}')
+    
+    if timer.past_due:
+        logging.info('The timer is past due!')
+
+    try:
+        from utilization import list_compute_resources, write_utilization
+        
+        end = utc_timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+        start = end - timedelta(days=1)
+        
+        subscription_ids = sorted(extract_subscription_ids_from_billing_scope(Config.billing_scope))
+        resources = list_compute_resources(subscription_ids)
+        if not resources:
+            logging.warning(f"No compute resources found across {len(subscription_ids)} subscriptions")
+            return
+        
+        s3_path = utilization_s3_path(start)
+        with open_s3_upload(s3_path) as sink:
+            summary = write_utilization(resources, start, end, sink)
+        
+        logging.info(f"Successfully exported utilization metrics for {start.strftime('%Y-%m-%d')} to S3: {s3_path} {summary}")
+        
+    except Exception as e:
+        logging.error(f"Error in utilization exporter: {str(e)}")
+        raise
+
 @app.function_name(name="CarbonEmissionsExporter")
 @app.timer_trigger(schedule="0 0 20 * *", arg_name="timer", run_on_startup=False)
+@metrics.invocation("CarbonEmissionsExporter")
 def carbon_emissions_exporter(timer: func.TimerRequest) -> None:
     """Timer trigger function that exports carbon emissions data monthly on the 20th
     
@@ -393,15 +684,11 @@ def carbon_emissions_exporter(timer: func.TimerRequest) -> None:
         
         logging.info(f'Exporting carbon data for period: {start_date} to {end_date} (within API range 2024-06-01 to 2025-06-01)')
         
-        # Get access token using managed identity
-        credential = ManagedIdentityCredential()
-        token = credential.get_token("https://management.azure.com/.default")
-        
-        # Prepare the API request
-        headers = {
-            "Authorization": f"Bearer {token.token}",
-            "Content-Type": "application/json"
-        }
+        # Skip the Carbon API if the month is already in S3 and was written after its data was final
+        month = last_month.strftime('%Y-%m')
+        if not Config.carbon_force_export and carbon_month_is_exported(carbon_output_index(month), month):
+            logging.info(f"Carbon emissions for {month} are already exported, skipping (set CARBON_FORCE_EXPORT to re-export)")
+            return
         
         # Extract subscription IDs from billing scope
         subscription_ids = extract_subscription_ids_from_billing_scope(Config.billing_scope)
@@ -412,99 +699,225 @@ def carbon_emissions_exporter(timer: func.TimerRequest) -> None:
         if len(subscription_ids) > 10:
             logging.info(f"... and {len(subscription_ids) - 10} more subscriptions")
         
-        # Call Carbon Optimization API for MonthlySummaryReport
-        api_url = "https://management.azure.com/providers/Microsoft.Carbon/carbonEmissionReports"
-        api_version = "2025-04-01"
-        
-        request_data = {
-            "reportType": "MonthlySummaryReport",
-            "subscriptionList": subscription_ids,
-            "carbonScopeList": ["Scope1", "Scope3"],
-            "dateRange": {
-                "start": start_date,
-                "end": start_date
-            }
-        }
-        
-        # Log the full request payload (excluding sensitive headers)
-        logging.info(f"Carbon API request URL: {api_url}?api-version={api_version}")
-        logging.info(f"Carbon API request payload: {json.dumps(request_data, indent=2)}")
+        # Call Carbon Optimization API for MonthlySummaryReport in chunks and merge the results
+        emissions_data = fetch_monthly_summary_report(subscription_ids, start_date)
         
-        response = requests.post(
-            f"{api_url}?api-version={api_version}",
-            headers=headers,
-            json=request_data,
-            timeout=300
-        )
+        # Log response details for confirmation
+        logging.info(f"Carbon API response received successfully")
+        logging.info(f"Response data structure: {json.dumps(emissions_data, indent=2)[:1000]}...")  # First 1000 chars
         
-        if response.status_code == 200:
-            emissions_data = response.json()
-            
-            # Log response details for confirmation
-            logging.info(f"Carbon API response received successfully")
-            logging.info(f"Response data structure: {json.dumps(emissions_data, indent=2)[:1000]}...")  # First 1000 chars
-            
-            if 'value' in emissions_data and len(emissions_data['value']) > 0:
-                first_record = emissions_data['value'][0]
-                logging.info(f"First record - Date: {first_record.get('date')}, Emissions: {first_record.get('latestMonthEmissions')}, Data Type: {first_record.get('dataType')}")
-                logging.info(f"Total records in response: {len(emissions_data['value'])}")
-            else:
-                logging.warning("No data found in Carbon API response")
-            
-            # Save to storage and upload to S3
-            file_name = f"carbon-emissions-{last_month.strftime('%Y-%m')}.json"
-            save_carbon_data_to_s3(emissions_data, file_name)
-            
-            logging.info(f"Successfully exported carbon emissions data for {start_date} to {end_date}")
-            
+        if 'value' in emissions_data and len(emissions_data['value']) > 0:
+            first_record = emissions_data['value'][0]
+            logging.info(f"First record - Date: {first_record.get('date')}, Emissions: {first_record.get('latestMonthEmissions')}, Data Type: {first_record.get('dataType')}")
+            logging.info(f"Total records in response: {len(emissions_data['value'])}")
         else:
-            logging.error(f"Carbon API request failed with status {response.status_code}: {response.text}")
-            logging.error(f"Request headers (auth redacted): Content-Type: {headers.get('Content-Type')}")
-            logging.error(f"Request was for {len(subscription_ids)} subscriptions")
+            logging.warning("No data found in Carbon API response")
+        
+        # Save to storage and upload to S3
+        file_name = f"carbon-emissions-{last_month.strftime('%Y-%m')}.json"
+        save_carbon_data_to_s3(emissions_data, file_name)
+        
+        logging.info(f"Successfully exported carbon emissions data for {start_date} to {end_date}")
             
     except Exception as e:
         logging.error(f"Error in carbon emissions exporter: {str(e)}")
         raise
 
+# Name of the carbon files written by save_carbon_data_to_s3, capturing the month and format
+CARBON_FILE_PATTERN = re.compile(r"carbon-emissions-(\d{4}-\d{2})\.(json|parquet)$")
+
+def carbon_output_index(month=None):
+    """List the carbon files already in S3 as {YYYY-MM: {format: {"key", "etag", "last_modified", "size"}}}
+
+    A single paginated listing of the carbon prefix (or of one month's
+    billing_period= partition), so deciding which months still need the Carbon
+    API costs one S3 request per 1000 files.
+    """
+    prefix = f"{Config.s3_carbon_path.rstrip('/')}/{Config.carbon_directory_name}/"
+    if month:
+        prefix += f"billing_period={month.replace('-', '')}01/"
+    bucket, key_prefix = split_s3_path(prefix)
+    
+    index = {}
+    for page in getS3Client().get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=key_prefix):
+        for obj in page.get("Contents", []):
+            match = CARBON_FILE_PATTERN.search(obj["Key"])
+            if match:
+                index.setdefault(match.group(1), {})[match.group(2)] = {
+                    "key": obj["Key"],
+                    "etag": obj["ETag"].strip('"'),
+                    "last_modified": obj["LastModified"],
+                    "size": obj["Size"]
+                }
+    return index
+
+def carbon_month_final_at(month):
+    """Return when a YYYY-MM month's emissions are final: CARBON_DATA_FINAL_DAY of the following month
+
+    A day past the end of the following month (e.g. 30 for February) means its last day.
+    """
+    month_date = datetime.strptime(month, "%Y-%m").replace(tzinfo=timezone.utc)
+    next_month = (month_date + timedelta(days=32)).replace(day=1)
+    last_day = calendar.monthrange(next_month.year, next_month.month)[1]
+    return next_month.replace(day=min(Config.carbon_data_final_day, last_day))
+
+def carbon_month_is_exported(index, month):
+    """Check that every CARBON_OUTPUT_FORMAT file of a month is in the index and was written after the month's data was final"""
+    files = index.get(month, {})
+    final_at = carbon_month_final_at(month)
+    return all(
+        output_format in files and files[output_format]["last_modified"] >= final_at
+        for output_format in Config.carbon_output_formats
+    )
+
+# Carbon backfill covers every month from BACKFILL_START up to (but excluding) CARBON_API_END.
+# Months before CARBON_API_START are outside the Carbon API range and get an empty record.
+CARBON_BACKFILL_START = (2022, 1)
+CARBON_API_START = (2024, 6)
+CARBON_API_END = (2025, 6)
+
+# Blob prefixes (in CONTAINER_NAME) for backfill job manifests and per-job, per-month checkpoints
+CARBON_BACKFILL_JOBS_PREFIX = "jobs/carbon-backfill/"
+CARBON_BACKFILL_CHECKPOINT_PREFIX = "checkpoints/carbon-backfill/"
+
+def carbon_backfill_months():
+    """Return every month covered by the carbon backfill as YYYY-MM strings"""
+    months = []
+    current_year, current_month = CARBON_BACKFILL_START
+    while (current_year, current_month) < CARBON_API_END:
+        months.append(f"{current_year:04d}-{current_month:02d}")
+        
+        # Move to next month
+        if current_month == 12:
+            current_year += 1
+            current_month = 1
+        else:
+            current_month += 1
+    return months
+
+def carbon_backfill_checkpoint_blob(job_id, month):
+    """Name the checkpoint blob a backfill job's worker writes once it has processed a YYYY-MM month"""
+    return f"{CARBON_BACKFILL_CHECKPOINT_PREFIX}{job_id}/{month}.json"
+
+def completed_carbon_backfill_months(job_id):
+    """Return the set of YYYY-MM months that a backfill job's workers have processed
+
+    Checkpoints are kept per job, so months written by an earlier job are not
+    counted before this job's worker has processed them.
+    """
+    container_client = azure_clients.container_client()
+    prefix = f"{CARBON_BACKFILL_CHECKPOINT_PREFIX}{job_id}/"
+    return {
+        blob.name[len(prefix):].removesuffix(".json")
+        for blob in container_client.list_blobs(name_starts_with=prefix)
+    }
+
 @app.function_name(name="CarbonEmissionsBackfill")
 @app.route(route="carbon-backfill", auth_level=func.AuthLevel.FUNCTION)
-def carbon_emissions_backfill(req: func.HttpRequest) -> func.HttpResponse:
-    """HTTP trigger function for carbon emissions backfill from 2022-01-01"""
+@app.queue_output(arg_name="work_items", queue_name="carbonbackfill", connection="StorageAccountManagedIdentity")
+def carbon_emissions_backfill(req: func.HttpRequest, work_items: func.Out[typing.List[str]]) -> func.HttpResponse:
+    """HTTP trigger function that starts a carbon emissions backfill from 2022-01-01
+
+    Enqueues one work item per month that is missing or stale in S3 (see
+    carbon_month_is_exported), or every month with ?force=true, and returns
+    immediately with a job id. Progress is available from the carbon-backfill/{job_id}
+    status endpoint.
+    """
     utc_timestamp = datetime.now(timezone.utc).isoformat()
     
     logging.info(f'Carbon emissions backfill triggered at: {utc_timestamp}')
     
     try:
-        # Get access token using managed identity
-        credential = ManagedIdentityCredential()
-        token = credential.get_token("https://management.azure.com/.default")
+        job_id = str(uuid.uuid4())
+        force = req.params.get("force", "").lower() == "true"
         
-        headers = {
-            "Authorization": f"Bearer {token.token}",
-            "Content-Type": "application/json"
-        }
+        # Only enqueue months that are missing or stale in S3, unless forced
+        months = carbon_backfill_months()
+        index = {} if force else carbon_output_index()
+        pending_months = [month for month in months if not carbon_month_is_exported(index, month)]
         
-        # Extract subscription IDs from billing scope
-        subscription_ids = extract_subscription_ids_from_billing_scope(Config.billing_scope)
+        save_json_blob(f"{CARBON_BACKFILL_JOBS_PREFIX}{job_id}.json", {
+            "job_id": job_id,
+            "created_at": utc_timestamp,
+            "force": force,
+            "months": pending_months
+        })
         
-        logging.info(f"Starting carbon backfill for {len(subscription_ids)} subscriptions")
+        work_items.set([json.dumps({"job_id": job_id, "month": month, "force": force}) for month in pending_months])
         
-        # API available range: 2024-06-01 to 2025-06-01, but we'll process from 2022-01
-        # Generate months from 2022-01 to 2024-05 (before API range)
-        start_year, start_month = 2022, 1
-        api_start_year, api_start_month = 2024, 6
+        logging.info(f"Carbon backfill job {job_id} enqueued {len(pending_months)} months ({len(months) - len(pending_months)} already exported, force={force})")
         
-        current_year, current_month = start_year, start_month
-        processed_months = 0
+        return func.HttpResponse(
+            json.dumps({
+                "job_id": job_id,
+                "enqueued_months": len(pending_months),
+                "already_completed_months": len(months) - len(pending_months),
+                "status_url": f"/api/carbon-backfill/{job_id}"
+            }),
+            status_code=202,
+            mimetype="application/json"
+        )
         
-        while (current_year, current_month) < (api_start_year, api_start_month):
-            month_date = datetime(current_year, current_month, 1, tzinfo=timezone.utc)
-            month_str = month_date.strftime("%Y-%m-01")
-            
+    except Exception as e:
+        error_msg = f"Error in carbon emissions backfill: {str(e)}"
+        logging.error(error_msg)
+        return func.HttpResponse(
+            error_msg,
+            status_code=500
+        )
+
+@app.function_name(name="CarbonEmissionsBackfillStatus")
+@app.route(route="carbon-backfill/{job_id}", methods=["GET"], auth_level=func.AuthLevel.FUNCTION)
+def carbon_emissions_backfill_status(req: func.HttpRequest) -> func.HttpResponse:
+    """HTTP trigger function that reports the progress of a carbon emissions backfill job"""
+    job_id = req.route_params.get("job_id")
+    
+    job = load_json_blob(f"{CARBON_BACKFILL_JOBS_PREFIX}{job_id}.json")
+    if job is None:
+        return func.HttpResponse(f"Carbon backfill job not found: {job_id}", status_code=404)
+    
+    completed_months = completed_carbon_backfill_months(job_id)
+    remaining_months = [month for month in job["months"] if month not in completed_months]
+    
+    return func.HttpResponse(
+        json.dumps({
+            "job_id": job_id,
+            "created_at": job["created_at"],
+            "status": "completed" if not remaining_months else "running",
+            "total_months": len(job["months"]),
+            "completed_months": len(job["months"]) - len(remaining_months),
+            "remaining_months": remaining_months
+        }),
+        status_code=200,
+        mimetype="application/json"
+    )
+
+@app.function_name(name="CarbonEmissionsBackfillWorker")
+@app.queue_trigger(arg_name="msg", queue_name="carbonbackfill", connection="StorageAccountManagedIdentity")
+@metrics.invocation("CarbonEmissionsBackfillWorker")
+def carbon_emissions_backfill_worker(msg: func.QueueMessage) -> None:
+    """Queue trigger function that backfills carbon emissions data for a single month
+
+    Instances scale out per queue message, so months are processed in parallel.
+    Failures are raised so the message is retried by the queue.
+    """
+    work_item = json.loads(msg.get_body().decode("utf-8"))
+    job_id = work_item["job_id"]
+    month_date = datetime.strptime(work_item["month"], "%Y-%m").replace(tzinfo=timezone.utc)
+    month_str = month_date.strftime("%Y-%m-01")
+    file_name = f"carbon-emissions-{month_date.strftime('%Y-%m')}.json"
+    
+    try:
+        emissions_data = None
+        
+        # A retried or duplicate message may find the month already written
+        if not work_item.get("force", False) and carbon_month_is_exported(carbon_output_index(work_item["month"]), work_item["month"]):
+            logging.info(f"Carbon emissions for {work_item['month']} are already exported, skipping")
+        elif (month_date.year, month_date.month) < CARBON_API_START:
             logging.info(f"Processing month: {month_str} (outside API range - will create empty record)")
             
             # Create empty carbon data for months outside API range
-            empty_emissions_data = {
+            emissions_data = {
                 "value": [{
                     "dataType": "MonthlySummaryData",
                     "date": month_str,
@@ -516,142 +929,233 @@ def carbon_emissions_backfill(req: func.HttpRequest) -> func.HttpResponse:
                     "note": "Data not available via API for this period"
                 }]
             }
-            
-            file_name = f"carbon-emissions-{month_date.strftime('%Y-%m')}.json"
-            save_carbon_data_to_s3(empty_emissions_data, file_name)
-            processed_months += 1
-            
-            # Move to next month
-            if current_month == 12:
-                current_year += 1
-                current_month = 1
-            else:
-                current_month += 1
-        
-        # Now process months within API range (2024-06 to 2025-05)
-        current_year, current_month = api_start_year, api_start_month
-        api_end_year, api_end_month = 2025, 6  # API goes up to 2025-06-01
-        
-        while (current_year, current_month) < (api_end_year, api_end_month):
-            month_date = datetime(current_year, current_month, 1, tzinfo=timezone.utc)
-            month_str = month_date.strftime("%Y-%m-01")
-            
+        else:
             logging.info(f"Processing month: {month_str} (within API range)")
             
-            # Call Carbon Optimization API
-            api_url = "https://management.azure.com/providers/Microsoft.Carbon/carbonEmissionReports"
-            api_version = "2025-04-01"
-            
-            request_data = {
-                "reportType": "MonthlySummaryReport",
-                "subscriptionList": subscription_ids,
-                "carbonScopeList": ["Scope1", "Scope3"],
-                "dateRange": {
-                    "start": month_str,
-                    "end": month_str
-                }
-            }
+            # Extract subscription IDs from billing scope (cached after the first worker)
+            subscription_ids = extract_subscription_ids_from_billing_scope(Config.billing_scope)
             
-            response = requests.post(
-                f"{api_url}?api-version={api_version}",
-                headers=headers,
-                json=request_data,
-                timeout=300
-            )
-            
-            if response.status_code == 200:
-                emissions_data = response.json()
-                file_name = f"carbon-emissions-{month_date.strftime('%Y-%m')}.json"
-                save_carbon_data_to_s3(emissions_data, file_name)
-                processed_months += 1
-                logging.info(f"Successfully processed {month_str}")
-            else:
-                logging.error(f"API request failed for {month_str}: {response.status_code} - {response.text}")
-            
-            # Move to next month
-            if current_month == 12:
-                current_year += 1
-                current_month = 1
-            else:
-                current_month += 1
+            # Call Carbon Optimization API in chunks and merge the results
+            emissions_data = fetch_monthly_summary_report(subscription_ids, month_str)
         
-        logging.info(f"Carbon backfill completed. Processed {processed_months} months total.")
+        if emissions_data is not None:
+            save_carbon_data_to_s3(emissions_data, file_name)
         
-        return func.HttpResponse(
-            f"Carbon backfill completed successfully. Processed {processed_months} months.",
-            status_code=200
-        )
+        # Checkpoint the month so the job's status counts it as completed
+        save_json_blob(carbon_backfill_checkpoint_blob(job_id, month_date.strftime("%Y-%m")), {
+            "job_id": job_id,
+            "completed_at": datetime.now(timezone.utc).isoformat()
+        })
+        
+        logging.info(f"Successfully processed {month_str} for carbon backfill job {job_id}")
         
     except Exception as e:
-        error_msg = f"Error in carbon emissions backfill: {str(e)}"
-        logging.error(error_msg)
-        return func.HttpResponse(
-            error_msg,
-            status_code=500
-        )
+        logging.error(f"Error in carbon emissions backfill worker for {month_str}: {str(e)}")
+        raise
 
-def sanitize_recommendations_data(data):
-    """Remove sensitive data from recommendations for security reasons"""
-    if not isinstance(data, dict) or "value" not in data:
-        return data
+def iter_subscription_recommendations(subscription_id):
+    """Yield Azure Advisor cost recommendations for a single subscription, following nextLink pages"""
+    # Azure Advisor Recommendations API endpoint
+    api_url = f"{Config.arm_endpoint}/subscriptions/{subscription_id}/providers/Microsoft.Advisor/recommendations"
+    api_version = "2025-01-01"
     
-    sanitized_data = data.copy()
-    sanitized_recommendations = []
+    # Filter for cost category recommendations only
+    params = {
+        "api-version": api_version,
+        "$filter": "Category eq 'Cost'"
+    }
     
-    for recommendation in data.get("value", []):
-        sanitized_rec = recommendation.copy()
+    page = 0
+    while api_url:
+        page += 1
+        logging.info(f"Calling API: {api_url} with params: {params} (page {page})")
         
-        # Remove impactedValue from properties
-        if "properties" in sanitized_rec and "impactedValue" in sanitized_rec["properties"]:
-            del sanitized_rec["properties"]["impactedValue"]
+        response = send_arm_request("GET", api_url, params=params, timeout=300)
         
-        # Remove resourceMetadata object entirely
-        if "properties" in sanitized_rec and "resourceMetadata" in sanitized_rec["properties"]:
-            del sanitized_rec["properties"]["resourceMetadata"]
+        logging.info(f"API Response Status: {response.status_code}")
         
-        sanitized_recommendations.append(sanitized_rec)
-    
-    sanitized_data["value"] = sanitized_recommendations
-    return sanitized_data
+        if response.status_code != 200:
+            logging.error(f"Failed to fetch recommendations for subscription {subscription_id}: {response.status_code}")
+            logging.error(f"Response text: {response.text}")
+            logging.error(f"Response headers: {dict(response.headers)}")
+            return
+        
+        recommendations_data = response.json()
+        logging.debug(f"Raw API response for subscription {subscription_id}: {recommendations_data}")
+        
+        for rec in recommendations_data.get("value", []):
+            # Add subscription ID to each recommendation for tracking
+            rec["subscriptionId"] = subscription_id
+            yield rec
+        
+        # nextLink already carries the api-version and filter query parameters
+        api_url = recommendations_data.get("nextLink")
+        params = None
 
-def save_recommendations_to_s3(data, file_name):
-    """Save Azure Advisor recommendations data to S3"""
+def fetch_subscription_recommendations(subscription_id):
+    """Fetch all Azure Advisor cost recommendations for a single subscription"""
     try:
-        # Sanitize data before saving to remove sensitive information
-        sanitized_data = sanitize_recommendations_data(data)
-        
-        # Convert to JSON string
-        json_data = json.dumps(sanitized_data, indent=2).encode('utf-8')
+        logging.info(f"Fetching cost recommendations for subscription: {subscription_id}")
+        recommendations = list(iter_subscription_recommendations(subscription_id))
+        logging.info(f"Retrieved {len(recommendations)} cost recommendations for subscription {subscription_id}")
+        return recommendations
+            
+    except Exception as e:
+        logging.error(f"Error fetching recommendations for subscription {subscription_id}: {str(e)}")
+        return []
+
+def iter_recommendations_concurrently(subscription_ids):
+    """Yield recommendations in subscription order, fetching a bounded window of subscriptions ahead
+
+    At most ADVISOR_MAX_CONCURRENCY subscriptions are in flight or waiting to be
+    consumed at any time, so memory does not grow with the size of the tenant.
+    """
+    subscription_iter = iter(subscription_ids)
+    fetch = metrics.bind(fetch_subscription_recommendations)
+    with ThreadPoolExecutor(max_workers=Config.advisor_max_concurrency) as executor:
+        pending = deque(
+            executor.submit(fetch, subscription_id)
+            for subscription_id in itertools.islice(subscription_iter, Config.advisor_max_concurrency)
+        )
+        while pending:
+            recommendations = pending.popleft().result()
+            next_subscription_id = next(subscription_iter, None)
+            if next_subscription_id is not None:
+                pending.append(executor.submit(fetch, next_subscription_id))
+            yield from recommendations
+
+# Cost recommendations from the Resource Graph advisorresources table, projected to the
+# shape the Advisor API returns (with subscriptionId added, as the API engine does)
+ADVISOR_RESOURCE_GRAPH_QUERY = (
+    "advisorresources "
+    "| where type =~ 'microsoft.advisor/recommendations' and tostring(properties.category) =~ 'Cost' "
+    "| project id, name, type = 'Microsoft.Advisor/recommendations', properties, subscriptionId "
+    "| order by subscriptionId asc, id asc"
+)
+
+MANAGEMENT_GROUP_SCOPE_PREFIX = "/providers/Microsoft.Management/managementGroups/"
+
+def resource_graph_scopes(billing_scope):
+    """Split comma-separated billing scopes into Resource Graph query scopes
+
+    Management groups are queried directly. Other scopes (billing accounts and
+    subscriptions) are resolved to subscription IDs, queried in chunks of up to
+    1000. Returns a list of {"management_groups": [...]} or {"subscriptions": [...]}.
+    """
+    scopes = [s.strip() for s in (billing_scope or "").split(",") if s.strip()]
+    management_groups = [s[len(MANAGEMENT_GROUP_SCOPE_PREFIX):] for s in scopes if s.startswith(MANAGEMENT_GROUP_SCOPE_PREFIX)]
+    other_scopes = [s for s in scopes if not s.startswith(MANAGEMENT_GROUP_SCOPE_PREFIX)]
+
+    query_scopes = [{"management_groups": management_groups}] if management_groups else []
+    if other_scopes:
+        subscription_ids = sorted(extract_subscription_ids_from_billing_scope(",".join(other_scopes)))
+        for i in range(0, len(subscription_ids), RESOURCE_GRAPH_MAX_SUBSCRIPTIONS):
+            query_scopes.append({"subscriptions": subscription_ids[i:i + RESOURCE_GRAPH_MAX_SUBSCRIPTIONS]})
+    return query_scopes
+
+def iter_recommendations_via_resource_graph(billing_scope):
+    """Yield Azure Advisor cost recommendations for the billing scopes from paged Resource Graph queries
+
+    One query (following $skipToken pages) covers a whole management group, so
+    no per-subscription requests are needed. Recommendations seen in an earlier
+    query scope are skipped, as scopes may overlap.
+    """
+    query_scopes = resource_graph_scopes(billing_scope)
+    logging.info(f"Querying Resource Graph advisorresources for cost recommendations in {len(query_scopes)} query scope(s)")
+
+    seen = set() if len(query_scopes) > 1 else None
+    for query_scope in query_scopes:
+        for recommendation in query_resource_graph(ADVISOR_RESOURCE_GRAPH_QUERY, **query_scope):
+            if seen is not None:
+                if recommendation.get("id") in seen:
+                    continue
+                seen.add(recommendation.get("id"))
+            yield recommendation
+
+def sanitize_recommendation(recommendation):
+    """Remove sensitive data from a single recommendation for security reasons"""
+    sanitized_rec = recommendation.copy()
+    
+    if "properties" in sanitized_rec:
+        sanitized_rec["properties"] = sanitized_rec["properties"].copy()
         
-        # Get S3 filesystem
-        s3 = getS3FileSystem()
+        # Remove impactedValue from properties
+        sanitized_rec["properties"].pop("impactedValue", None)
         
+        # Remove resourceMetadata object entirely
+        sanitized_rec["properties"].pop("resourceMetadata", None)
+    
+    return sanitized_rec
+
+OUTPUT_FORMATS = ("json", "parquet")
+RECOMMENDATION_OUTPUT_FORMATS = ("json", "ndjson", "parquet")
+
+def output_file_names(file_name, formats, supported=OUTPUT_FORMATS):
+    """Return {format: file name} for the requested output formats, swapping the .json suffix for the format's"""
+    unknown = set(formats) - set(supported)
+    if unknown or not formats:
+        raise ValueError(f"Unsupported output format(s) {sorted(unknown) or formats}, expected one or more of {supported}")
+    base_name = file_name[:-len(".json")] if file_name.endswith(".json") else file_name
+    return {output_format: f"{base_name}.{output_format}" for output_format in formats}
+
+def json_document_item(item, first):
+    """Encode one item of the {"value": [...]} document as json.dumps(document, indent=2) would lay it out"""
+    lines = json.dumps(item, indent=2).split("\n")
+    prefix = '{\n  "value": [\n' if first else ",\n"
+    return (prefix + "\n".join(f"    {line}" for line in lines)).encode('utf-8')
+
+def save_recommendations_to_s3(recommendations, file_name):
+    """Stream Azure Advisor recommendations to S3 in the RECOMMENDATIONS_OUTPUT_FORMAT formats
+
+    JSON output is the {"value": [...]} document, NDJSON output has one
+    recommendation per line and parquet output uses the flattened
+    RECOMMENDATION_SCHEMA. Each recommendation is sanitized and written to every
+    format as it arrives, so only the parts being uploaded are held in memory.
+    Returns the record count.
+    """
+    try:
         # Use current date directly for billing period instead of parsing from filename
         current_date = datetime.now(timezone.utc)
         billing_period = current_date.strftime("%Y%m%d")  # Current date as YYYYMMDD (e.g., 20250814)
-        s3_path = f"{Config.s3_recommendations_path.rstrip('/')}/gds-recommendations-v1/billing_period={billing_period}/{file_name}"
+        s3_prefix = f"{Config.s3_recommendations_path.rstrip('/')}/gds-recommendations-v1/billing_period={billing_period}"
+        file_names = output_file_names(file_name, Config.recommendations_output_formats, RECOMMENDATION_OUTPUT_FORMATS)
         
-        logging.info(f"Saving recommendations with billing_period={billing_period} to path: {s3_path}")
+        logging.info(f"Saving recommendations with billing_period={billing_period} to {s3_prefix} as {', '.join(file_names.values())}")
         
-        # Upload to S3
-        with s3.open_output_stream(s3_path) as f:
-            f.write(json_data)
+        # Upload to S3, one sanitized recommendation per document item, line or parquet row
+        record_count = 0
+        with contextlib.ExitStack() as stack:
+            json_sink = stack.enter_context(open_s3_upload(f"{s3_prefix}/{file_names['json']}")) if "json" in file_names else None
+            ndjson_sink = stack.enter_context(open_s3_upload(f"{s3_prefix}/{file_names['ndjson']}")) if "ndjson" in file_names else None
+            parquet_writer = None
+            if "parquet" in file_names:
+                from export_tables import RecommendationParquetWriter
+                parquet_sink = stack.enter_context(open_s3_upload(f"{s3_prefix}/{file_names['parquet']}"))
+                parquet_writer = stack.enter_context(RecommendationParquetWriter(parquet_sink))
+            
+            for recommendation in recommendations:
+                sanitized = sanitize_recommendation(recommendation)
+                if json_sink is not None:
+                    json_sink.write(json_document_item(sanitized, first=record_count == 0))
+                if ndjson_sink is not None:
+                    ndjson_sink.write(json.dumps(sanitized).encode('utf-8') + b"\n")
+                if parquet_writer is not None:
+                    parquet_writer.write(sanitized)
+                record_count += 1
+            
+            if json_sink is not None:
+                json_sink.write(b"\n  ]\n}" if record_count else b'{\n  "value": []\n}')
             
-        logging.info(f"Successfully uploaded recommendations data to S3: {s3_path}")
+        logging.info(f"Successfully uploaded {record_count} recommendations to S3: {s3_prefix}")
+        return record_count
         
     except Exception as e:
         logging.error(f"Error saving recommendations data to S3: {str(e)}")
         raise
 
 def save_carbon_data_to_s3(data, file_name):
-    """Save carbon emissions data to S3"""
+    """Save carbon emissions data to S3 in the CARBON_OUTPUT_FORMAT formats"""
     try:
-        # Convert to JSON string
-        json_data = json.dumps(data, indent=2).encode('utf-8')
-        
-        # Get S3 filesystem
-        s3 = getS3FileSystem()
-        
         # Create S3 path with billing period structure matching the data month
         # Use the same month as the data we're exporting, not the current month
         # Extract YYYY-MM from filename like "carbon-emissions-2025-05.json"
@@ -659,13 +1163,18 @@ def save_carbon_data_to_s3(data, file_name):
         year_month = f"{filename_parts[-2]}-{filename_parts[-1]}"  # Get "2025-05"
         data_month = datetime.strptime(year_month, '%Y-%m')
         billing_period = data_month.strftime("%Y%m01")  # First day of data month
-        s3_path = f"{Config.s3_carbon_path.rstrip('/')}/{Config.carbon_directory_name}/billing_period={billing_period}/{file_name}"
+        s3_prefix = f"{Config.s3_carbon_path.rstrip('/')}/{Config.carbon_directory_name}/billing_period={billing_period}"
         
-        # Upload to S3
-        with s3.open_output_stream(s3_path) as f:
-            f.write(json_data)
+        for output_format, output_name in output_file_names(file_name, Config.carbon_output_formats).items():
+            s3_path = f"{s3_prefix}/{output_name}"
+            with open_s3_upload(s3_path) as f:
+                if output_format == "parquet":
+                    from export_tables import write_carbon_parquet
+                    write_carbon_parquet(data, f)
+                else:
+                    f.write(json.dumps(data, indent=2).encode('utf-8'))
             
-        logging.info(f"Successfully uploaded carbon data to S3: {s3_path}")
+            logging.info(f"Successfully uploaded carbon data to S3: {s3_path}")
         
     except Exception as e:
         logging.error(f"Error saving carbon data to S3: {str(e)}")
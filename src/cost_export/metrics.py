@@ -0,0 +1,215 @@
+"""Per-stage timings and counters for the function app, emitted as custom metrics
+
+METRICS_MODE selects where they go:
+- off (default): span(), count() and timed() are no-ops
+- log: one structured "Metrics" log line per invocation, with the time and
+  call count of each stage and the counters
+- otel: OpenTelemetry histograms and counters; exported to Application
+  Insights when azure-monitor-opentelemetry is installed and
+  APPLICATIONINSIGHTS_CONNECTION_STRING is set
+
+Stage times are exclusive: time spent in a nested span (e.g. an S3 part upload
+that blocks an encode) is charged to the inner stage only, so the stages of an
+invocation add up to at most its duration.
+"""
+import json
+import time
+import logging
+import threading
+import contextlib
+import contextvars
+
+OFF = "off"
+LOG = "log"
+OTEL = "otel"
+
+_mode = OFF
+_meter = None
+_instruments = {}
+_instruments_lock = threading.Lock()
+_current = contextvars.ContextVar("metrics_invocation", default=None)
+_local = threading.local()
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NOOP_SPAN = _NoopSpan()
+
+def configure(mode):
+    """Select the metrics output; otel falls back to log if OpenTelemetry is not installed"""
+    global _mode, _meter
+    mode = (mode or OFF).lower()
+    if mode == OTEL:
+        try:
+            from opentelemetry import metrics as otel_metrics
+        except ImportError:
+            logging.warning("METRICS_MODE is otel but opentelemetry is not installed, using log mode")
+            mode = LOG
+        else:
+            try:
+                from azure.monitor.opentelemetry import configure_azure_monitor
+                configure_azure_monitor()
+            except ImportError:
+                logging.info("azure-monitor-opentelemetry is not installed, using the configured OpenTelemetry exporter")
+            _meter = otel_metrics.get_meter("cost_export")
+    elif mode not in (OFF, LOG):
+        logging.warning(f"Unknown METRICS_MODE {mode}, metrics are disabled")
+        mode = OFF
+    _mode = mode
+
+def enabled():
+    return _mode != OFF
+
+class _Invocation:
+    """Stage times and counters recorded during one function invocation"""
+
+    def __init__(self, function, attributes):
+        self.function = function
+        self.attributes = attributes
+        self.stages = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def add_stage(self, stage, seconds):
+        with self.lock:
+            total = self.stages.setdefault(stage, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+
+    def add_counter(self, name, value):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+def _instrument(kind, name, unit=""):
+    with _instruments_lock:
+        if name not in _instruments:
+            create = _meter.create_histogram if kind == "histogram" else _meter.create_counter
+            _instruments[name] = create(f"cost_export.{name}", unit=unit)
+        return _instruments[name]
+
+def _otel_attributes(invocation, attributes):
+    merged = {"function": invocation.function if invocation else "unknown"}
+    merged.update(attributes)
+    return merged
+
+@contextlib.contextmanager
+def invocation(function, **attributes):
+    """Collect the spans and counters of one function invocation and emit them when it ends
+
+    Usable as a decorator on a function app trigger. Functions submitted to
+    thread pools should be wrapped with bind() so that their spans are
+    attributed to the invocation.
+    """
+    if _mode == OFF:
+        yield
+        return
+
+    current = _Invocation(function, attributes)
+    token = _current.set(current)
+    start = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        _current.reset(token)
+        _emit(current, duration, failed)
+
+def _emit(current, duration, failed):
+    try:
+        if _mode == LOG:
+            summary = {
+                "function": current.function,
+                "duration_s": round(duration, 4),
+                "failed": failed,
+                "stages": {stage: {"seconds": round(seconds, 4), "count": count} for stage, (seconds, count) in sorted(current.stages.items())},
+                "counters": current.counters,
+            }
+            summary.update(current.attributes)
+            logging.info(f"Metrics {json.dumps(summary)}")
+        elif _mode == OTEL:
+            attributes = {"function": current.function, "failed": failed}
+            _instrument("histogram", "invocation.duration", "s").record(duration, attributes)
+    except Exception as e:
+        logging.warning(f"Failed to emit metrics for {current.function}: {str(e)}")
+
+class _Span:
+    __slots__ = ("stage", "attributes", "start")
+
+    def __init__(self, stage, attributes):
+        self.stage = stage
+        self.attributes = attributes
+
+    def __enter__(self):
+        stack = _local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        stack = _local.stack
+        exclusive = elapsed - stack.pop()
+        if stack:
+            stack[-1] += elapsed
+
+        current = _current.get()
+        if current is not None:
+            current.add_stage(self.stage, exclusive)
+        if _mode == OTEL:
+            attributes = _otel_attributes(current, self.attributes)
+            attributes["stage"] = self.stage
+            _instrument("histogram", "stage.duration", "s").record(exclusive, attributes)
+        return False
+
+def span(stage, **attributes):
+    """Time a block of work as a stage of the current invocation"""
+    if _mode == OFF:
+        return _NOOP_SPAN
+    return _Span(stage, attributes)
+
+def count(name, value=1, **attributes):
+    """Add to a counter of the current invocation, e.g. bytes_in, rows_out or arm_retries"""
+    if _mode == OFF:
+        return
+    current = _current.get()
+    if current is not None:
+        current.add_counter(name, value)
+    if _mode == OTEL:
+        _instrument("counter", name).add(value, _otel_attributes(current, attributes))
+
+def bind(fn):
+    """Wrap fn to record into the current invocation when it runs on another thread"""
+    current = _current.get()
+    if current is None:
+        return fn
+
+    def bound(*args, **kwargs):
+        token = _current.set(current)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.reset(token)
+    return bound
+
+def timed(iterable, stage):
+    """Time each step of an iterator, such as decoding parquet record batches, as a stage"""
+    if _mode == OFF:
+        return iterable
+    return _timed(iter(iterable), stage)
+
+def _timed(iterator, stage):
+    while True:
+        with span(stage):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
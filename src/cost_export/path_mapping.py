@@ -0,0 +1,234 @@
+"""Map cost export blob names to flattened S3 keys
+
+Example: gds-focus-v1/focus-backfill-0-2025-06/20250601-20250630/202507010312/7a770e35-b455-4df2-a276-b07408438d9a/providers/Microsoft.Billing/billingAccounts/billing-account-id:profile-id/billingProfiles/profile-name/part_0_0001.parquet
+Becomes: gds-focus-v1/billing_period=20250601/billing-account-id-profile-id_profile-name_part_0_0001.parquet
+
+This module has no dependency on the function configuration so it can be used
+by backfill and replay tooling as well as by the CostExportProcessor.
+"""
+import re
+import uuid
+from collections import namedtuple
+from datetime import datetime
+from functools import lru_cache
+
+DAILY_EXPORT_PREFIX = "focus-daily-cost-export"
+BACKFILL_EXPORT_PREFIX = "focus-backfill-"
+UNKNOWN_BILLING_ACCOUNT = "unknown-billing-account"
+
+_TIMESTAMP_RE = re.compile(r"^\d{12}$")
+_DATE_RANGE_RE = re.compile(r"^(\d{8})-\d{8}$")
+_UUID_CANDIDATE_RE = re.compile(r"^[{]?(urn:uuid:)?[0-9a-fA-F-]{32,}[}]?$")
+
+# Segment kinds returned by classify_segment
+SKIP = "skip"
+BILLING_PERIOD = "billing_period"
+PROVIDERS = "providers"
+BILLING_PROFILES = "billingProfiles"
+KEEP = "keep"
+
+ParsedBlobPath = namedtuple("ParsedBlobPath", [
+    "directory_parts",
+    "filename",
+    "billing_account",
+    "billing_profile",
+    "export_index",
+])
+
+@lru_cache(maxsize=8192)
+def _is_timestamp(part):
+    """Check if a 12 digit segment is a valid YYYYMMDDHHMM timestamp"""
+    try:
+        datetime.strptime(part, "%Y%m%d%H%M")
+        return True
+    except ValueError:
+        return False
+
+@lru_cache(maxsize=8192)
+def _is_uuid(part):
+    """Check if a segment is a valid UUID"""
+    if not _UUID_CANDIDATE_RE.match(part):
+        return False
+    try:
+        uuid.UUID(part)
+        return True
+    except ValueError:
+        return False
+
+@lru_cache(maxsize=8192)
+def _export_index(part):
+    """Return the billing account index encoded in an export directory name, if any
+
+    Daily exports look like focus-daily-cost-export-0 and backfill exports like
+    focus-backfill-0-2024-01.
+    """
+    parts = part.split("-")
+    if len(parts) < 4:
+        return None
+    try:
+        if part.startswith(DAILY_EXPORT_PREFIX + "-"):
+            return int(parts[-1])
+        if part.startswith(BACKFILL_EXPORT_PREFIX) and len(parts) >= 5:
+            return int(parts[2])
+    except ValueError:
+        pass
+    return None
+
+@lru_cache(maxsize=8192)
+def classify_segment(part):
+    """Classify a single path segment; results are memoised as segments repeat across blobs"""
+    if part == DAILY_EXPORT_PREFIX or part.startswith(DAILY_EXPORT_PREFIX + "-") or part.startswith(BACKFILL_EXPORT_PREFIX):
+        return SKIP
+    if _TIMESTAMP_RE.match(part) and _is_timestamp(part):
+        return SKIP
+    if _DATE_RANGE_RE.match(part):
+        return BILLING_PERIOD
+    if _is_uuid(part):
+        return SKIP
+    if part == "providers":
+        return PROVIDERS
+    if part == "billingProfiles":
+        return BILLING_PROFILES
+    return KEEP
+
+def parse_blob_path(blob_name):
+    """Parse a blob name in a single pass over its segments"""
+    path_parts = blob_name.split('/')
+    kept_parts = []
+    billing_account = None
+    billing_profile = None
+    export_index = None
+
+    i = 0
+    count = len(path_parts)
+    while i < count:
+        part = path_parts[i]
+        kind = classify_segment(part)
+
+        if kind == SKIP:
+            if export_index is None and part.startswith((DAILY_EXPORT_PREFIX + "-", BACKFILL_EXPORT_PREFIX)):
+                export_index = _export_index(part)
+            i += 1
+        elif kind == BILLING_PERIOD:
+            # Transform date range (e.g., "20250801-20250831" -> "billing_period=20250801")
+            kept_parts.append(f"billing_period={part[:8]}")
+            i += 1
+        elif kind == PROVIDERS and i + 3 < count and path_parts[i + 1] == "Microsoft.Billing" and path_parts[i + 2] == "billingAccounts":
+            # Skip providers/Microsoft.Billing/billingAccounts/{id} and keep the billing account ID
+            billing_account = path_parts[i + 3]
+            i += 4
+        elif kind == BILLING_PROFILES:
+            # Skip billingProfiles/{name} and keep the billing profile name
+            if i + 1 < count:
+                billing_profile = path_parts[i + 1]
+                i += 2
+            else:
+                i += 1
+        else:
+            if part:
+                kept_parts.append(part)
+            i += 1
+
+    if kept_parts:
+        return ParsedBlobPath(kept_parts[:-1], kept_parts[-1], billing_account, billing_profile, export_index)
+    return ParsedBlobPath([], None, billing_account, billing_profile, export_index)
+
+ExportRun = namedtuple("ExportRun", ["export", "timestamp", "run_id"])
+
+def parse_export_run(blob_name):
+    """Return the export directory, run timestamp (YYYYMMDDHHMM) and run ID of a blob, each None if missing
+
+    Every run of an export writes its parts under a new timestamp and run ID,
+    which map_blob_path leaves out of the S3 key.
+    """
+    export = timestamp = run_id = None
+    for part in blob_name.split('/'):
+        if export is None and (part == DAILY_EXPORT_PREFIX or part.startswith((DAILY_EXPORT_PREFIX + "-", BACKFILL_EXPORT_PREFIX))):
+            export = part
+        elif timestamp is None and _TIMESTAMP_RE.match(part) and _is_timestamp(part):
+            timestamp = part
+        elif timestamp is not None and run_id is None and _is_uuid(part):
+            run_id = part
+    return ExportRun(export, timestamp, run_id)
+
+def is_daily_export(blob_name):
+    """Check if a blob belongs to the daily MonthToDate export rather than a backfill export"""
+    return any(part == DAILY_EXPORT_PREFIX or part.startswith(DAILY_EXPORT_PREFIX + "-") for part in blob_name.split('/'))
+
+def resolve_billing_account(parsed, billing_account_id=None, billing_account_mapping=None):
+    """Pick the billing account folder: data first, then the path, then the export index mapping"""
+    if billing_account_id:
+        return billing_account_id
+    if parsed.billing_account:
+        return parsed.billing_account
+    if parsed.export_index is not None and billing_account_mapping and str(parsed.export_index) in billing_account_mapping:
+        return billing_account_mapping[str(parsed.export_index)]
+    return UNKNOWN_BILLING_ACCOUNT
+
+def build_key(parsed, billing_account_folder, billing_profile=None):
+    """Build the flattened, relative S3 key for a parsed blob path
+
+    The filename becomes billing_account_billing_profile_original_filename, with
+    colons in the billing account replaced by dashes. A billing profile from the
+    data is preferred over one from the path.
+    """
+    if parsed.filename is None:
+        return '/'.join(parsed.directory_parts)
+
+    filename_parts = []
+    if billing_account_folder:
+        filename_parts.append(billing_account_folder.replace(':', '-'))
+
+    billing_profile_to_use = billing_profile or parsed.billing_profile
+    if billing_profile_to_use:
+        filename_parts.append(billing_profile_to_use)
+
+    filename_parts.append(parsed.filename)
+    flattened_filename = '_'.join(filename_parts)
+
+    if parsed.directory_parts:
+        return '/'.join(parsed.directory_parts) + '/' + flattened_filename
+    return flattened_filename
+
+def map_blob_path(blob_name, billing_account_id=None, billing_profile=None, billing_account_mapping=None, filename=None):
+    """Map a blob name to (relative S3 key, billing account folder)
+
+    filename replaces the original filename, e.g. for outputs that combine several blobs.
+    """
+    parsed = parse_blob_path(blob_name)
+    if filename is not None:
+        parsed = parsed._replace(filename=filename)
+    billing_account_folder = resolve_billing_account(parsed, billing_account_id, billing_account_mapping)
+    return build_key(parsed, billing_account_folder, billing_profile), billing_account_folder
+
+def map_blob_paths(blob_names, billing_account_mapping=None):
+    """Map many blob names at once, using only the path and the export index mapping
+
+    Parts of an export run share a directory, so each directory is parsed and
+    its billing account resolved once, and every filename in it is appended to
+    the same key prefix. Returns a list of (blob name, relative S3 key, billing
+    account folder) tuples in input order, for backfill and replay tooling.
+    """
+    prefixes = {}
+    mapped = []
+    for blob_name in blob_names:
+        directory, _, name = blob_name.rpartition('/')
+        if not name or classify_segment(name) != KEEP:
+            mapped.append((blob_name,) + map_blob_path(blob_name, billing_account_mapping=billing_account_mapping))
+            continue
+
+        if directory not in prefixes:
+            parsed = parse_blob_path(blob_name)
+            if parsed.filename == name:
+                billing_account_folder = resolve_billing_account(parsed, billing_account_mapping=billing_account_mapping)
+                prefixes[directory] = (build_key(parsed._replace(filename=""), billing_account_folder), billing_account_folder)
+            else:
+                # The filename was read as a billing account or profile, so the directory can't be shared
+                prefixes[directory] = None
+
+        if prefixes[directory] is None:
+            mapped.append((blob_name,) + map_blob_path(blob_name, billing_account_mapping=billing_account_mapping))
+        else:
+            prefix, billing_account_folder = prefixes[directory]
+            mapped.append((blob_name, prefix + name, billing_account_folder))
+    return mapped
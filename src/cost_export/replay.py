@@ -0,0 +1,169 @@
+"""Drain or replay FOCUS export parts already in the storage container
+
+Lists the parquet blobs under a prefix and runs each one through the same
+transform as CostExportProcessor, across a pool of worker processes. Use it
+when Event Grid deliveries were lost, or to re-apply the column policy after it
+changes (with --keep-source, so the parts stay for the next replay).
+
+Parts that map to the same S3 key, such as the daily MonthToDate runs of one
+part, are processed in order by the same worker, so the latest run is written
+last. Finished parts are appended to the progress file, and a rerun with the
+same file skips them.
+
+Runs with the function app's settings (STORAGE_CONNECTION_STRING,
+CONTAINER_NAME, S3_FOCUS_PATH, AWS_ROLE_ARN, ENTRA_APP_URN, AWS_REGION,
+BILLING_ACCOUNT_MAPPING and the PARQUET_* settings) in the environment. Off
+Azure, --azure-credential default uses DefaultAzureCredential (e.g. az login)
+for the AWS federation token, so the AWS role must trust that identity.
+
+Usage: python replay.py [--prefix gds-focus-v1/focus-backfill-0-2025] [--workers 8]
+       [--progress-file replay-progress.jsonl] [--dry-run] [--keep-source]
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+
+from common import Config, azure_clients
+from path_mapping import map_blob_paths
+
+def list_parts(prefix):
+    """Return {blob name: size} of the parquet parts under prefix"""
+    container_client = azure_clients.container_client()
+    return {
+        blob.name: blob.size
+        for blob in container_client.list_blobs(name_starts_with=prefix or None)
+        if blob.name.endswith(".parquet")
+    }
+
+def group_parts(blob_names):
+    """Group blobs by the S3 key they are written to, each group in export run order
+
+    Returns a list of lists of blob names, largest groups first so the pool is
+    not left waiting on a long group at the end.
+    """
+    groups = {}
+    for blob_name, key, _ in map_blob_paths(sorted(blob_names), billing_account_mapping=Config.billing_account_mapping):
+        groups.setdefault(key, []).append(blob_name)
+    return sorted(groups.values(), key=len, reverse=True)
+
+def load_progress(progress_file):
+    """Return the blob names recorded as done in a progress file"""
+    done = set()
+    if not progress_file or not os.path.exists(progress_file):
+        return done
+    with open(progress_file) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A line cut short by an interrupted run
+                continue
+            if record.get("status") == "done":
+                done.add(record["blob"])
+    return done
+
+def init_worker(log_level, azure_credential):
+    logging.basicConfig(level=log_level, format="%(asctime)s %(processName)s %(levelname)s %(message)s")
+    if azure_credential == "default":
+        from azure.identity import DefaultAzureCredential
+        azure_clients.set_credential(DefaultAzureCredential())
+
+def process_group(blob_names, delete_source):
+    """Process a group of blobs in order in a worker process
+
+    Returns a progress record per blob. A failure stops the group, as later runs
+    of the same part must not be overwritten by an earlier one on retry.
+    """
+    import metrics
+    from function_app import process_cost_export_blob
+
+    results = []
+    for index, blob_name in enumerate(blob_names):
+        start = time.perf_counter()
+        try:
+            with metrics.invocation("CostExportReplay", blob=blob_name):
+                rows = process_cost_export_blob(blob_name, delete_source=delete_source)
+        except Exception as e:
+            results.append({"blob": blob_name, "status": "failed", "error": str(e)})
+            results.extend({"blob": name, "status": "skipped", "error": f"earlier part failed: {blob_name}"} for name in blob_names[index + 1:])
+            break
+        results.append({"blob": blob_name, "status": "done", "rows": rows, "seconds": round(time.perf_counter() - start, 3)})
+    return results
+
+def print_plan(groups, sizes, done):
+    pending = [blob_name for group in groups for blob_name in group]
+    print(f"{len(pending)} parts ({sum(sizes[b] for b in pending) / 1024 ** 2:.1f} MiB) in {len(groups)} output keys to process, {len(done)} already done")
+    for group in groups:
+        for blob_name in group:
+            print(f"  {blob_name}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--prefix", default="", help="Only process blobs whose names start with this prefix")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Worker processes (default: CPU count)")
+    parser.add_argument("--progress-file", help="JSON lines file recording finished parts; parts already done in it are skipped")
+    parser.add_argument("--dry-run", action="store_true", help="List the parts that would be processed and exit")
+    parser.add_argument("--keep-source", action="store_true", help="Keep the source blobs after they are uploaded")
+    parser.add_argument("--azure-credential", choices=["managed-identity", "default"], default="default", help="Credential for the AWS federation token")
+    parser.add_argument("--verbose", action="store_true", help="Show the processor's own logging")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+
+    sizes = list_parts(args.prefix)
+    done = load_progress(args.progress_file)
+    groups = group_parts(name for name in sizes if name not in done)
+    pending = sum(len(group) for group in groups)
+
+    if args.dry_run:
+        print_plan(groups, sizes, done & set(sizes))
+        return
+    if not groups:
+        logging.info(f"Nothing to process under '{args.prefix}' ({len(done & set(sizes))} parts already done)")
+        return
+
+    logging.info(f"Processing {pending} parts in {len(groups)} output keys with {args.workers} workers")
+    processed = failed = rows = 0
+    start = time.perf_counter()
+    progress = open(args.progress_file, "a") if args.progress_file else None
+    try:
+        # Spawned workers start without the parent's threads and connection pools
+        with ProcessPoolExecutor(
+            max_workers=args.workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(logging.INFO if args.verbose else logging.WARNING, args.azure_credential)
+        ) as executor:
+            futures = [executor.submit(process_group, group, not args.keep_source) for group in groups]
+            for future in as_completed(futures):
+                for record in future.result():
+                    record["finished_at"] = datetime.now(timezone.utc).isoformat()
+                    if progress:
+                        progress.write(json.dumps(record) + "\n")
+                    if record["status"] == "done":
+                        processed += 1
+                        rows += record["rows"]
+                    else:
+                        failed += 1
+                        logging.error(f"{record['status'].capitalize()}: {record['blob']}: {record['error']}")
+                if progress:
+                    progress.flush()
+
+                elapsed = time.perf_counter() - start
+                logging.info(f"{processed + failed}/{pending} parts, {rows} rows, {failed} failed, {elapsed:.0f}s elapsed, {rows / elapsed:.0f} rows/s")
+    finally:
+        if progress:
+            progress.close()
+
+    logging.info(f"Processed {processed} parts ({rows} rows) in {time.perf_counter() - start:.0f}s, {failed} failed or skipped")
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
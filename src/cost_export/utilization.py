@@ -0,0 +1,176 @@
+"""Fetch compute utilization metrics with the Azure Monitor batch metrics API
+
+Virtual machines and scale sets are listed with Resource Graph, then grouped by
+subscription, region and resource type, as each metrics:getBatch request takes
+up to 50 resources that share all three. Batches are requested concurrently and
+their time series are streamed to parquet as they arrive.
+"""
+import itertools
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import pyarrow as pa
+import metrics
+from common import Config, send_arm_request, query_resource_graph, RESOURCE_GRAPH_MAX_SUBSCRIPTIONS
+from focus import ParquetOutputWriter, ParquetOutputProfile
+
+METRICS_API_VERSION = "2024-02-01"
+METRICS_SCOPE = "https://metrics.monitor.azure.com/.default"
+
+# Metrics requested per resource type (the metric namespace). The CPU and disk IOPS metrics are
+# percentages; Available Memory Bytes is the free memory in bytes, not a utilization, as
+# Azure Monitor has no host memory percentage for every VM size. The Unit column tells them apart
+UTILIZATION_METRICS = {
+    "microsoft.compute/virtualmachines": ["Percentage CPU", "Available Memory Bytes", "OS Disk IOPS Consumed Percentage", "Data Disk IOPS Consumed Percentage"],
+    "microsoft.compute/virtualmachinescalesets": ["Percentage CPU", "Available Memory Bytes", "OS Disk IOPS Consumed Percentage", "Data Disk IOPS Consumed Percentage"],
+}
+
+AGGREGATIONS = ("average", "maximum", "minimum", "total", "count")
+
+UTILIZATION_SCHEMA = pa.schema([
+    ("Timestamp", pa.timestamp("s", tz="UTC")),
+    ("SubscriptionId", pa.string()),
+    ("ResourceGroup", pa.string()),
+    ("ResourceType", pa.string()),
+    ("ResourceName", pa.string()),
+    ("ResourceId", pa.string()),
+    ("Location", pa.string()),
+    ("MetricName", pa.string()),
+    ("Unit", pa.string()),
+    ("Interval", pa.string()),
+] + [(aggregation.capitalize(), pa.float64()) for aggregation in AGGREGATIONS])
+
+UTILIZATION_SORT_COLUMNS = ("ResourceId", "MetricName", "Timestamp")
+
+# Encoding of the utilization files, independent of the FOCUS PARQUET_* settings. Every
+# column is dictionary encoded, and metric batches are buffered into large row groups
+UTILIZATION_OUTPUT_PROFILE = ParquetOutputProfile(
+    compression="zstd",
+    compression_level=3,
+    row_group_rows=500000,
+    sort_columns=UTILIZATION_SORT_COLUMNS,
+)
+
+def list_compute_resources(subscription_ids):
+    """List the resources with utilization metrics in the given subscriptions, ordered by ID"""
+    resource_types = ", ".join(f"'{resource_type}'" for resource_type in UTILIZATION_METRICS)
+    query = (
+        f"resources | where type in~ ({resource_types}) "
+        "| project id = tolower(id), name, type = tolower(type), location, subscriptionId, resourceGroup "
+        "| order by id asc"
+    )
+    resources = []
+    for i in range(0, len(subscription_ids), RESOURCE_GRAPH_MAX_SUBSCRIPTIONS):
+        resources.extend(query_resource_graph(query, subscriptions=subscription_ids[i:i + RESOURCE_GRAPH_MAX_SUBSCRIPTIONS]))
+    return resources
+
+def plan_batches(resources, batch_size):
+    """Group resources into metrics:getBatch requests
+
+    Returns a list of (subscription ID, location, resource type, [resources]).
+    """
+    key = lambda r: (r["subscriptionId"], r["location"], r["type"])
+    batches = []
+    for (subscription_id, location, resource_type), group in itertools.groupby(sorted(resources, key=key), key=key):
+        group = list(group)
+        for i in range(0, len(group), batch_size):
+            batches.append((subscription_id, location, resource_type, group[i:i + batch_size]))
+    return batches
+
+def request_metrics_batch(subscription_id, location, resource_type, resource_ids, start, end, interval, aggregations):
+    """Request the utilization metrics of up to 50 resources of one type in one region"""
+    url = f"{Config.monitor_metrics_endpoint.format(location=location)}/subscriptions/{subscription_id}/metrics:getBatch"
+    params = {
+        "api-version": METRICS_API_VERSION,
+        "metricnamespace": resource_type,
+        "metricnames": ",".join(UTILIZATION_METRICS[resource_type]),
+        "starttime": start.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "endtime": end.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "interval": interval,
+        "aggregation": ",".join(aggregations),
+    }
+    response = send_arm_request("POST", url, params=params, json={"resourceids": resource_ids}, timeout=120, scope=METRICS_SCOPE)
+
+    if response.status_code != 200:
+        raise RuntimeError(f"Batch metrics request failed for {len(resource_ids)} {resource_type} resources in {subscription_id}/{location}: {response.status_code} - {response.text}")
+
+    return response.json()
+
+def metrics_batch_to_record_batch(response, resources_by_id):
+    """Flatten a metrics:getBatch response into rows of UTILIZATION_SCHEMA"""
+    columns = {field.name: [] for field in UTILIZATION_SCHEMA}
+    for resource_values in response.get("values", []):
+        resource_id = (resource_values.get("resourceid") or "").lower()
+        resource = resources_by_id.get(resource_id, {})
+        for metric in resource_values.get("value", []):
+            metric_name = metric.get("name", {}).get("value")
+            if metric.get("errorCode", "Success") != "Success":
+                logging.warning(f"Metric {metric_name} unavailable for {resource_id}: {metric.get('errorCode')} {metric.get('errorMessage', '')}")
+                continue
+            for series in metric.get("timeseries", []):
+                for point in series.get("data", []):
+                    columns["Timestamp"].append(datetime.fromisoformat(point["timeStamp"].replace("Z", "+00:00")))
+                    columns["SubscriptionId"].append(resource.get("subscriptionId"))
+                    columns["ResourceGroup"].append(resource.get("resourceGroup"))
+                    columns["ResourceType"].append(resource.get("type"))
+                    columns["ResourceName"].append(resource.get("name"))
+                    columns["ResourceId"].append(resource_id)
+                    columns["Location"].append(resource_values.get("resourceregion") or resource.get("location"))
+                    columns["MetricName"].append(metric_name)
+                    columns["Unit"].append(metric.get("unit"))
+                    columns["Interval"].append(resource_values.get("interval"))
+                    for aggregation in AGGREGATIONS:
+                        columns[aggregation.capitalize()].append(point.get(aggregation))
+    return pa.RecordBatch.from_pydict(columns, schema=UTILIZATION_SCHEMA)
+
+def fetch_batch(batch, start, end, interval, aggregations):
+    """Fetch one planned batch and return it as a record batch, or None if the request failed"""
+    subscription_id, location, resource_type, resources = batch
+    try:
+        response = request_metrics_batch(subscription_id, location, resource_type, [r["id"] for r in resources], start, end, interval, aggregations)
+        return metrics_batch_to_record_batch(response, {r["id"]: r for r in resources})
+    except Exception as e:
+        logging.error(f"Error fetching utilization metrics for {len(resources)} {resource_type} resources in {subscription_id}/{location}: {str(e)}")
+        return None
+
+def iter_metrics_batches_concurrently(batches, start, end, interval, aggregations, max_concurrency):
+    """Yield (batch, record batch or None) in plan order, with a bounded window of requests in flight"""
+    batch_iter = iter(batches)
+    fetch = metrics.bind(fetch_batch)
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        pending = deque(
+            (batch, executor.submit(fetch, batch, start, end, interval, aggregations))
+            for batch in itertools.islice(batch_iter, max_concurrency)
+        )
+        while pending:
+            batch, future = pending.popleft()
+            record_batch = future.result()
+            next_batch = next(batch_iter, None)
+            if next_batch is not None:
+                pending.append((next_batch, executor.submit(fetch, next_batch, start, end, interval, aggregations)))
+            yield batch, record_batch
+
+def write_utilization(resources, start, end, sink, profile=UTILIZATION_OUTPUT_PROFILE):
+    """Fetch the utilization metrics of resources between start and end and write them to sink as parquet
+
+    Interval, aggregations, batch size and concurrency come from the
+    UTILIZATION_* settings. Returns a summary dict. Raises if every batch
+    failed, so the run is retried instead of leaving an empty file.
+    """
+    batches = plan_batches(resources, Config.utilization_batch_size)
+    logging.info(f"Requesting utilization metrics for {len(resources)} resources in {len(batches)} batch(es) with concurrency {Config.utilization_max_concurrency}")
+
+    failed = 0
+    with ParquetOutputWriter(sink, UTILIZATION_SCHEMA, profile) as writer:
+        for _, record_batch in iter_metrics_batches_concurrently(batches, start, end, Config.utilization_interval, Config.utilization_aggregations, Config.utilization_max_concurrency):
+            if record_batch is None:
+                failed += 1
+            elif record_batch.num_rows:
+                writer.write_batch(record_batch)
+
+    if batches and failed == len(batches):
+        raise RuntimeError(f"All {failed} utilization metrics batches failed")
+
+    metrics.count("rows_out", writer.rows)
+    return {"resources": len(resources), "batches": len(batches), "failed_batches": failed, "rows": writer.rows, "bytes": writer.bytes_written}
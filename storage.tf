@@ -32,6 +32,12 @@ resource "azapi_resource" "cost_data_queue" {
   parent_id = "${azurerm_storage_account.cost_export.id}/queueServices/default"
 }
 
+resource "azapi_resource" "carbon_backfill_queue" {
+  type      = "Microsoft.Storage/storageAccounts/queueServices/queues@2022-09-01"
+  name      = "carbonbackfill"
+  parent_id = "${azurerm_storage_account.cost_export.id}/queueServices/default"
+}
+
 resource "azurerm_storage_account" "deployment" {
   name                     = "stcostexdply${random_string.unique.result}"
   resource_group_name      = azurerm_resource_group.cost_export.name
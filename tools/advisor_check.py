@@ -0,0 +1,70 @@
+"""Compare the Advisor API and Resource Graph recommendation engines against the recorded-response stand-in
+
+Starts tools/arm_standin.py in-process with a recordings file holding the same
+recommendations as Advisor API responses and as Resource Graph advisorresources
+rows, runs both engines for the recordings' scope and checks that they produce
+the same sanitized recommendations, and as many as the "expected" section says.
+The number of ARM requests each engine sent is reported.
+
+Exits with status 1 on a mismatch, so it can be run as a check in CI.
+
+Usage: python tools/advisor_check.py [--recordings tools/recordings/advisor.json]
+"""
+import argparse
+import json
+import os
+import sys
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TOOLS_DIR, "..", "src", "cost_export"))
+sys.path.insert(0, TOOLS_DIR)
+
+from arm_standin import RecordedArmServer  # noqa: E402
+from utilization_check import StaticTokenCredential  # noqa: E402
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recordings", default=os.path.join(TOOLS_DIR, "recordings", "advisor.json"))
+    args = parser.parse_args()
+
+    with open(args.recordings) as f:
+        recordings_text = f.read()
+    recordings = json.loads(recordings_text)
+
+    with RecordedArmServer(recordings) as server:
+        # nextLinks are absolute, so point them at the stand-in
+        server.interactions = json.loads(recordings_text.replace("{ARM_ENDPOINT}", server.url))["interactions"]
+        os.environ.update({"ARM_ENDPOINT": server.url, "BILLING_SCOPE": recordings["scope"]})
+        from common import azure_clients, extract_subscription_ids_from_billing_scope
+        from function_app import iter_recommendations_concurrently, iter_recommendations_via_resource_graph, sanitize_recommendation
+
+        azure_clients.set_credential(StaticTokenCredential())
+
+        results = {}
+        for engine in ("api", "resource_graph"):
+            sent_before = len(server.requests)
+            if engine == "api":
+                subscription_ids = sorted(extract_subscription_ids_from_billing_scope(recordings["scope"], use_cache=False))
+                recommendations = iter_recommendations_concurrently(subscription_ids)
+            else:
+                recommendations = iter_recommendations_via_resource_graph(recordings["scope"])
+            results[engine] = [sanitize_recommendation(r) for r in recommendations]
+            print(f"{engine:<15}: {len(results[engine])} recommendations from {len(server.requests) - sent_before} ARM request(s)")
+
+    failures = []
+    expected = recordings.get("expected", {}).get("recommendations")
+    for engine, recommendations in results.items():
+        if expected is not None and len(recommendations) != expected:
+            failures.append(f"{engine} returned {len(recommendations)} recommendations, expected {expected}")
+    by_id = {engine: {r["id"].lower(): r for r in recommendations} for engine, recommendations in results.items()}
+    differing = sorted(key for key in by_id["api"].keys() | by_id["resource_graph"].keys() if by_id["api"].get(key) != by_id["resource_graph"].get(key))
+    if differing:
+        failures.append(f"engines differ for {differing}")
+
+    if failures:
+        print(f"FAIL: {'; '.join(failures)}")
+        sys.exit(1)
+    print("OK: both engines produced the same sanitized recommendations")
+
+if __name__ == "__main__":
+    main()
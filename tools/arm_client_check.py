@@ -0,0 +1,101 @@
+"""Check the shared ARM client against a throttling stand-in
+
+Starts tools/arm_standin.py in-process with a request quota and sends a burst of
+concurrent Advisor requests, one per subscription, through send_arm_request.
+One subscription answers with a 503 first, to exercise the retry of transient
+errors. Every request must end with a 200; the number of 429s the stand-in had
+to send, the elapsed time and the request rate achieved are reported.
+
+With --compare, the burst is repeated with the adaptive rate disabled (the
+low-quota watermark set to 0), so only 429s and Retry-After slow it down.
+
+Exits with status 1 if any request did not succeed, so it can be run as a check in CI.
+
+Usage: python tools/arm_client_check.py [--subscriptions 60] [--concurrency 16] [--throttle 40/4] [--compare]
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TOOLS_DIR, "..", "src", "cost_export"))
+sys.path.insert(0, TOOLS_DIR)
+
+from arm_standin import RecordedArmServer  # noqa: E402
+from utilization_check import StaticTokenCredential  # noqa: E402
+
+ADVISOR_PATH = "/subscriptions/{subscription_id}/providers/Microsoft.Advisor/recommendations"
+
+def subscription_id(index):
+    return f"00000000-0000-0000-0000-{index:012d}"
+
+def recordings(subscriptions, limit, window_seconds):
+    """Recordings answering one Advisor request per subscription, with a 503 before the first"""
+    interactions = [{
+        "request": {"method": "GET", "path": ADVISOR_PATH.format(subscription_id=subscription_id(0))},
+        "response": {"status": 503, "json": {"error": {"code": "ServiceUnavailable", "message": "Transient failure"}}},
+        "times": 1,
+    }]
+    for index in range(subscriptions):
+        interactions.append({
+            "request": {"method": "GET", "path": ADVISOR_PATH.format(subscription_id=subscription_id(index))},
+            "response": {"status": 200, "json": {"value": [{"id": f"{ADVISOR_PATH.format(subscription_id=subscription_id(index))}/rec-1", "properties": {"category": "Cost"}}]}},
+        })
+    return {"throttle": {"requests": limit, "window_seconds": window_seconds}, "interactions": interactions}
+
+def run_burst(server, subscriptions, concurrency):
+    """Send one request per subscription concurrently; returns (status codes, elapsed seconds, 429s sent)"""
+    from common import Config, send_arm_request
+
+    def fetch(index):
+        url = f"{Config.arm_endpoint}{ADVISOR_PATH.format(subscription_id=subscription_id(index))}"
+        return send_arm_request("GET", url, params={"api-version": "2025-01-01"}, timeout=60, max_retries=8).status_code
+
+    throttled_before = server.throttled
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        statuses = list(executor.map(fetch, range(subscriptions)))
+    return statuses, time.monotonic() - started, server.throttled - throttled_before
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subscriptions", type=int, default=60, help="Number of requests in the burst")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--throttle", default="40/4", metavar="REQUESTS/SECONDS", help="Stand-in quota")
+    parser.add_argument("--rate", default="20", help="ARM_REQUESTS_PER_SECOND for the client")
+    parser.add_argument("--compare", action="store_true", help="Repeat the burst with the adaptive rate disabled")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR, format="%(asctime)s %(levelname)s %(message)s")
+    limit, window_seconds = args.throttle.split("/")
+    runs = [("adaptive", None)] + ([("fixed rate", 0)] if args.compare else [])
+
+    failed = False
+    with RecordedArmServer(recordings(args.subscriptions, int(limit), float(window_seconds))) as server:
+        os.environ.update({"ARM_ENDPOINT": server.url, "ARM_REQUESTS_PER_SECOND": args.rate})
+        from common import Config, azure_clients, arm_rate_limiter
+        azure_clients.set_credential(StaticTokenCredential())
+
+        for name, watermark in runs:
+            if watermark is not None:
+                Config.arm_quota_low_watermark = watermark
+            # Start each run with full buckets and a fresh quota window
+            arm_rate_limiter._buckets.clear()
+            time.sleep(float(window_seconds))
+
+            statuses, elapsed, throttled = run_burst(server, args.subscriptions, args.concurrency)
+            ok = statuses.count(200)
+            print(f"{name:<10}: {ok}/{len(statuses)} succeeded in {elapsed:.1f}s ({len(statuses) / elapsed:.1f} req/s), {throttled} throttled (429) response(s)")
+            failed = failed or ok != len(statuses)
+
+    if failed:
+        print("FAIL: not every request succeeded")
+        sys.exit(1)
+    print("OK")
+
+if __name__ == "__main__":
+    main()
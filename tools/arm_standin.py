@@ -0,0 +1,222 @@
+"""Recorded-response HTTP stand-in for Azure Resource Manager and Azure Monitor
+
+Serves responses from a recordings file so the exporters can be run locally
+without Azure. Point the function app at it with ARM_ENDPOINT and
+MONITOR_METRICS_ENDPOINT (the {location} placeholder can be left out, as the
+stand-in serves every region).
+
+A recordings file is a JSON object with an "interactions" list. Each
+interaction has a "request" to match and a "response" to send:
+
+    {"request": {"method": "POST", "path": "/subscriptions/.../metrics:getBatch",
+                 "query": {"metricnamespace": "microsoft.compute/virtualmachines"},
+                 "json": {"resourceids": ["..."]}},
+     "response": {"status": 200, "headers": {}, "json": {...}},
+     "times": 1}
+
+query and json only need to contain the parts that identify the request: a
+request matches if they are a subset of what was sent. The first matching
+interaction is used; one with "times" is used up after that many responses,
+e.g. to serve a 429 before the recorded 200. Unmatched requests get a 404.
+
+A top-level "throttle" object simulates ARM's request quota:
+
+    {"throttle": {"requests": 100, "window_seconds": 10,
+                  "header": "x-ms-ratelimit-remaining-subscription-reads"}}
+
+Every response then carries the header with the requests left in the current
+window, and requests beyond the quota get a 429 with a Retry-After of the time
+until the window resets. --throttle REQUESTS/SECONDS sets the same from the
+command line.
+
+With --record, requests are forwarded to the real endpoint (with the caller's
+Authorization header) and appended to the recordings file instead.
+
+Usage: python tools/arm_standin.py tools/recordings/utilization.json [--port 8080]
+       python tools/arm_standin.py tools/recordings/throttling.json --throttle 50/5
+       python tools/arm_standin.py new-recordings.json --record https://management.azure.com
+"""
+import argparse
+import json
+import logging
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qsl
+
+def is_subset(expected, actual):
+    """Check that expected is contained in actual: dicts by key, everything else by equality"""
+    if isinstance(expected, dict):
+        return isinstance(actual, dict) and all(key in actual and is_subset(value, actual[key]) for key, value in expected.items())
+    return expected == actual
+
+class RecordedArmServer(ThreadingHTTPServer):
+    """HTTP server replaying (or recording) ARM interactions
+
+    Every request admitted past the throttle is kept in requests as (method, path, query, json)
+    so callers can check what was sent, and throttled counts the 429s sent
+    when a throttle quota is set.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, recordings, port=0, record_upstream=None, recordings_path=None):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.interactions = [dict(interaction) for interaction in recordings.get("interactions", [])]
+        self.record_upstream = record_upstream.rstrip("/") if record_upstream else None
+        self.recordings_path = recordings_path
+        self.requests = []
+        self.lock = threading.Lock()
+        self._thread = None
+        self.throttle = recordings.get("throttle")
+        self.throttled = 0
+        self._window_start = time.monotonic()
+        self._window_requests = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def match(self, method, path, query, body):
+        """Return the response of the first interaction matching a request, or None"""
+        with self.lock:
+            self.requests.append((method, path, query, body))
+            for interaction in self.interactions:
+                request = interaction["request"]
+                if request.get("method", "GET").upper() != method or request["path"] != path:
+                    continue
+                if not is_subset(request.get("query", {}), query) or not is_subset(request.get("json", {}), body or {}):
+                    continue
+                if "times" in interaction:
+                    if interaction["times"] <= 0:
+                        continue
+                    interaction["times"] -= 1
+                return interaction["response"]
+        return None
+
+    def admit(self):
+        """Count a request against the throttle quota
+
+        Returns (headers to add, throttled response or None).
+        """
+        if not self.throttle:
+            return {}, None
+        header = self.throttle.get("header", "x-ms-ratelimit-remaining-subscription-reads")
+        with self.lock:
+            now = time.monotonic()
+            window_end = self._window_start + self.throttle["window_seconds"]
+            if now >= window_end:
+                self._window_start, self._window_requests = now, 0
+                window_end = now + self.throttle["window_seconds"]
+            self._window_requests += 1
+            remaining = self.throttle["requests"] - self._window_requests
+            if remaining >= 0:
+                return {header: str(remaining)}, None
+            self.throttled += 1
+            retry_after = max(1, math.ceil(window_end - now))
+        return {}, {
+            "status": 429,
+            "headers": {header: "0", "Retry-After": str(retry_after)},
+            "json": {"error": {"code": "TooManyRequests", "message": f"Quota of {self.throttle['requests']} requests per {self.throttle['window_seconds']} seconds exceeded"}},
+        }
+
+    def record(self, method, path, query, body, response):
+        with self.lock:
+            self.interactions.append({
+                "request": {"method": method, "path": path, "query": query, "json": body},
+                "response": response,
+            })
+            with open(self.recordings_path, "w") as f:
+                json.dump({"interactions": self.interactions}, f, indent=2)
+
+class _Handler(BaseHTTPRequestHandler):
+    def _handle(self):
+        parts = urlsplit(self.path)
+        query = dict(parse_qsl(parts.query, keep_blank_values=True))
+        length = int(self.headers.get("Content-Length") or 0)
+        raw_body = self.rfile.read(length) if length else b""
+        try:
+            body = json.loads(raw_body) if raw_body else None
+        except ValueError:
+            body = None
+
+        quota_headers, response = self.server.admit()
+        if response is None and self.server.record_upstream:
+            response = self._forward(raw_body)
+            self.server.record(self.command, parts.path, query, body, response)
+        elif response is None:
+            response = self.server.match(self.command, parts.path, query, body)
+            if response is None:
+                logging.warning(f"No recorded response for {self.command} {self.path} {body}")
+                response = {"status": 404, "json": {"error": {"code": "NoRecording", "message": f"No recorded response for {self.command} {parts.path}"}}}
+
+        payload = json.dumps(response.get("json", {})).encode("utf-8")
+        self.send_response(response.get("status", 200))
+        for name, value in {**response.get("headers", {}), **quota_headers}.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _forward(self, raw_body):
+        import requests
+
+        headers = {name: value for name, value in self.headers.items() if name.lower() in ("authorization", "content-type")}
+        upstream = requests.request(self.command, f"{self.server.record_upstream}{self.path}", headers=headers, data=raw_body or None, timeout=300)
+        try:
+            payload = upstream.json()
+        except ValueError:
+            payload = {"text": upstream.text}
+        kept_headers = {name: value for name, value in upstream.headers.items() if name.lower() == "retry-after" or name.lower().startswith("x-ms-ratelimit")}
+        return {"status": upstream.status_code, "headers": kept_headers, "json": payload}
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        logging.debug(f"{self.address_string()} {format % args}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recordings", help="Recordings file to serve, or to write with --record")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--record", metavar="UPSTREAM", help="Forward requests to UPSTREAM and record the responses")
+    parser.add_argument("--throttle", metavar="REQUESTS/SECONDS", help="Answer with 429 beyond REQUESTS requests per SECONDS-second window")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    recordings = {"interactions": []}
+    if not args.record:
+        with open(args.recordings) as f:
+            recordings = json.load(f)
+    if args.throttle:
+        limit, seconds = args.throttle.split("/")
+        recordings["throttle"] = {"requests": int(limit), "window_seconds": float(seconds)}
+
+    server = RecordedArmServer(recordings, port=args.port, record_upstream=args.record, recordings_path=args.recordings)
+    logging.info(f"Serving {len(server.interactions)} recorded interactions on {server.url}" if not args.record else f"Recording {args.record} to {args.recordings} on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
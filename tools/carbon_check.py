@@ -0,0 +1,76 @@
+"""Check the merge of chunked carbon emissions reports against the recorded-response stand-in
+
+Starts tools/arm_standin.py in-process with a recordings file holding the same
+MonthlySummaryReport as one unchunked response and as responses for chunks of
+subscriptions, then fetches the report both ways. Each result must have the
+records of the "expected" section, in the same order: the summed emissions,
+the month-over-month change ratio recomputed from the sums and the carbon
+intensity re-weighted by each chunk's emissions.
+
+Exits with status 1 on a mismatch, so it can be run as a check in CI.
+
+Usage: python tools/carbon_check.py [--recordings tools/recordings/carbon.json]
+"""
+import argparse
+import json
+import math
+import os
+import sys
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TOOLS_DIR, "..", "src", "cost_export"))
+sys.path.insert(0, TOOLS_DIR)
+
+from arm_standin import RecordedArmServer  # noqa: E402
+from utilization_check import StaticTokenCredential  # noqa: E402
+
+CHECKED_FIELDS = ("latestMonthEmissions", "previousMonthEmissions", "monthlyEmissionsChangeValue", "monthOverMonthEmissionsChangeRatio", "carbonIntensity")
+
+def compare(name, report, expected):
+    """Return the differences between a merged report and the expected records"""
+    records = report.get("value", [])
+    keys = [(r.get("date"), r.get("dataType")) for r in records]
+    expected_keys = [(r["date"], r["dataType"]) for r in expected]
+    if keys != expected_keys:
+        return [f"{name}: records {keys}, expected {expected_keys}"]
+    failures = []
+    for record, expected_record in zip(records, expected):
+        for field in CHECKED_FIELDS:
+            if not math.isclose(record.get(field), expected_record[field], rel_tol=1e-9, abs_tol=1e-12):
+                failures.append(f"{name}: {field} for {record['date']} is {record.get(field)}, expected {expected_record[field]}")
+    return failures
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recordings", default=os.path.join(TOOLS_DIR, "recordings", "carbon.json"))
+    args = parser.parse_args()
+
+    with open(args.recordings) as f:
+        recordings = json.load(f)
+
+    with RecordedArmServer(recordings) as server:
+        os.environ["ARM_ENDPOINT"] = server.url
+        from common import Config, azure_clients
+        from carbon import fetch_monthly_summary_report
+
+        azure_clients.set_credential(StaticTokenCredential())
+        subscription_ids = max((i["request"]["json"]["subscriptionList"] for i in recordings["interactions"]), key=len)
+
+        results = {}
+        for name, chunk_size in (("unchunked", len(subscription_ids)), ("chunked", recordings["chunk_size"])):
+            Config.carbon_subscription_chunk_size = chunk_size
+            sent_before = len(server.requests)
+            results[name] = fetch_monthly_summary_report(subscription_ids, recordings["month"])
+            print(f"{name:<9}: {len(results[name].get('value', []))} records from {len(server.requests) - sent_before} request(s)")
+
+    failures = []
+    for name, report in results.items():
+        failures.extend(compare(name, report, recordings["expected"]["value"]))
+
+    if failures:
+        print(f"FAIL: {'; '.join(failures)}")
+        sys.exit(1)
+    print("OK: the chunked and unchunked reports have the expected records in the same order")
+
+if __name__ == "__main__":
+    main()
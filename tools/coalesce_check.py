@@ -0,0 +1,171 @@
+"""Check that a MonthToDate rerun replaces the coalesced outputs of the previous run
+
+Runs CostExportBatchProcessor twice over the same synthetic export parts, as
+two daily runs of the same export write them under a new run timestamp and ID.
+The second drain uses a different COALESCE_TARGET_BYTES, so its parts are
+grouped into different chunks and its outputs get different names. The row
+count under S3_FOCUS_PATH must be the same after both drains.
+
+Blob storage and the costdata queue are in-memory stand-ins; S3 is moto,
+started in-process, with STS stubbed as in benchmarks/cost_export_benchmark.py.
+
+Exits with status 1 if the second drain changed the row count or left messages
+on the queue, so it can be run as a check in CI.
+
+Usage: python tools/coalesce_check.py [--rows 5000] [--files 6]
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import uuid
+from types import SimpleNamespace
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCHMARKS_DIR = os.path.join(TOOLS_DIR, "..", "benchmarks")
+sys.path.insert(0, os.path.join(TOOLS_DIR, "..", "src", "cost_export"))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from cost_export_benchmark import BUCKET_NAME, CONTAINER_NAME, event_message, generate_parts, start_moto_server, stub_sts  # noqa: E402
+
+RUNS = [("202508150632", 1), ("202508160631", 2)]
+
+class MemoryBlobClient:
+    """The subset of BlobClient the processor uses, over a dict of blob name to bytes"""
+
+    def __init__(self, blobs, name):
+        self._blobs = blobs
+        self._name = name
+
+    def _data(self):
+        from azure.core.exceptions import ResourceNotFoundError
+        if self._name not in self._blobs:
+            raise ResourceNotFoundError(f"The specified blob does not exist: {self._name}")
+        return self._blobs[self._name]
+
+    def get_blob_properties(self):
+        return SimpleNamespace(size=len(self._data()))
+
+    def download_blob(self, offset=0, length=None):
+        data = self._data()
+        end = len(data) if length is None else offset + length
+        return SimpleNamespace(readall=lambda: data[offset:end])
+
+    def upload_blob(self, data, overwrite=False):
+        self._blobs[self._name] = data.encode("utf-8") if isinstance(data, str) else bytes(data)
+
+    def delete_blob(self):
+        self._data()
+        del self._blobs[self._name]
+
+class MemoryContainerClient:
+    def __init__(self):
+        self.blobs = {}
+
+    def get_container_client(self, name):
+        return self
+
+    def get_blob_client(self, name):
+        return MemoryBlobClient(self.blobs, name)
+
+    def delete_blobs(self, *names):
+        for name in names:
+            self.blobs.pop(name, None)
+
+class MemoryQueueClient:
+    def __init__(self):
+        self.messages = []
+        self.hidden = set()
+
+    def send_message(self, content):
+        self.messages.append(SimpleNamespace(id=uuid.uuid4().hex, content=content))
+
+    def receive_messages(self, messages_per_page=None, max_messages=None, visibility_timeout=None):
+        # Received messages stay hidden until deleted, as within the visibility timeout
+        received = [message for message in self.messages if message.id not in self.hidden][:max_messages]
+        self.hidden.update(message.id for message in received)
+        return received
+
+    def delete_message(self, message):
+        self.messages.remove(message)
+
+def run_blob_name(blob_name, timestamp, run):
+    """Move a part of the benchmark's export run to another run timestamp and ID"""
+    return blob_name.replace("202508150632", timestamp).replace(str(uuid.UUID(int=1)), str(uuid.UUID(int=run)))
+
+def count_rows(s3_client, prefix):
+    """Return (objects, rows) under an S3 prefix, reading each object's parquet footer"""
+    import pyarrow.parquet as pq
+    from common import getS3FileSystem
+
+    objects = rows = 0
+    for page in s3_client.get_paginator("list_objects_v2").paginate(Bucket=BUCKET_NAME, Prefix=prefix):
+        for item in page.get("Contents", []):
+            if item["Key"].endswith(".parquet"):
+                with getS3FileSystem().open_input_file(f"{BUCKET_NAME}/{item['Key']}") as f:
+                    rows += pq.ParquetFile(f).metadata.num_rows
+                objects += 1
+    return objects, rows
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=5000, help="Rows per export part")
+    parser.add_argument("--files", type=int, default=6, help="Number of export parts per run")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.ERROR, format="%(asctime)s %(levelname)s %(message)s")
+    server, s3_endpoint = start_moto_server()
+    prefix = "coalesce-check/"
+    os.environ.update({
+        "ENTRA_APP_CLIENT_ID": "00000000-0000-0000-0000-000000000000",
+        "ENTRA_APP_URN": "api://coalesce-check",
+        "AWS_ROLE_ARN": "arn:aws:iam::000000000000:role/coalesce-check",
+        "AWS_REGION": "eu-west-2",
+        "S3_FOCUS_PATH": f"s3://{BUCKET_NAME}/{prefix}",
+        "CONTAINER_NAME": CONTAINER_NAME,
+        "COST_EXPORT_BATCH_MODE": "true",
+    })
+    try:
+        import common
+        import function_app
+
+        stub_sts(common, s3_endpoint, "check", "check")
+        s3_client = common.getS3Client()
+        s3_client.create_bucket(Bucket=BUCKET_NAME, CreateBucketConfiguration={"LocationConstraint": "eu-west-2"})
+
+        container_client = MemoryContainerClient()
+        queue_client = MemoryQueueClient()
+        common.azure_clients._blob_service_client = container_client
+        common.azure_clients._queue_clients[function_app.COST_DATA_QUEUE] = queue_client
+
+        counts = []
+        with tempfile.TemporaryDirectory() as directory:
+            parts = generate_parts(directory, args.rows, args.files, extra_columns=0)
+            part_bytes = parts[0][3]
+            # One part per chunk on the first run, two per chunk on the second
+            for (timestamp, run), target_bytes in zip(RUNS, (part_bytes, part_bytes * 2 + 1)):
+                common.Config.coalesce_target_bytes = target_bytes
+                for blob_name, path, _, size in parts:
+                    name = run_blob_name(blob_name, timestamp, run)
+                    with open(path, "rb") as f:
+                        container_client.blobs[name] = f.read()
+                    queue_client.send_message(event_message(name, size))
+
+                function_app.cost_export_batch_processor(None)
+                queue_client.hidden.clear()
+                objects, rows = count_rows(s3_client, prefix)
+                counts.append(rows)
+                print(f"run {timestamp}: {objects} object(s), {rows} rows in S3, {len(queue_client.messages)} message(s) left")
+    finally:
+        server.stop()
+
+    expected = args.rows * args.files
+    if counts != [expected, expected] or queue_client.messages:
+        print(f"FAIL: expected {expected} rows and no messages left after each run, found {counts} rows and {len(queue_client.messages)} message(s)")
+        sys.exit(1)
+    print("OK: the rerun replaced the previous run's coalesced outputs")
+
+if __name__ == "__main__":
+    main()
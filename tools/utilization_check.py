@@ -0,0 +1,85 @@
+"""Run the utilization exporter against the recorded-response stand-in
+
+Starts tools/arm_standin.py in-process with a recordings file, points the
+exporter's ARM and metrics endpoints at it, and writes the parquet output to a
+local file instead of S3. The resource, batch and row counts are checked
+against the "expected" section of the recordings file.
+
+Exits with status 1 on a mismatch, so it can be run as a check in CI.
+
+Usage: python tools/utilization_check.py [--recordings tools/recordings/utilization.json] [--output utilization.parquet]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone, timedelta
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TOOLS_DIR, "..", "src", "cost_export"))
+sys.path.insert(0, TOOLS_DIR)
+
+from arm_standin import RecordedArmServer  # noqa: E402
+
+class StaticTokenCredential:
+    """Credential returning a fixed token, as the stand-in does not check authorization"""
+
+    def get_token(self, *scopes, **kwargs):
+        from azure.core.credentials import AccessToken
+        return AccessToken("stand-in", int(time.time()) + 3600)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recordings", default=os.path.join(TOOLS_DIR, "recordings", "utilization.json"))
+    parser.add_argument("--day", default="2025-08-14", help="Day the recordings cover (YYYY-MM-DD)")
+    parser.add_argument("--interval", default="PT6H", help="Metric time grain the recordings were made with")
+    parser.add_argument("--batch-size", type=int, default=2, help="Resources per batch metrics request")
+    parser.add_argument("--output", help="Keep the parquet output at this path")
+    args = parser.parse_args()
+
+    with open(args.recordings) as f:
+        recordings = json.load(f)
+
+    with RecordedArmServer(recordings) as server:
+        os.environ.update({
+            "ARM_ENDPOINT": server.url,
+            "MONITOR_METRICS_ENDPOINT": server.url,
+            "UTILIZATION_INTERVAL": args.interval,
+            "UTILIZATION_BATCH_SIZE": str(args.batch_size),
+        })
+        import pyarrow.parquet as pq
+        from common import azure_clients
+        from utilization import list_compute_resources, write_utilization
+
+        azure_clients.set_credential(StaticTokenCredential())
+        start = datetime.strptime(args.day, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+        subscription_ids = sorted({r["subscriptionId"] for i in recordings["interactions"] for r in i["response"].get("json", {}).get("data", [])})
+
+        resources = list_compute_resources(subscription_ids)
+        output = args.output or os.path.join(tempfile.mkdtemp(), "utilization.parquet")
+        with open(output, "wb") as sink:
+            summary = write_utilization(resources, start, start + timedelta(days=1), sink)
+
+        table = pq.read_table(output)
+        print(f"Summary: {summary}")
+        print(f"Requests served: {len(server.requests)}")
+        units = {}
+        for row in table.group_by(["ResourceType", "MetricName", "Unit"]).aggregate([("Timestamp", "count"), ("Average", "mean")]).to_pylist():
+            units.setdefault(row["MetricName"], set()).add(row["Unit"])
+            print(f"  {row['ResourceType']:<45} {row['MetricName']:<40} {row['Timestamp_count']:>5} rows, mean {row['Average_mean']:.2f} {row['Unit']}")
+
+    expected = recordings.get("expected", {})
+    actual = {"resources": summary["resources"], "batches": summary["batches"], "rows": table.num_rows}
+    mismatches = {key: (value, actual.get(key)) for key, value in expected.items() if actual.get(key) != value}
+    # Free memory is an amount, so it must not be labelled as a percentage like the other metrics
+    if units.get("Available Memory Bytes", {"Bytes"}) != {"Bytes"}:
+        mismatches["Available Memory Bytes unit"] = ("Bytes", sorted(units["Available Memory Bytes"]))
+    if mismatches or summary["failed_batches"]:
+        print(f"FAIL: expected != actual for {mismatches}, {summary['failed_batches']} failed batch(es)")
+        sys.exit(1)
+    print(f"OK: {actual}")
+
+if __name__ == "__main__":
+    main()
@@ -65,4 +65,97 @@ variable "focus_dataset_version" {
   description = "Version of the cost and usage details (FOCUS) dataset to use"
   type        = string
   default     = "1.0r2"
-}
\ No newline at end of file
+}
+
+variable "cost_export_batch_mode" {
+  description = "If true, FOCUS cost export parts are drained from the queue in batches by the CostExportBatchProcessor function and coalesced into fewer, larger S3 objects, and the per-message CostExportProcessor function is disabled"
+  type        = bool
+  default     = false
+}
+
+variable "enable_s3_compaction" {
+  description = "If true, the FocusPartitionCompactor function compacts the FOCUS parquet files in each billing_period partition in S3 once the billing period has closed. This is not invisible to queries: while each compacted file's sources are being deleted, queries of the partition count those rows twice"
+  type        = bool
+  default     = false
+}
+
+variable "focus_incremental_mode" {
+  description = "If true, the daily FOCUS export is processed incrementally: only the charge days whose row count or cost totals changed since the previous run are written to S3, as day-level objects, instead of rewriting the whole month to date"
+  type        = bool
+  default     = false
+}
+
+variable "parquet_compression" {
+  description = "Compression codec for the FOCUS parquet files written to S3 (e.g. 'snappy', 'zstd', 'gzip')"
+  type        = string
+  default     = "snappy"
+}
+
+variable "parquet_compression_level" {
+  description = "Compression level for the parquet codec. Set to null to use the codec's default"
+  type        = number
+  default     = null
+}
+
+variable "parquet_dictionary_columns" {
+  description = "Columns to dictionary encode in the FOCUS parquet files written to S3. These should be low-cardinality columns; an empty list dictionary encodes every column"
+  type        = list(string)
+  default     = []
+}
+
+variable "parquet_row_group_rows" {
+  description = "Number of rows per row group in the FOCUS parquet files written to S3. Set to null to write one row group per decoded record batch"
+  type        = number
+  default     = null
+}
+
+variable "parquet_sort_columns" {
+  description = "Columns the rows of each row group are sorted by, which improves compression and min/max statistics for filtering"
+  type        = list(string)
+  default     = []
+}
+
+variable "parquet_write_page_index" {
+  description = "If true, a page index is written to the FOCUS parquet files so query engines can skip pages as well as row groups"
+  type        = bool
+  default     = false
+}
+
+variable "metrics_mode" {
+  description = "Per-stage timings and counters for each function invocation: 'off', 'log' for one structured log line per invocation, or 'otel' for OpenTelemetry metrics sent to Application Insights"
+  type        = string
+  default     = "off"
+}
+
+variable "recommendations_output_format" {
+  description = "Formats the Azure Advisor recommendations are written to S3 in: 'json' for a {\"value\": [...]} JSON document, 'ndjson' for newline-delimited JSON in a .ndjson file and/or 'parquet' for a flattened, typed table"
+  type        = list(string)
+  default     = ["json"]
+
+  validation {
+    condition     = length(var.recommendations_output_format) > 0 && alltrue([for f in var.recommendations_output_format : contains(["json", "ndjson", "parquet"], f)])
+    error_message = "recommendations_output_format must contain one or more of 'json', 'ndjson' and 'parquet'."
+  }
+}
+
+variable "carbon_output_format" {
+  description = "Formats the carbon emissions reports are written to S3 in: 'json' and/or 'parquet' for a flattened, typed table"
+  type        = list(string)
+  default     = ["json"]
+
+  validation {
+    condition     = length(var.carbon_output_format) > 0 && alltrue([for f in var.carbon_output_format : contains(["json", "parquet"], f)])
+    error_message = "carbon_output_format must contain 'json', 'parquet' or both."
+  }
+}
+
+variable "advisor_engine" {
+  description = "Where the AdvisorRecommendationsExporter function reads cost recommendations: 'api' calls the Azure Advisor API once per subscription, 'resource_graph' runs one paged Azure Resource Graph query of the advisorresources table for the whole management group"
+  type        = string
+  default     = "api"
+
+  validation {
+    condition     = contains(["api", "resource_graph"], var.advisor_engine)
+    error_message = "advisor_engine must be 'api' or 'resource_graph'."
+  }
+}